@@ -0,0 +1,114 @@
+import json
+import time
+import socket
+import resource
+import contextlib
+
+# Version of the format of the stored results
+RESULTS_VERSION = 1
+
+def get_peak_rss():
+    '''
+    Return peak resident set size in kB of this process
+    and of its terminated children (process pool workers).
+    '''
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+class StageTimer(object):
+    '''
+    Measures wall clock time, processor time and peak memory of named
+    stages. A stage entered several times accumulates its times.
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self._stats = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.time()
+        cpu = time.clock()
+        try:
+            yield
+        finally:
+            if name not in self._stats:
+                self.stages.append(name)
+                self._stats[name] = {"seconds": 0.0, "cpu_seconds": 0.0, "calls": 0}
+
+            stats = self._stats[name]
+            stats["seconds"] += time.time() - wall
+            stats["cpu_seconds"] += time.clock() - cpu
+            stats["calls"] += 1
+            stats["peak_rss_kb"], stats["children_peak_rss_kb"] = get_peak_rss()
+
+    def get_stats(self):
+        '''
+        Return list of dicts with name and statistics of the stages
+        in order of their first start.
+        '''
+        return [dict(self._stats[name], name=name) for name in self.stages]
+
+class NullTimer(object):
+    '''
+    StageTimer which measures nothing.
+    '''
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield
+
+null_timer = NullTimer()
+
+def save_results(path, timer, parameters):
+    '''
+    Store statistics of the stages measured by `timer`, the time since
+    it was created and the benchmark `parameters` to a JSON file.
+    '''
+    stages = timer.get_stats()
+    peak_rss, children_peak_rss = get_peak_rss()
+    results = {"version": RESULTS_VERSION,
+               "time": int(time.time()),
+               "host": socket.gethostname(),
+               "parameters": parameters,
+               "stages": stages,
+               "seconds": time.time() - timer.started,
+               "peak_rss_kb": peak_rss,
+               "children_peak_rss_kb": children_peak_rss}
+
+    with open(path, "w") as fil:
+        json.dump(results, fil, indent=2, sort_keys=True)
+
+    return results
+
+def load_results(path):
+    with open(path, "r") as fil:
+        results = json.load(fil)
+
+    if results.get("version") != RESULTS_VERSION:
+        raise Exception, "Unsupported version of benchmark results in {0}".format(path)
+
+    return results
+
+def compare_results(old, new):
+    '''
+    Return list of tuples of stage name, old seconds, new seconds and
+    their ratio for the stages of `new` results, followed by the totals.
+    '''
+    old_stages = dict((stage["name"], stage) for stage in old["stages"])
+
+    result = []
+    for stage in new["stages"]:
+        old_seconds = old_stages.get(stage["name"], {}).get("seconds")
+        ratio = None
+        if old_seconds:
+            ratio = stage["seconds"] / old_seconds
+        result.append((stage["name"], old_seconds, stage["seconds"], ratio))
+
+    ratio = None
+    if old["seconds"]:
+        ratio = new["seconds"] / old["seconds"]
+    result.append(("total", old["seconds"], new["seconds"], ratio))
+
+    return result
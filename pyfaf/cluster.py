@@ -1,116 +1,440 @@
+import zlib
+import mmap
+import array
+import random
 import logging
+import tempfile
+import itertools
+import multiprocessing
 
 import btparser
 
 from sqlalchemy import func
 
 import pyfaf
+from pyfaf.benchmark import null_timer
 from pyfaf.storage.opsys import OpSys, OpSysComponent
-from pyfaf.storage.report import Report
-from pyfaf.storage.problem import Problem, ProblemComponent
-
-def get_funs_clusters(threads, max_cluster_size, log_debug=None):
-    # Return list of sets of threads clustered by common function names
-
-    # function name -> set of threads
-    funs_threads = dict()
-    for thread in threads:
+from pyfaf.storage.report import Report, ReportChanged
+from pyfaf.storage.problem import (Problem,
+                                   ProblemComponent,
+                                   ProblemThread)
+
+def get_funs_index(threads):
+    # Return tuple of list of function names and inverted index of the
+    # threads with them in CSR layout: threads having function i are
+    # thread_ids[offsets[i]:offsets[i + 1]]. Function names are numbered
+    # in order of their first appearance, thread ids are ascending.
+
+    # function name -> function id
+    fun_ids = dict()
+    fun_names = []
+    # ids of threads having the function, ascending
+    fun_threads = []
+
+    for thread_id, thread in enumerate(threads):
+        last_fun_id = None
         for frame in thread.frames:
             name = frame.get_function_name()
-            if name == "??":
+            fun_id = fun_ids.get(name)
+            if fun_id is None:
+                if name == "??":
+                    continue
+                fun_id = fun_ids[name] = len(fun_names)
+                fun_names.append(name)
+                fun_threads.append(array.array("l"))
+            elif fun_id == last_fun_id or fun_threads[fun_id][-1] == thread_id:
                 continue
-            if not funs_threads.has_key(name):
-                funs_threads[name] = set([thread])
-            funs_threads[name].add(thread)
+            fun_threads[fun_id].append(thread_id)
+            last_fun_id = fun_id
 
-    if log_debug:
-        log_debug("Found {0} unique function names.".format(len(funs_threads)))
+    # concatenate the lists into one array
+    offsets = array.array("l", [0])
+    thread_ids = array.array("l")
+    for fun_id in xrange(len(fun_names)):
+        thread_ids.extend(fun_threads[fun_id])
+        offsets.append(len(thread_ids))
+        fun_threads[fun_id] = None
+
+    return fun_names, offsets, thread_ids
+
+def get_funs_clusters(threads, max_cluster_size, log_debug=None):
+    # Return list of sets of threads clustered by common function names
+
+    fun_names, offsets, thread_ids = get_funs_index(threads)
 
-    # remove functions which are only in one thread
-    for (name, thread_set) in funs_threads.items():
-        if len(thread_set) == 1:
-            del funs_threads[name]
+    def fun_count(fun_id):
+        return offsets[fun_id + 1] - offsets[fun_id]
 
     if log_debug:
-        log_debug("Found {0} function names used in more than one thread.".format(len(funs_threads)))
+        log_debug("Found {0} unique function names.".format(len(fun_names)))
 
-    # sort the function names by number of threads having them
-    funs_by_use = list(funs_threads.keys())
-    funs_by_use.sort(key = lambda name: len(funs_threads[name]))
+    # skip functions which are only in one thread
+    # and sort the rest by number of threads having them
+    funs_by_use = [fun_id for fun_id in xrange(len(fun_names)) if fun_count(fun_id) > 1]
+    funs_by_use.sort(key=fun_count)
 
     if log_debug:
+        log_debug("Found {0} function names used in more than one thread.".format(len(funs_by_use)))
         log_debug("10 most common function names:")
-        for name in reversed(funs_by_use[-10:]):
-            log_debug("- {0} {1}".format(len(funs_threads[name]), name))
-
-    # thread -> threads
-    thread_threads = dict()
-
-    # merge threads with common funs
-    for name in funs_by_use:
-        thread_sets = []
-        included_sets_ids = set()
-        detached_threads = set()
-        for thread in funs_threads[name]:
-            if thread in thread_threads:
-                threads = thread_threads[thread]
-                if id(threads) in included_sets_ids:
-                    continue
-                thread_sets.append(threads)
-                included_sets_ids.add(id(threads))
-            else:
-                detached_threads.add(thread)
+        for fun_id in reversed(funs_by_use[-10:]):
+            log_debug("- {0} {1}".format(fun_count(fun_id), fun_names[fun_id]))
+
+    # union-find of the thread clusters, -1 for threads not in any cluster yet
+    parent = array.array("l", [-1]) * len(threads)
+    size = array.array("l", [0]) * len(threads)
+
+    def find(thread_id):
+        root = thread_id
+        while parent[root] != root:
+            root = parent[root]
+        while parent[thread_id] != root:
+            parent[thread_id], thread_id = root, parent[thread_id]
+        return root
+
+    # merge clusters of threads with common funs
+    for fun_id in funs_by_use:
+        roots = []
+        included_roots = set()
+        detached_threads = []
+        for i in xrange(offsets[fun_id], offsets[fun_id + 1]):
+            thread_id = thread_ids[i]
+            if parent[thread_id] < 0:
+                detached_threads.append(thread_id)
+                continue
+            root = find(thread_id)
+            if root not in included_roots:
+                roots.append(root)
+                included_roots.add(root)
 
-        # add new set of threads which are alone now
+        # add new cluster of threads which are alone now
         if 1 <= len(detached_threads) <= max_cluster_size:
-            for thread in detached_threads:
-                thread_threads[thread] = detached_threads
-            thread_sets.append(detached_threads)
-
-        # sort the sets by their size
-        thread_sets.sort(key = lambda threads: len(threads))
-
-        # group the sets so that the sizes of the results are not over the limit
-        group_sets = [[]]
-        size = 0
-        for thread_set in thread_sets:
-            if len(thread_set) > max_cluster_size:
+            root = detached_threads[0]
+            for thread_id in detached_threads:
+                parent[thread_id] = root
+            size[root] = len(detached_threads)
+            roots.append(root)
+
+        # sort the clusters by their size
+        roots.sort(key=lambda root: size[root])
+
+        # group the clusters so that the sizes of the results are not over the limit
+        groups = [[]]
+        group_size = 0
+        for root in roots:
+            if size[root] > max_cluster_size:
                 break
-            if size + len(thread_set) > max_cluster_size:
-                group_sets.append([thread_set])
-                size = len(thread_set)
+            if group_size + size[root] > max_cluster_size:
+                groups.append([root])
+                group_size = size[root]
             else:
-                group_sets[-1].append(thread_set)
-                size += len(thread_set)
+                groups[-1].append(root)
+                group_size += size[root]
 
-        # join the sets in the groups, smaller sets with the largest one
-        for join_sets in group_sets:
-            if len(join_sets) < 2:
+        # join the clusters in the groups, smaller ones to the largest one
+        for group in groups:
+            if len(group) < 2:
                 continue
 
-            new_threads = set()
-            for threads in join_sets[:-1]:
-                assert len(threads & new_threads) == 0
-                new_threads |= threads
+            target = group[-1]
+            for root in group[:-1]:
+                parent[root] = target
+                size[target] += size[root]
+
+    # collect the clusters ordered by their first thread
+    clusters = dict()
+    result = []
+    for thread_id in xrange(len(threads)):
+        if parent[thread_id] < 0:
+            continue
+        root = find(thread_id)
+        if size[root] < 2:
+            continue
+        if root not in clusters:
+            clusters[root] = []
+            result.append(clusters[root])
+        clusters[root].append(threads[thread_id])
+
+    return result
+
+# Candidate generation methods of cluster_threads
+CANDIDATES_FUNS = "funs"
+CANDIDATES_MINHASH = "minhash"
+
+# Default number of LSH bands and of MinHash values in a band, threads
+# with Jaccard similarity s share a bucket with probability
+# 1 - (1 - s^rows)^bands
+DEFAULT_LSH_BANDS = 16
+DEFAULT_LSH_ROWS = 4
+
+# Modulus of the MinHash functions (Mersenne prime 2^61 - 1)
+MINHASH_PRIME = (1 << 61) - 1
+
+def get_thread_shingles(thread):
+    # Return set of function@library shingles of the thread frames
+    # with known function names.
+    result = set()
+    for frame in thread.frames:
+        name = frame.get_function_name()
+        if name != "??":
+            result.add("{0}@{1}".format(name, frame.get_library_name()))
+
+    return result
+
+def get_minhash_clusters(threads, max_cluster_size, bands=DEFAULT_LSH_BANDS,
+                         rows=DEFAULT_LSH_ROWS, seed=0, log_debug=None):
+    # Return list of lists of threads whose MinHash signatures of frame
+    # shingles agree in all rows of at least one LSH band, the buckets
+    # are joined only up to max_cluster_size threads.
+
+    # MinHash functions (a * x + b) mod p, fixed by the seed
+    rand = random.Random(seed)
+    coefs = [(rand.randint(1, MINHASH_PRIME - 1), rand.randint(0, MINHASH_PRIME - 1))
+             for i in xrange(bands * rows)]
+
+    # hash values of the shingles, most shingles are shared by many threads
+    shingle_hashes = dict()
+
+    def get_shingle_hashes(shingle):
+        result = shingle_hashes.get(shingle)
+        if result is None:
+            x = zlib.crc32(shingle) & 0xffffffff
+            result = shingle_hashes[shingle] = [(a * x + b) % MINHASH_PRIME
+                                                for a, b in coefs]
+        return result
+
+    # hashes of the bands of the thread signatures, None for threads
+    # without any shingle
+    band_hashes = [array.array("l", [0]) * len(threads) for band in xrange(bands)]
+    hashed = array.array("b", [0]) * len(threads)
+    for thread_id, thread in enumerate(threads):
+        shingles = get_thread_shingles(thread)
+        if not shingles:
+            continue
 
-            assert len(join_sets[-1] & new_threads) == 0
-            join_sets[-1] |= new_threads
+        signature = map(min, itertools.izip(*[get_shingle_hashes(shingle)
+                                              for shingle in shingles]))
+        for band in xrange(bands):
+            band_hashes[band][thread_id] = hash(tuple(signature[band * rows:(band + 1) * rows]))
+        hashed[thread_id] = 1
 
-            for thread in new_threads:
-                thread_threads[thread] = join_sets[-1]
+    if log_debug:
+        log_debug("Computed MinHash signatures of {0} threads from {1} shingles.".\
+                format(sum(hashed), len(shingle_hashes)))
+
+    parent = array.array("l", xrange(len(threads)))
+    size = array.array("l", [1]) * len(threads)
+
+    def find(thread_id):
+        root = thread_id
+        while parent[root] != root:
+            root = parent[root]
+        while parent[thread_id] != root:
+            parent[thread_id], thread_id = root, parent[thread_id]
+        return root
+
+    # join threads with the first thread in their bucket of every band
+    for band in xrange(bands):
+        buckets = dict()
+        for thread_id in xrange(len(threads)):
+            if not hashed[thread_id]:
+                continue
+
+            first = buckets.setdefault(band_hashes[band][thread_id], thread_id)
+            if first == thread_id:
+                continue
+
+            root, other = find(first), find(thread_id)
+            if root != other and size[root] + size[other] <= max_cluster_size:
+                if size[root] < size[other]:
+                    root, other = other, root
+                parent[other] = root
+                size[root] += size[other]
 
-    saved_sets_ids = set()
-    saved_sets = []
-    saved_threads = set()
-    for threads in thread_threads.itervalues():
-        if id(threads) in saved_sets_ids or len(threads) < 2:
+    # collect the clusters ordered by their first thread
+    clusters = dict()
+    result = []
+    for thread_id in xrange(len(threads)):
+        root = find(thread_id)
+        if size[root] < 2:
             continue
-        saved_sets.append(list(threads))
-        saved_sets_ids.add(id(threads))
-        assert len(saved_threads & threads) == 0
-        saved_threads |= threads
+        if root not in clusters:
+            clusters[root] = []
+            result.append(clusters[root])
+        clusters[root].append(threads[thread_id])
 
-    return saved_sets
+    return result
+
+# Default number of threads in a funs cluster above which the cluster
+# is cut with single linkage from condensed distances
+DEFAULT_DENSE_LIMIT = 2000
+
+# Default size in bytes of condensed distances kept in memory, bigger
+# ones are stored in a memory-mapped temporary file
+DEFAULT_SPILL_SIZE = 256 << 20
+
+# Number of rows of the distance matrix computed by btparser at once
+DISTANCES_BLOCK_ROWS = 64
+
+def get_dense_limit():
+    return int(pyfaf.config.CONFIG.get("processing.clusterdenselimit",
+                                       DEFAULT_DENSE_LIMIT))
+
+class CondensedDistances(object):
+    '''
+    Distances between `n` objects stored as the upper triangle of the
+    distance matrix, row by row, in 32-bit floats. It takes n*(n-1)*2
+    bytes instead of n*n doubles. Stores bigger than `spill_size` bytes
+    are kept in a memory-mapped temporary file, so they are backed by
+    the page cache instead of anonymous memory.
+    '''
+
+    ITEM_SIZE = array.array("f").itemsize
+
+    def __init__(self, n, spill_size=None, tmpdir=None):
+        if spill_size is None:
+            spill_size = int(pyfaf.config.CONFIG.get("processing.distancesspillsize",
+                                                     DEFAULT_SPILL_SIZE))
+        if tmpdir is None and "storage.tmpdir" in pyfaf.config.CONFIG:
+            tmpdir = pyfaf.config.CONFIG["storage.tmpdir"]
+
+        self.n = n
+        self.length = n * (n - 1) / 2
+        size = self.length * self.ITEM_SIZE
+
+        self._file = None
+        if size > spill_size and size > 0:
+            self._file = tempfile.TemporaryFile(prefix="faf-distances-", dir=tmpdir)
+            self._file.truncate(size)
+            self._data = mmap.mmap(self._file.fileno(), size)
+        else:
+            self._data = array.array("f", [0.0]) * self.length
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def close(self):
+        if self._file is not None:
+            self._data.close()
+            self._file.close()
+            self._file = None
+        self._data = None
+
+    def _row_start(self, i):
+        # index of the distance between i and i + 1
+        return i * (2 * self.n - i - 1) / 2
+
+    def set_row(self, i, values):
+        '''
+        Store distances between object `i` and objects i + 1 ... n - 1.
+        '''
+        if len(values) != self.n - i - 1:
+            raise ValueError, "Row {0} has {1} distances, expected {2}".\
+                    format(i, len(values), self.n - i - 1)
+
+        start = self._row_start(i)
+        values = array.array("f", values)
+        if self._file is None:
+            self._data[start:start + len(values)] = values
+        else:
+            self._data[start * self.ITEM_SIZE:(start + len(values)) * self.ITEM_SIZE] = \
+                    values.tostring()
+
+    def get_row(self, i):
+        '''
+        Return array of distances between object `i`
+        and objects i + 1 ... n - 1.
+        '''
+        start = self._row_start(i)
+        end = start + self.n - i - 1
+        if self._file is None:
+            return self._data[start:end]
+
+        return array.array("f", self._data[start * self.ITEM_SIZE:end * self.ITEM_SIZE])
+
+    def get_distance(self, i, j):
+        if i == j:
+            return 0.0
+        if i > j:
+            i, j = j, i
+        index = self._row_start(i) + j - i - 1
+        if self._file is None:
+            return self._data[index]
+
+        return array.array("f", self._data[index * self.ITEM_SIZE:(index + 1) * self.ITEM_SIZE])[0]
+
+    def fill(self, threads, distance, block_rows=DISTANCES_BLOCK_ROWS):
+        '''
+        Compute `distance` between all pairs of `threads`. btparser
+        computes only `block_rows` rows of the matrix at once.
+        '''
+        if len(threads) != self.n:
+            raise ValueError, "Expected {0} threads, got {1}".format(self.n, len(threads))
+
+        for start in xrange(0, self.n - 1, block_rows):
+            rows = min(block_rows, self.n - 1 - start)
+            # distances of the first `rows` threads to all the following ones
+            block = btparser.Distances(distance, threads[start:], rows)
+            columns = self.n - start
+            for row in xrange(rows):
+                self.set_row(start + row, [block.get_distance(row, column)
+                                           for column in xrange(row + 1, columns)])
+
+    def single_linkage_cut(self, level, min_size=1):
+        '''
+        Return list of clusters of the single linkage dendrogram cut at
+        `level`, i.e. the connected components of the objects not further
+        than `level` from each other. The clusters are ascending lists of
+        indices ordered by their first object.
+        '''
+        # compare with the level rounded as the stored distances
+        level = array.array("f", [level])[0]
+        parent = array.array("l", xrange(self.n))
+
+        def find(i):
+            root = i
+            while parent[root] != root:
+                root = parent[root]
+            while parent[i] != root:
+                parent[i], i = root, parent[i]
+            return root
+
+        for i in xrange(self.n - 1):
+            row = self.get_row(i)
+            if min(row) > level:
+                continue
+
+            root = find(i)
+            for offset, value in enumerate(row):
+                if value <= level:
+                    other = find(i + 1 + offset)
+                    if other != root:
+                        # keep the smaller index as the root
+                        if other < root:
+                            root, other = other, root
+                        parent[other] = root
+
+        clusters = dict()
+        for i in xrange(self.n):
+            clusters.setdefault(find(i), []).append(i)
+
+        return [clusters[cluster_root] for cluster_root in sorted(clusters)
+                if len(clusters[cluster_root]) >= min_size]
+
+def cut_threads(threads, distance, cut_level):
+    # Return list of clusters of indices to threads. Up to the dense limit
+    # the threads are cut from a btparser dendrogram, larger sets are cut
+    # with single linkage from condensed distances.
+    if len(threads) <= get_dense_limit():
+        dendrogram = btparser.Dendrogram(btparser.Distances(distance, threads, len(threads)))
+        return [list(dups) for dups in dendrogram.cut(cut_level, 1)]
+
+    distances = CondensedDistances(len(threads))
+    try:
+        distances.fill(threads, distance)
+        return distances.single_linkage_cut(cut_level)
+    finally:
+        distances.close()
 
 def cluster_funs_clusters(funs_clusters, distance, log_debug=None):
     # Return list of dendrograms corresponding to the funs clusters.
@@ -125,6 +449,48 @@ def cluster_funs_clusters(funs_clusters, distance, log_debug=None):
 
     return dendrograms
 
+def _cut_funs_cluster(args):
+    # Process pool worker of cut_funs_clusters.
+    texts, distance, cut_level = args
+    threads = [btparser.Thread(text, True) for text in texts]
+    return cut_threads(threads, distance, cut_level)
+
+def cut_funs_clusters(funs_clusters, distance, cut_level, jobs=1, log_debug=None):
+    # Return list of clusters cut from the dendrogram of each funs
+    # cluster, the clusters are lists of indices to the funs cluster.
+    # With more jobs the funs clusters are serialized and clustered
+    # in a process pool, the largest ones first.
+    if jobs <= 1:
+        result = []
+        for (i, funs_cluster) in enumerate(funs_clusters):
+            if log_debug:
+                log_debug("Clustering funs cluster {0}/{1} (size = {2}).".\
+                        format(i + 1, len(funs_clusters), len(funs_cluster)))
+            result.append(cut_threads(funs_cluster, distance, cut_level))
+        return result
+
+    order = sorted(xrange(len(funs_clusters)),
+                   key=lambda i: len(funs_clusters[i]), reverse=True)
+    tasks = (([pyfaf.ureport.btp_thread_to_text(thread) for thread in funs_clusters[i]],
+              distance, cut_level) for i in order)
+
+    result = [None] * len(funs_clusters)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for n, (i, cut) in enumerate(itertools.izip(order, pool.imap(_cut_funs_cluster, tasks))):
+            if log_debug:
+                log_debug("Clustered funs cluster {0}/{1} (size = {2}).".\
+                        format(n + 1, len(funs_clusters), len(funs_clusters[i])))
+            result[i] = cut
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return result
+
 def get_common_components(components_lists):
     # Find the components which are in a majority of the components lists.
     components_sets = [set(l) for l in components_lists]
@@ -259,67 +625,366 @@ def remove_frequent_frames(threads, freq_frames, max_frames):
                 frames.append(frame)
         thread.frames = frames
 
-def create_problems(db, max_cluster_size=2000, distance="levenshtein",
-                    cut_level=0.3, max_fun_usage=None):
-
+def get_max_frames():
     if "processing.clusterframes" in pyfaf.config.CONFIG:
-        max_frames = int(pyfaf.config.CONFIG["processing.clusterframes"])
+        return int(pyfaf.config.CONFIG["processing.clusterframes"])
+
+    return 16
+
+def group_by_partition(items, partitions):
+    # Return list of lists of the items grouped by their keys in the
+    # partitions dict, in order of the first item of each partition.
+    # Without partitions all items are in one group.
+
+    if partitions is None:
+        return [items]
+
+    groups = dict()
+    keys = []
+    for item in items:
+        key = partitions[item]
+        if key not in groups:
+            groups[key] = []
+            keys.append(key)
+        groups[key].append(item)
+
+    return [groups[group_key] for group_key in keys]
+
+def cluster_threads(threads, thread_names, max_cluster_size, distance, cut_level,
+                    jobs=1, candidates=CANDIDATES_FUNS, lsh_bands=DEFAULT_LSH_BANDS,
+                    lsh_rows=DEFAULT_LSH_ROWS, partitions=None, timer=null_timer):
+    # Return list of sets of names of the clustered threads. The threads
+    # are compared only within candidate clusters, which are generated
+    # from common function names or from MinHash signatures. If partitions
+    # (dict mapping threads to partition keys) is given, candidate clusters
+    # are generated separately in each partition, so threads from different
+    # partitions are never clustered together. Dendrograms of all partitions
+    # are cut in one pool of jobs.
+
+    if candidates == CANDIDATES_MINHASH:
+        logging.info("Clustering by MinHash signatures ({0} bands of {1} rows, "
+                     "maximum cluster size = {2}).".format(lsh_bands, lsh_rows, max_cluster_size))
+    elif candidates == CANDIDATES_FUNS:
+        logging.info("Clustering by common function names (maximum cluster size = {0}).".format(max_cluster_size))
     else:
-        max_frames = 16
+        raise ValueError, "Unknown candidate generation method: {0}".format(candidates)
+
+    with timer.stage("candidates"):
+        funs_clusters = []
+        for partition_threads in group_by_partition(threads, partitions):
+            if candidates == CANDIDATES_MINHASH:
+                funs_clusters.extend(get_minhash_clusters(partition_threads, max_cluster_size,
+                                                          bands=lsh_bands, rows=lsh_rows,
+                                                          log_debug=logging.debug))
+            else:
+                funs_clusters.extend(get_funs_clusters(partition_threads, max_cluster_size,
+                                                       log_debug=logging.debug))
+
+    # Find threads which are not in any funs cluster (i.e. their function names are all unique).
+    unique_funs_threads = set(threads) - set().union(*funs_clusters)
+
+    # Sort threads in the funs clusters by their names to stabilize the clustering results.
+    for funs_cluster in funs_clusters:
+        funs_cluster.sort(key=lambda x: thread_names[x])
+
+    logging.info("Clustering by {0} distance.".format(distance))
+    with timer.stage("dendrograms"):
+        cuts = cut_funs_clusters(funs_clusters, distance, cut_level, jobs=jobs,
+                                 log_debug=logging.debug)
+
+    # Prepare the list of clusters.
+    clusters = []
+    for (cut, funs_cluster) in zip(cuts, funs_clusters):
+        clusters.extend([set([thread_names[funs_cluster[dup]] for dup in dups]) for dups in cut])
+
+    for thread in sorted(unique_funs_threads, key=lambda x: thread_names[x]):
+        clusters.append(set([thread_names[thread]]))
+
+    return clusters
+
+def get_component_ids(db):
+    # Return dict mapping (opsys id, component name) to component id.
+    return dict(((opsys_id, name), component_id) for component_id, opsys_id, name in
+                db.session.query(OpSysComponent.id, OpSysComponent.opsys_id,
+                                 OpSysComponent.name))
+
+def get_problem_components(db, cluster, opsys_id, component_names, component_ids):
+    # Return ordered list of ids of the components of a problem formed
+    # by the cluster of reports of the operating system opsys_id.
+    report_components = set(component_names[report_id] for report_id in cluster)
+
+    if len(report_components) > 1:
+        # Prepare a list of common components in report backtraces.
+
+        components_lists = pyfaf.ureport.get_frame_components(cluster, opsys_id, db)
+
+        # Add the report components to the lists.
+        for component_list, report_id in zip(components_lists, cluster):
+            component_list.append(component_names[report_id])
+
+        components_lists = filter_components_lists(components_lists)
+        common_components = get_common_components(components_lists)
+        ordered_components = get_ordered_components(common_components, components_lists)
+    else:
+        # With only one report component just use that component.
+        ordered_components = list(report_components)
+
+    # Drop unknown components.
+    components = [component for component in ordered_components
+                  if (opsys_id, component) in component_ids]
+
+    logging.debug("Setting problem components to: {0}.".format(components))
+
+    return [component_ids[(opsys_id, component)] for component in components]
+
+# Temporary tables used by apply_problems
+REPORT_PROBLEMS_TABLE = "tmp_reportproblems"
+CHANGED_PROBLEMS_TABLE = "tmp_changedproblems"
+
+# Number of rows inserted by a single statement
+INSERT_CHUNK_SIZE = 1000
+
+def apply_problems(db, assignments):
+    # Store results of clustering in bulk. Assignments are tuples of
+    # a problem (new ones are not flushed yet), set of ids of its
+    # reports, ordered list of its component ids (None to keep the
+    # problem as it is) and the representative report id with its
+    # thread (None to keep the stored one).
+    #
+    # Reports are moved to their problems and occurrences of the changed
+    # problems are recomputed by a few statements over temporary tables,
+    # only differing problem components are rewritten and problems left
+    # without reports are removed, all in one transaction (a nested one
+    # when the session is not in autocommit mode).
+
+    db.session.begin(subtransactions=True)
+    try:
+        db.session.flush()
+
+        db.session.execute("CREATE TEMPORARY TABLE {0} (report_id INTEGER PRIMARY KEY, "
+                           "problem_id INTEGER NOT NULL)".format(REPORT_PROBLEMS_TABLE))
+        db.session.execute("CREATE TEMPORARY TABLE {0} (problem_id INTEGER PRIMARY KEY)"
+                           .format(CHANGED_PROBLEMS_TABLE))
+
+        report_problems = dict()
+        for problem, report_ids, component_ids, representative in assignments:
+            if component_ids is not None:
+                for report_id in report_ids:
+                    report_problems[report_id] = problem.id
+
+        report_rows = [{"report_id": report_id, "problem_id": problem_id}
+                       for report_id, problem_id in report_problems.items()]
+        for rows in pyfaf.ureport.chunks(report_rows, INSERT_CHUNK_SIZE):
+            db.session.execute("INSERT INTO {0} (report_id, problem_id) "
+                               "VALUES (:report_id, :problem_id)".format(REPORT_PROBLEMS_TABLE),
+                               rows)
+
+        # Problems the moved reports leave need new occurrences as well.
+        changed_problem_ids = set(report_problems.values())
+        for (problem_id,) in db.session.execute(
+                "SELECT DISTINCT r.problem_id FROM {0} r "
+                "JOIN {1} t ON t.report_id = r.id "
+                "WHERE r.problem_id IS NOT NULL AND r.problem_id <> t.problem_id"
+                .format(Report.__tablename__, REPORT_PROBLEMS_TABLE)):
+            changed_problem_ids.add(problem_id)
+
+        problem_rows = [{"problem_id": problem_id} for problem_id in changed_problem_ids]
+        for rows in pyfaf.ureport.chunks(problem_rows, INSERT_CHUNK_SIZE):
+            db.session.execute("INSERT INTO {0} (problem_id) VALUES (:problem_id)"
+                               .format(CHANGED_PROBLEMS_TABLE), rows)
+
+        logging.info("Moving reports, {0} problems changed.".format(len(problem_rows)))
+        move_reports(db)
+
+        db.session.execute("UPDATE {0} SET "
+                           "first_occurence = (SELECT MIN(r.first_occurence) FROM {1} r "
+                           "                   WHERE r.problem_id = {0}.id), "
+                           "last_occurence = (SELECT MAX(r.last_occurence) FROM {1} r "
+                           "                  WHERE r.problem_id = {0}.id) "
+                           "WHERE id IN (SELECT problem_id FROM {2})"
+                           .format(Problem.__tablename__, Report.__tablename__,
+                                   CHANGED_PROBLEMS_TABLE))
+
+        # Rewrite only the differing problem components.
+        new_components = dict((problem.id, component_ids)
+                              for problem, report_ids, component_ids, representative in assignments
+                              if component_ids is not None)
+        old_components = dict()
+        for problem_ids in pyfaf.ureport.chunks(new_components.keys()):
+            for problem_id, component_id, order in \
+                    db.session.query(ProblemComponent.problem_id, ProblemComponent.component_id,
+                                     ProblemComponent.order).\
+                    filter(ProblemComponent.problem_id.in_(problem_ids)).\
+                    order_by(ProblemComponent.order):
+                old_components.setdefault(problem_id, []).append(component_id)
+
+        table = ProblemComponent.__table__
+        deleted = []
+        inserted = []
+        for problem_id, component_ids in new_components.items():
+            old = old_components.get(problem_id, [])
+            if old == component_ids:
+                continue
+
+            deleted.append(problem_id)
+            inserted.extend({"problem_id": problem_id, "component_id": component_id, "order": order}
+                            for order, component_id in enumerate(component_ids))
+
+        for problem_ids in pyfaf.ureport.chunks(deleted):
+            db.session.execute(table.delete().where(table.c.problem_id.in_(problem_ids)))
+        for rows in pyfaf.ureport.chunks(inserted, INSERT_CHUNK_SIZE):
+            db.session.execute(table.insert(), rows)
+
+        logging.info("Updated components of {0} problems.".format(len(deleted)))
+
+        # Store the representative threads.
+        representatives = dict((problem.id, representative)
+                               for problem, report_ids, component_ids, representative in assignments
+                               if representative is not None)
+        problemthreads = dict()
+        for problem_ids in pyfaf.ureport.chunks(representatives.keys()):
+            for problemthread in db.session.query(ProblemThread).\
+                    filter(ProblemThread.problem_id.in_(problem_ids)):
+                problemthreads[problemthread.problem_id] = problemthread
+
+        for problem_id, (report_id, thread) in representatives.items():
+            if problem_id not in problemthreads:
+                problemthreads[problem_id] = ProblemThread()
+                problemthreads[problem_id].problem_id = problem_id
+                db.session.add(problemthreads[problem_id])
+
+            problemthreads[problem_id].report_id = report_id
+            problemthreads[problem_id].thread = pyfaf.ureport.btp_thread_to_text(thread)
+
+        db.session.flush()
+
+        remove_unreferenced_problems(db)
+
+        db.session.execute("DROP TABLE {0}".format(REPORT_PROBLEMS_TABLE))
+        db.session.execute("DROP TABLE {0}".format(CHANGED_PROBLEMS_TABLE))
+        db.session.commit()
+    except:
+        db.session.rollback()
+        raise
+
+    # The rows were changed behind the loaded objects.
+    db.session.expire_all()
+
+def move_reports(db):
+    # Set problems of reports to the ones in the report problems table.
+    # MySQL can not refer to a temporary table twice in one statement.
+    dialect = db.session.bind.dialect.name
+    if dialect == "mysql":
+        db.session.execute("UPDATE {0} r JOIN {1} t ON t.report_id = r.id "
+                           "SET r.problem_id = t.problem_id "
+                           "WHERE r.problem_id IS NULL OR r.problem_id <> t.problem_id"
+                           .format(Report.__tablename__, REPORT_PROBLEMS_TABLE))
+    elif dialect == "postgresql":
+        db.session.execute("UPDATE {0} SET problem_id = t.problem_id FROM {1} t "
+                           "WHERE t.report_id = {0}.id AND "
+                           "      ({0}.problem_id IS NULL OR {0}.problem_id <> t.problem_id)"
+                           .format(Report.__tablename__, REPORT_PROBLEMS_TABLE))
+    else:
+        db.session.execute("UPDATE {0} SET problem_id = "
+                           "(SELECT t.problem_id FROM {1} t WHERE t.report_id = {0}.id) "
+                           "WHERE EXISTS (SELECT 1 FROM {1} t WHERE t.report_id = {0}.id AND "
+                           "              ({0}.problem_id IS NULL OR "
+                           "               {0}.problem_id <> t.problem_id))"
+                           .format(Report.__tablename__, REPORT_PROBLEMS_TABLE))
+
+def remove_unreferenced_problems(db):
+    # Remove problems which are not referenced by any report.
+    logging.info("Removing unreferenced problems.")
+    used_problem_ids = db.session.query(Report.problem_id).\
+            filter(Report.problem_id != None)
+    old_problem_ids = db.session.query(Problem.id).\
+            filter(func.not_(Problem.id.in_(used_problem_ids)))
+    db.session.query(ProblemComponent).\
+            filter(ProblemComponent.problem_id.in_(old_problem_ids)).\
+            delete(synchronize_session=False)
+    db.session.query(ProblemThread).\
+            filter(ProblemThread.problem_id.in_(old_problem_ids)).\
+            delete(synchronize_session=False)
+    old_problem_ids.delete(synchronize_session=False)
+
+def filter_partitions(query, opsys=None, report_type=None):
+    # Restrict a query joined with OpSysComponent to reports
+    # of the operating system (name) and report type.
+
+    if opsys is not None:
+        query = query.join(OpSys).filter(OpSys.name == opsys)
+    if report_type is not None:
+        query = query.filter(Report.type == report_type)
+
+    return query
+
+def create_problems(db, max_cluster_size=2000, distance="levenshtein",
+                    cut_level=0.3, max_fun_usage=None, jobs=1,
+                    candidates=CANDIDATES_FUNS, lsh_bands=DEFAULT_LSH_BANDS,
+                    lsh_rows=DEFAULT_LSH_ROWS, opsys=None, report_type=None,
+                    timer=null_timer):
+    # Recluster all reports and create new or modify old problems.
+    # Reports are clustered in independent partitions by their operating
+    # system and type. If opsys (name) or report_type is given, only the
+    # matching partitions are reclustered and other reports keep their
+    # problems. Stages of the clustering are measured by the timer.
+
+    max_frames = get_max_frames()
 
     current_problems = dict()
     current_report_problems = dict()
     report_ids = []
-    opsys_ids = dict()
     component_names = dict()
-
-    for report_id, problem_id, opsys_id, component_name in \
-            db.session.query(Report.id, Report.problem_id, OpSysComponent.opsys_id, OpSysComponent.name).\
-            join(OpSysComponent).order_by(Report.id).all():
-        if problem_id not in current_problems:
-            current_problems[problem_id] = set()
-        current_problems[problem_id].add(report_id)
-        current_report_problems[report_id] = problem_id
-        report_ids.append(report_id)
-        opsys_ids[report_id] = opsys_id
-        component_names[report_id] = component_name
-
-    report_threads = pyfaf.ureport.get_report_btp_threads(report_ids, db,
-            max_frames=4 * max_frames if max_fun_usage else max_frames, log_debug=logging.debug)
+    report_partitions = dict()
+
+    with timer.stage("load threads"):
+        for report_id, problem_id in db.session.query(Report.id, Report.problem_id):
+            if problem_id not in current_problems:
+                current_problems[problem_id] = set()
+            current_problems[problem_id].add(report_id)
+            current_report_problems[report_id] = problem_id
+
+        query = db.session.query(Report.id, Report.type, OpSysComponent.opsys_id, OpSysComponent.name).\
+                join(OpSysComponent)
+        query = filter_partitions(query, opsys, report_type)
+        for report_id, type, opsys_id, component_name in query.order_by(Report.id).all():
+            report_ids.append(report_id)
+            component_names[report_id] = component_name
+            report_partitions[report_id] = (opsys_id, type)
+
+        report_threads = pyfaf.ureport.get_report_btp_threads(report_ids, db,
+                max_frames=4 * max_frames if max_fun_usage else max_frames, log_debug=logging.debug)
 
     thread_names = dict()
+    report_thread = dict()
+    partitions = dict()
     threads = []
     for report_id, thread in report_threads:
         threads.append(thread)
         thread_names[thread] = report_id
+        report_thread[report_id] = thread
+        partitions[thread] = report_partitions[report_id]
+
+    logging.info("Clustering {0} reports in {1} partitions.".format(len(threads),
+                 len(set(partitions.values()))))
 
     if max_fun_usage:
         logging.info("Removing too frequent functions from threads.")
-        freq_frames = pyfaf.cluster.get_frequent_frames(threads, max_fun_usage)
-        pyfaf.cluster.remove_frequent_frames(threads, freq_frames, max_frames)
-
-    logging.info("Clustering by common function names (maximum cluster size = {0}).".format(max_cluster_size))
-    funs_clusters = pyfaf.cluster.get_funs_clusters(threads, max_cluster_size, log_debug=logging.debug)
-
-    # Find threads which are not in any funs cluster (i.e. their function names are all unique).
-    unique_funs_threads = set(threads) - set().union(*funs_clusters)
-
-    # Sort threads in the funs clusters by report id to stabilize the clustering results.
-    for funs_cluster in funs_clusters:
-        funs_cluster.sort(key=lambda x: thread_names[x])
-
-    logging.info("Clustering by {0} distance.".format(distance))
-    dendrograms = pyfaf.cluster.cluster_funs_clusters(funs_clusters, distance, log_debug=logging.debug)
+        with timer.stage("frequent frames"):
+            for partition_threads in group_by_partition(threads, partitions):
+                freq_frames = get_frequent_frames(partition_threads, max_fun_usage)
+                remove_frequent_frames(partition_threads, freq_frames, max_frames)
 
-    # Prepare the list of clusters.
-    clusters = []
-    for (dendrogram, funs_cluster) in zip(dendrograms, funs_clusters):
-        clusters.extend([set([thread_names[funs_cluster[dup]] for dup in dups]) for dups in dendrogram.cut(cut_level, 1)])
+    clusters = cluster_threads(threads, thread_names, max_cluster_size,
+                               distance, cut_level, jobs=jobs, candidates=candidates,
+                               lsh_bands=lsh_bands, lsh_rows=lsh_rows,
+                               partitions=partitions, timer=timer)
 
-    for thread in unique_funs_threads:
-        clusters.append(set([thread_names[thread]]))
+    component_ids = get_component_ids(db)
+    stored_problems = dict((problem.id, problem) for problem in db.session.query(Problem))
 
     # Create new or modify old problems.
+    assignments = []
     for i, cluster in enumerate(clusters):
         # Find currently stored problems which contain reports from the new cluster.
         problem_ids = set()
@@ -339,94 +1004,222 @@ def create_problems(db, max_cluster_size=2000, distance="levenshtein",
                     len(current_problems[problem_id]) / 2:
                 reuse_problem = True
 
+        representative = (min(cluster), report_thread[min(cluster)])
+
         if reuse_problem:
+            problem = stored_problems[problem_id]
+
             # If the reports from the problem are equal to the cluster, there is nothing to do.
             if current_problems[problem_id] == cluster:
                 logging.debug("[ {0} / {1} ] Skipping existing problem #{2} with reports: {3}.".\
                         format(i + 1, len(clusters), problem_id, sorted(list(cluster))))
+                assignments.append((problem, cluster, None, representative))
                 continue
 
-            # Otherwise fetch the problem which will be modified.
-            problem = db.session.query(Problem).filter(Problem.id == problem_id).one()
-
             logging.debug("[ {0} / {1} ] Reusing existing problem #{2} with reports: {3} for reports: {4}.".\
                     format(i + 1, len(clusters), problem_id, sorted(list(current_problems[problem_id])),
                         sorted(list(cluster))))
         else:
             # Create a new problem.
             problem = Problem()
-            db.session.add(problem)
 
             logging.debug("[ {0} / {1} ] Creating new problem for reports: {2}.".\
                     format(i + 1, len(clusters), sorted(list(cluster))))
 
-        # For now, only one OpSys per cluster is supported.
-        report_opsys_ids = set([opsys_ids[report_id] for report_id in cluster])
-        if(len(report_opsys_ids) > 1):
-            logging.warning('Only one OpSys per cluster is supported, skipping')
+        # Clusters never span several partitions.
+        opsys_id, _ = report_partitions[min(cluster)]
+        with timer.stage("components"):
+            components = get_problem_components(db, cluster, opsys_id, component_names,
+                                                component_ids)
+
+        if problem.id is None:
+            db.session.add(problem)
+        assignments.append((problem, cluster, components, representative))
+
+    with timer.stage("write-back"):
+        apply_problems(db, assignments)
+
+        # All reports are clustered with their current backtraces now.
+        if opsys is None and report_type is None:
+            db.session.query(ReportChanged).delete(synchronize_session=False)
+        else:
+            for report_ids_chunk in pyfaf.ureport.chunks(report_ids):
+                db.session.query(ReportChanged).\
+                        filter(ReportChanged.report_id.in_(report_ids_chunk)).\
+                        delete(synchronize_session=False)
+
+def create_problems_incremental(db, max_cluster_size=2000, distance="levenshtein",
+                                cut_level=0.3, max_fun_usage=None, jobs=1,
+                                candidates=CANDIDATES_FUNS, lsh_bands=DEFAULT_LSH_BANDS,
+                                lsh_rows=DEFAULT_LSH_ROWS, opsys=None, report_type=None):
+    # Cluster only reports without a problem and reports whose backtraces
+    # changed since they were clustered. They are compared with the
+    # representative threads of the stored problems in the same partition
+    # (operating system and report type) and assigned to them or to new
+    # problems. Problems are never merged or split, that is left to
+    # create_problems. If opsys (name) or report_type is given, only
+    # the matching partitions are clustered.
+
+    max_frames = get_max_frames()
+
+    opsys_ids = dict()
+    component_names = dict()
+    report_partitions = dict()
+    report_ids = []
+    query = db.session.query(Report.id, Report.type, OpSysComponent.opsys_id, OpSysComponent.name).\
+            join(OpSysComponent).\
+            filter((Report.problem_id == None) | \
+                   (Report.id.in_(db.session.query(ReportChanged.report_id))))
+    query = filter_partitions(query, opsys, report_type)
+    for report_id, type, opsys_id, component_name in query.order_by(Report.id).all():
+        report_ids.append(report_id)
+        opsys_ids[report_id] = opsys_id
+        component_names[report_id] = component_name
+        report_partitions[report_id] = (opsys_id, type)
+
+    changed_report_ids = set(report_id for (report_id,) in
+                             db.session.query(ReportChanged.report_id)) & set(report_ids)
+
+    logging.info("Clustering {0} new or changed reports.".format(len(report_ids)))
+    if not report_ids:
+        return
+
+    report_threads = pyfaf.ureport.get_report_btp_threads(report_ids, db,
+            max_frames=4 * max_frames if max_fun_usage else max_frames, log_debug=logging.debug)
+
+    # Names of the threads are report ids and negative problem ids.
+    thread_names = dict()
+    report_thread = dict()
+    partitions = dict()
+    threads = []
+    for report_id, thread in report_threads:
+        threads.append(thread)
+        thread_names[thread] = report_id
+        report_thread[report_id] = thread
+        partitions[thread] = report_partitions[report_id]
+
+    if max_fun_usage:
+        logging.info("Removing too frequent functions from threads.")
+        for partition_threads in group_by_partition(threads, partitions):
+            freq_frames = get_frequent_frames(partition_threads, max_fun_usage)
+            remove_frequent_frames(partition_threads, freq_frames, max_frames)
+
+    # Load the representative threads of problems in the same partitions.
+    used_partitions = set(report_partitions.values())
+    problem_threads = dict()
+    for problem_id, report_id, text, type, opsys_id in \
+            db.session.query(ProblemThread.problem_id, ProblemThread.report_id,
+                             ProblemThread.thread, Report.type, OpSysComponent.opsys_id).\
+            join(Report, Report.id == ProblemThread.report_id).\
+            join(OpSysComponent).\
+            filter(OpSysComponent.opsys_id.in_(set(opsys_ids.values()))).all():
+        if (opsys_id, type) not in used_partitions:
             continue
 
-        opsys_id = list(report_opsys_ids)[0]
+        if report_id in report_thread:
+            # The representative report changed, use its new thread.
+            text = pyfaf.ureport.btp_thread_to_text(report_thread[report_id])
+
+        thread = btparser.Thread(text, True)
 
-        report_components = set([component_names[report_id] for report_id in cluster])
+        problem_threads[problem_id] = thread
+        threads.append(thread)
+        thread_names[thread] = -problem_id
+        partitions[thread] = (opsys_id, type)
 
-        if len(report_components) > 1:
-            # Prepare a list of common components in report backtraces.
+    logging.info("Comparing with {0} existing problems.".format(len(problem_threads)))
 
-            components_lists = pyfaf.ureport.get_frame_components(cluster, opsys_id, db)
+    clusters = cluster_threads(threads, thread_names, max_cluster_size,
+                               distance, cut_level, jobs=jobs, candidates=candidates,
+                               lsh_bands=lsh_bands, lsh_rows=lsh_rows,
+                               partitions=partitions)
 
-            # Add the report components to the lists.
-            for component_list, report_id in zip(components_lists, cluster):
-                component_list.append(component_names[report_id])
+    component_ids = get_component_ids(db)
 
-            components_lists = pyfaf.cluster.filter_components_lists(components_lists)
-            common_components = pyfaf.cluster.get_common_components(components_lists)
-            ordered_components = pyfaf.cluster.get_ordered_components(common_components, components_lists)
+    # Problems to store in order of their first cluster, their reports
+    # and operating systems.
+    problems = []
+    problem_reports = dict()
+    problem_opsys_ids = dict()
+    for i, cluster in enumerate(clusters):
+        new_reports = set(name for name in cluster if name > 0)
+        if not new_reports:
+            continue
+
+        # Clusters never span several partitions.
+        cluster_problems = [-name for name in cluster if name < 0]
+        if cluster_problems:
+            # Attach the reports to the biggest similar problem.
+            problem = max(db.session.query(Problem).filter(Problem.id.in_(cluster_problems)).all(),
+                          key=lambda problem: len(problem.reports))
+
+            logging.debug("[ {0} / {1} ] Adding reports: {2} to problem #{3}.".\
+                    format(i + 1, len(clusters), sorted(list(new_reports)), problem.id))
+
+            if problem not in problem_reports:
+                problems.append(problem)
+                problem_reports[problem] = set()
+                for report_id, component_name in \
+                        db.session.query(Report.id, OpSysComponent.name).\
+                        join(OpSysComponent).filter(Report.problem_id == problem.id):
+                    component_names[report_id] = component_name
+                    problem_reports[problem].add(report_id)
         else:
-            # With only one report component just use that component.
-            ordered_components = list(report_components)
-
-        # Drop unknown components.
-        components = [component for component in ordered_components if component != None]
-
-        logging.debug("Setting problem components to: {0}.".format(components))
-
-        if len(components) > 0:
-            # Fetch the components from db and sort them as in ordered_components.
-            components = db.session.query(OpSysComponent).\
-                    filter((OpSysComponent.name.in_(components)) & \
-                        (OpSys.id == opsys_id)).all()
-            components.sort(key=lambda c: ordered_components.index(c.name))
-
-        # Set problem for all reports in the cluster and update it.
-        for report in db.session.query(Report).filter(Report.id.in_(cluster)).all():
-            report.problem = problem
-
-            if not problem.first_occurence or problem.first_occurence > report.first_occurence:
-                problem.first_occurence = report.first_occurence
-            if not problem.last_occurence or problem.last_occurence < report.last_occurence:
-                problem.last_occurence = report.last_occurence
-
-        # Update the problem component list.
-        db.session.query(ProblemComponent).filter(ProblemComponent.problem == problem).delete()
-        for j, component in enumerate(components):
-            problemcomponent = ProblemComponent()
-            problemcomponent.problem = problem
-            problemcomponent.component = component
-            problemcomponent.order = j
-            db.session.add(problemcomponent)
-
-        if len(db.session.new) + len(db.session.dirty) > 100:
-            db.session.flush()
+            problem = Problem()
+            problems.append(problem)
+            problem_reports[problem] = set()
+
+            logging.debug("[ {0} / {1} ] Creating new problem for reports: {2}.".\
+                    format(i + 1, len(clusters), sorted(list(new_reports))))
+
+        problem_reports[problem] |= new_reports
+        opsys_id, _ = report_partitions[min(new_reports)]
+        problem_opsys_ids.setdefault(problem, opsys_id)
+
+    assignments = []
+    for problem in problems:
+        report_ids = problem_reports[problem]
+        components = get_problem_components(db, report_ids, problem_opsys_ids[problem],
+                                            component_names, component_ids)
+
+        representative = None
+        if problem.id not in problem_threads and min(report_ids) in report_thread:
+            representative = (min(report_ids), report_thread[min(report_ids)])
+
+        if problem.id is None:
+            db.session.add(problem)
+        assignments.append((problem, report_ids, components, representative))
+
+    apply_problems(db, assignments)
+
+    # Store the new threads of changed representative reports.
+    for report_ids_chunk in pyfaf.ureport.chunks(changed_report_ids):
+        for problemthread in db.session.query(ProblemThread).\
+                filter(ProblemThread.report_id.in_(report_ids_chunk)):
+            if problemthread.report_id in report_thread:
+                problemthread.thread = pyfaf.ureport.btp_thread_to_text(report_thread[problemthread.report_id])
 
     db.session.flush()
 
-    # Remove problems which are not referenced by any report.
-    logging.info("Removing unreferenced problems.")
-    used_problem_ids = db.session.query(Report.problem_id)
-    old_problem_ids = db.session.query(Problem.id).\
-            filter(func.not_(Problem.id.in_(used_problem_ids)))
-    old_problem_components = db.session.query(ProblemComponent).\
-            filter(ProblemComponent.problem_id.in_(old_problem_ids))
-    old_problem_components.delete(synchronize_session=False)
-    old_problem_ids.delete(synchronize_session=False)
+    # Problems whose representative report was moved to another
+    # problem get a new representative.
+    for problemthread in db.session.query(ProblemThread).\
+            join(Report, Report.id == ProblemThread.report_id).\
+            filter(Report.problem_id != ProblemThread.problem_id).all():
+        report_id = db.session.query(func.min(Report.id)).\
+                filter(Report.problem_id == problemthread.problem_id).scalar()
+        if report_id is None:
+            continue
+
+        for report_id, thread in pyfaf.ureport.get_report_btp_threads([report_id], db,
+                                                                      max_frames=max_frames):
+            problemthread.report_id = report_id
+            problemthread.thread = pyfaf.ureport.btp_thread_to_text(thread)
+
+    for report_ids_chunk in pyfaf.ureport.chunks(changed_report_ids):
+        db.session.query(ReportChanged).\
+                filter(ReportChanged.report_id.in_(report_ids_chunk)).\
+                delete(synchronize_session=False)
+    db.session.flush()
+
+    remove_unreferenced_problems(db)
@@ -1,16 +1,30 @@
 import os
 import re
+import atexit
 import rpm
 import sys
 import time
 import logging
 import datetime
+import threading
 import traceback
 import subprocess
+import collections
 
 from rpmUtils import miscutils as rpmutils
 
-from pyfaf.storage.opsys import PackageDependency
+from pyfaf.storage.opsys import (Build,
+                                 OpSysComponent,
+                                 Package,
+                                 PackageBuildId,
+                                 PackageDependency,
+                                 PathComponent)
+
+# Maximum number of values in a single IN clause
+PATH_CHUNK_SIZE = 500
+
+# Directory with symbolic links named by build ids in debuginfo packages
+BUILD_ID_DIR = "/usr/lib/debug/.build-id/"
 
 def get_libname(path):
     libname = os.path.basename(path)
@@ -28,6 +42,10 @@ def store_package_deps(db, package_obj):
     files = header.fiFromHeader()
     logging.debug("{0} contains {1} files".format(package_obj.nvra(),
         len(files)))
+    paths = []
+    links = dict((path, target) for path, target in
+                 zip(header[rpm.RPMTAG_FILENAMES], header[rpm.RPMTAG_FILELINKTOS])
+                 if target)
     for f in files:
         new = PackageDependency()
         new.package_id = pkg_id
@@ -35,6 +53,7 @@ def store_package_deps(db, package_obj):
         new.name = f[0]
         new.flags = 0
         db.session.add(new)
+        paths.append(f[0])
 
     provides = header.dsFromHeader('providename')
     for p in provides:
@@ -75,6 +94,171 @@ def store_package_deps(db, package_obj):
     rpm_file.close()
     db.session.flush()
 
+    component = package_obj.build.component
+    store_path_components(db, component.opsys_id, component.id, paths)
+    store_build_ids(db, package_obj, paths, links)
+
+def get_debug_file(build_id):
+    '''
+    Return path of the debug file of the build id in debuginfo packages.
+    '''
+    return "{0}{1}/{2}.debug".format(BUILD_ID_DIR, build_id[:2], build_id[2:])
+
+def get_build_id_links(links):
+    '''
+    Return dict mapping build ids to tuples of the path of the debug
+    file and the path of the binary (or None) from the .build-id
+    symbolic `links` (dict of paths and link targets) of a debuginfo
+    package.
+    '''
+    debug_files = {}
+    binaries = {}
+    for path, target in links.items():
+        if not path.startswith(BUILD_ID_DIR):
+            continue
+
+        name = path[len(BUILD_ID_DIR):]
+        if name.count("/") != 1:
+            continue
+
+        build_id = name.replace("/", "")
+        if build_id.endswith(".debug"):
+            debug_files[build_id[:-len(".debug")]] = path
+        else:
+            binaries[build_id] = os.path.normpath(
+                    os.path.join(os.path.dirname(path), target))
+
+    return dict((build_id, (debug_file, binaries.get(build_id)))
+                for build_id, debug_file in debug_files.items())
+
+def store_build_ids(db, package_obj, paths, links):
+    '''
+    Store build ids of the debug files of a debuginfo package with
+    the binary packages of the same build providing the binaries.
+    For other packages, assign the package to the stored build ids
+    of the binaries it provides.
+    '''
+    build_ids = get_build_id_links(links)
+    if not build_ids:
+        paths = set(paths)
+        for package_build_id in db.session.query(PackageBuildId).\
+                join(Package, Package.id == PackageBuildId.debuginfo_id).\
+                filter((Package.build_id == package_obj.build_id) &
+                       (Package.arch_id == package_obj.arch_id) &
+                       (PackageBuildId.package_id == None) &
+                       (PackageBuildId.path != None)):
+            if package_build_id.path in paths:
+                package_build_id.package_id = package_obj.id
+
+        db.session.flush()
+        return
+
+    binary_paths = sorted(set(path for _, path in build_ids.values() if path))
+    binaries = {}
+    for i in xrange(0, len(binary_paths), PATH_CHUNK_SIZE):
+        chunk = binary_paths[i:i + PATH_CHUNK_SIZE]
+        for package_id, path in db.session.query(Package.id, PackageDependency.name).\
+                join(PackageDependency).\
+                filter((Package.build_id == package_obj.build_id) &
+                       (Package.arch_id == package_obj.arch_id) &
+                       (Package.id != package_obj.id) &
+                       (PackageDependency.type == "PROVIDES") &
+                       (PackageDependency.name.in_(chunk))):
+            binaries.setdefault(path, package_id)
+
+    for build_id, (debug_file, path) in build_ids.items():
+        new = PackageBuildId()
+        new.build_id = build_id
+        new.debuginfo_id = package_obj.id
+        new.debug_path = debug_file
+        new.path = path
+        new.package_id = binaries.get(path)
+        db.session.add(new)
+
+    db.session.flush()
+
+def rebuild_build_ids(db):
+    '''
+    Fill the build id table from the file dependencies of stored
+    debuginfo packages which have no build ids stored. Link targets
+    are not stored in the dependencies, so binaries are not known.
+    '''
+    stored = set(debuginfo_id for (debuginfo_id,) in
+                 db.session.query(PackageBuildId.debuginfo_id).distinct())
+
+    count = 0
+    for package_id, path in db.session.query(PackageDependency.package_id,
+                                             PackageDependency.name).\
+            filter((PackageDependency.type == "PROVIDES") &
+                   (PackageDependency.name.like("{0}%.debug".format(BUILD_ID_DIR)))).\
+            order_by(PackageDependency.package_id).yield_per(PATH_CHUNK_SIZE):
+        if package_id in stored:
+            continue
+
+        name = path[len(BUILD_ID_DIR):]
+        if name.count("/") != 1:
+            continue
+
+        new = PackageBuildId()
+        new.build_id = name.replace("/", "")[:-len(".debug")]
+        new.debuginfo_id = package_id
+        new.debug_path = path
+        db.session.add(new)
+
+        count += 1
+        if count % PATH_CHUNK_SIZE == 0:
+            db.session.flush()
+
+    db.session.flush()
+
+def store_path_components(db, opsys_id, component_id, paths):
+    '''
+    Map file `paths` to the component in the path to component
+    map of the operating system, mapped paths are kept. Relative
+    paths (files of source RPMs) are skipped.
+    '''
+    paths = sorted(set(path for path in paths if path.startswith("/")))
+    for i in xrange(0, len(paths), PATH_CHUNK_SIZE):
+        chunk = paths[i:i + PATH_CHUNK_SIZE]
+        mapped = set(path for (path,) in db.session.query(PathComponent.path).\
+                filter((PathComponent.opsys_id == opsys_id) &
+                       (PathComponent.path.in_(chunk))))
+
+        for path in chunk:
+            if path not in mapped:
+                new = PathComponent()
+                new.opsys_id = opsys_id
+                new.path = path
+                new.component_id = component_id
+                db.session.add(new)
+
+    db.session.flush()
+
+def rebuild_path_components(db, opsys_id):
+    '''
+    Fill the path to component map of the operating system
+    from the file dependencies of all stored packages.
+    '''
+    db.session.query(PathComponent).\
+            filter(PathComponent.opsys_id == opsys_id).\
+            delete(synchronize_session=False)
+
+    db.session.execute("INSERT INTO {0} (opsys_id, path, component_id) "
+                       "SELECT c.opsys_id, d.name, MIN(c.id) FROM {1} d "
+                       "JOIN {2} p ON p.id = d.package_id "
+                       "JOIN {3} b ON b.id = p.build_id "
+                       "JOIN {4} c ON c.id = b.component_id "
+                       "WHERE c.opsys_id = :opsys_id AND d.type = 'PROVIDES' AND "
+                       "      d.name LIKE '/%' "
+                       "GROUP BY c.opsys_id, d.name" \
+                       .format(PathComponent.__tablename__,
+                               PackageDependency.__tablename__,
+                               Package.__tablename__,
+                               Build.__tablename__,
+                               OpSysComponent.__tablename__),
+                       {"opsys_id": opsys_id})
+    db.session.flush()
+
 userspace = re.compile('SIG[^)]+')
 
 def format_reason(rtype, reason, function_name):
@@ -103,17 +287,200 @@ def format_reason(rtype, reason, function_name):
 
     return 'Crash'
 
+class LRUCache(object):
+    '''
+    Bounded mapping that forgets the least recently used
+    items when it grows over `size`. Safe to share between threads.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+class CppDemangler(object):
+    '''
+    Demangles C++ symbol names using a few long-running
+    c++filt coprocesses that read names from stdin and write
+    one demangled name per line to stdout. Results are kept
+    in a bounded LRU cache.
+    '''
+
+    # c++filt splits its input on anything else
+    valid_name = re.compile(r'^[A-Za-z0-9_$.]+$')
+
+    def __init__(self, processes=2, cache_size=100000, chunk_bytes=8192):
+        self.processes = processes
+        self.chunk_bytes = chunk_bytes
+        self.cache = LRUCache(cache_size)
+        self._procs = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        while len(self._procs) < self.processes:
+            proc = subprocess.Popen(["c++filt"], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, close_fds=True)
+            self._procs.append(proc)
+
+    def close(self):
+        '''
+        Terminates the coprocesses.
+        '''
+
+        with self._lock:
+            for proc in self._procs:
+                try:
+                    proc.stdin.close()
+                    proc.wait()
+                except (IOError, OSError):
+                    pass
+            self._procs = []
+
+    def _chunks(self, names):
+        '''
+        Splits `names` into chunks small enough not to fill
+        the pipes in either direction before they are read.
+        '''
+
+        chunk = []
+        size = 0
+        for name in names:
+            if chunk and size + len(name) + 1 > self.chunk_bytes:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(name)
+            size += len(name) + 1
+
+        if chunk:
+            yield chunk
+
+    def _run(self, names):
+        '''
+        Sends `names` to the coprocesses, spreading the chunks
+        among them, and returns a dict with the results.
+        '''
+
+        self._start()
+        result = {}
+        chunks = list(self._chunks(names))
+        while chunks:
+            running = []
+            for proc in self._procs:
+                if not chunks:
+                    break
+                chunk = chunks.pop(0)
+                proc.stdin.write("".join("{0}\n".format(n) for n in chunk))
+                proc.stdin.flush()
+                running.append((proc, chunk))
+
+            for proc, chunk in running:
+                for name in chunk:
+                    line = proc.stdout.readline()
+                    if not line:
+                        raise IOError("c++filt exited unexpectedly")
+                    result[name] = line.strip()
+
+        return result
+
+    def demangle_many(self, names):
+        '''
+        Returns a list of demangled `names`. Items that can not
+        be demangled are None.
+        '''
+
+        result = {}
+        missing = []
+        with self._lock:
+            for name in names:
+                if name in result:
+                    continue
+
+                demangled = self.cache.get(name)
+                if demangled is not None:
+                    result[name] = demangled
+                elif not self.valid_name.match(name):
+                    # c++filt does not demangle these as a whole
+                    result[name] = name
+                else:
+                    result[name] = None
+                    missing.append(name)
+
+            if missing:
+                try:
+                    demangled = self._run(missing)
+                except (IOError, OSError) as ex:
+                    logging.error("c++filt failed: {0}".format(str(ex)))
+                    for proc in self._procs:
+                        proc.kill()
+                    self._procs = []
+                    demangled = {}
+
+                for name, value in demangled.items():
+                    self.cache.set(name, value)
+                    result[name] = value
+
+        return [result[name] for name in names]
+
+    def demangle(self, mangled):
+        return self.demangle_many([mangled])[0]
+
+_demangler = None
+
+def get_demangler():
+    '''
+    Returns the process-wide `CppDemangler` instance.
+    '''
+
+    global _demangler
+    if _demangler is None:
+        _demangler = CppDemangler()
+        atexit.register(_demangler.close)
+
+    return _demangler
+
 def cpp_demangle(mangled):
-    cmd = ["c++filt", mangled]
-    demangle_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = demangle_proc.communicate()
-    if demangle_proc.returncode != 0:
-        logging.error('c++filt failed.'
-            ' command {0} \n stdout: {1} \n stderr: {2} \n'.format(
-            ' '.join(cmd), stdout, stderr))
-        return None
-
-    return stdout.strip()
+    return get_demangler().demangle(mangled)
+
+def cpp_demangle_many(names):
+    '''
+    Demangles a list of C++ symbol names at once.
+    Returns a list of the same length.
+    '''
+
+    return get_demangler().demangle_many(names)
 
 def daterange(a_date, b_date, step=1, desc=False):
     '''
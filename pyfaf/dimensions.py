@@ -0,0 +1,276 @@
+import time
+import logging
+import threading
+
+from sqlalchemy import func
+
+import pyfaf
+from pyfaf.common import LRUCache
+from pyfaf.storage.opsys import (Arch,
+                                 Build,
+                                 OpSys,
+                                 OpSysComponent,
+                                 OpSysRelease,
+                                 Package)
+
+# Default number of seconds to trust the cached lookups
+DEFAULT_TTL = 300
+
+# Maximum number of remembered package lookups
+PACKAGE_CACHE_SIZE = 50000
+
+class DimensionCache(object):
+    '''
+    In-memory lookups of the small dimension tables
+    (OpSys, OpSysRelease, Arch, OpSysComponent) and
+    of packages and guessed components of uReports.
+
+    The small tables are loaded at once and only ids are kept.
+    Objects are returned by `session.query(...).get(id)`, which
+    usually hits the identity map, and a hit is checked against
+    the looked up name, so a stale entry only causes a reload.
+    A miss reloads the tables if their row count or the highest
+    id changed since they were loaded. Everything is reloaded
+    after `ttl` seconds.
+
+    Package lookups are remembered in a bounded LRU cache. Found
+    packages are checked the same way, missing ones are only
+    trusted as long as no package has been added.
+
+    Lookups, loads and invalidation are serialized by a lock, only
+    the package queries run outside of it.
+    '''
+
+    def __init__(self, ttl=None, size=PACKAGE_CACHE_SIZE):
+        if ttl is None:
+            ttl = int(pyfaf.config.CONFIG.get("cache.dimensionttl", DEFAULT_TTL))
+
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._packages = LRUCache(size)
+        self._guessed_components = LRUCache(size)
+        self.invalidate()
+
+    def invalidate(self):
+        '''
+        Forget everything, the tables will be loaded on next lookup.
+        '''
+        with self._lock:
+            self._loaded = 0
+            self._stamp = None
+            self._opsys = {}
+            self._opsysreleases = {}
+            self._archs = {}
+            self._components = {}
+            self._objects = {}
+            self._packages.clear()
+            self._guessed_components.clear()
+
+    @staticmethod
+    def _get_stamp(db):
+        result = []
+        for table in [OpSys, OpSysRelease, Arch, OpSysComponent]:
+            result.append(db.session.query(func.count(table.id),
+                                           func.max(table.id)).one())
+        return tuple(result)
+
+    @staticmethod
+    def _get_package_stamp(db):
+        return db.session.query(func.max(Package.id)).scalar()
+
+    def _load(self, db, stamp=None):
+        if stamp is None:
+            stamp = self._get_stamp(db)
+
+        logging.debug("Loading dimension tables.")
+        # build the lookups aside, other threads keep using the old ones
+        opsyss = {}
+        opsys_names = {}
+        for opsys_id, name in db.session.query(OpSys.id, OpSys.name):
+            opsyss[name] = opsys_id
+            opsys_names[opsys_id] = name
+
+        opsysreleases = {}
+        for release_id, opsys_id, version in \
+                db.session.query(OpSysRelease.id, OpSysRelease.opsys_id,
+                                 OpSysRelease.version).order_by(OpSysRelease.id):
+            key = (opsys_names[opsys_id], version)
+            opsysreleases.setdefault(key, (release_id, opsys_id))
+
+        archs = {}
+        for arch_id, name in db.session.query(Arch.id, Arch.name).order_by(Arch.id):
+            archs.setdefault(name, arch_id)
+
+        components = {}
+        for component_id, opsys_id, name in \
+                db.session.query(OpSysComponent.id, OpSysComponent.opsys_id,
+                                 OpSysComponent.name).order_by(OpSysComponent.id):
+            components.setdefault((opsys_id, name), component_id)
+
+        self._opsys = opsyss
+        self._opsysreleases = opsysreleases
+        self._archs = archs
+        self._components = components
+        self._objects = {}
+        self._packages.clear()
+        self._guessed_components.clear()
+        self._stamp = stamp
+        self._loaded = time.time()
+
+    def _refresh(self, db, force=False):
+        '''
+        Load the tables if they were not loaded yet, if they expired
+        or if `force` is set and the tables changed since last load.
+        '''
+        if not self._loaded or time.time() - self._loaded > self.ttl:
+            self._load(db)
+            return True
+
+        if force:
+            stamp = self._get_stamp(db)
+            if stamp != self._stamp:
+                self._load(db, stamp)
+                return True
+
+        return False
+
+    def _get(self, db, table, obj_id, name, attr="name"):
+        obj = db.session.query(table).get(obj_id)
+        if obj is None or getattr(obj, attr) != name:
+            return None
+
+        # keep the object in the identity map
+        self._objects[(table, obj_id)] = obj
+        return obj
+
+    def _lookup(self, db, find):
+        '''
+        Call `find` on the loaded tables. If it finds nothing,
+        or a stale object, reload the changed tables and try again.
+        '''
+        with self._lock:
+            self._refresh(db)
+            result = find()
+            if result is None and self._refresh(db, force=True):
+                result = find()
+
+            return result
+
+    def get_opsys(self, db, name):
+        def find():
+            opsys_id = self._opsys.get(name)
+            if opsys_id is None:
+                return None
+            return self._get(db, OpSys, opsys_id, name)
+
+        return self._lookup(db, find)
+
+    def get_opsysrelease(self, db, osname, version):
+        def find():
+            release = self._opsysreleases.get((osname, version))
+            if release is None:
+                return None
+            release_id, _ = release
+            return self._get(db, OpSysRelease, release_id, version, attr="version")
+
+        return self._lookup(db, find)
+
+    def get_arch(self, db, name):
+        def find():
+            arch_id = self._archs.get(name)
+            if arch_id is None:
+                return None
+            return self._get(db, Arch, arch_id, name)
+
+        return self._lookup(db, find)
+
+    def get_component(self, db, component_name, osname, version):
+        '''
+        Return component `component_name` of the operating system
+        `osname` if it has release `version`.
+        '''
+        def find():
+            release = self._opsysreleases.get((osname, version))
+            if release is None:
+                return None
+            _, opsys_id = release
+            component_id = self._components.get((opsys_id, component_name))
+            if component_id is None:
+                return None
+            return self._get(db, OpSysComponent, component_id, component_name)
+
+        return self._lookup(db, find)
+
+    def _cached_package_lookup(self, db, cache, key, table, query, name=None):
+        '''
+        Return the object of `table` remembered in `cache` for `key`,
+        run `query` if there is none or it is stale.
+        '''
+        with self._lock:
+            self._refresh(db)
+            # a single get, the item may be evicted by another thread
+            cached = cache.get(key)
+
+        if cached is not None:
+            obj_id, stamp = cached
+            if obj_id is not None:
+                obj = db.session.query(table).get(obj_id)
+                if obj is not None and (name is None or obj.name == name):
+                    return obj
+            elif stamp == self._get_package_stamp(db):
+                # no package has been added since
+                return None
+
+        stamp = self._get_package_stamp(db)
+        obj = query()
+        if obj is None:
+            cache.set(key, (None, stamp))
+        else:
+            cache.set(key, (obj.id, None))
+
+        return obj
+
+    def get_package(self, db, ureport_package, ureport_os):
+        key = (ureport_package["name"], ureport_package["epoch"],
+               ureport_package["version"], ureport_package["release"],
+               ureport_package["architecture"], ureport_os["name"],
+               ureport_os["version"])
+
+        def query():
+            return db.session.query(Package).join(Package.arch).join(Package.build).\
+                    join(Build.component).join(OpSysComponent.opsysreleases).\
+                    join(OpSysRelease.opsys).\
+                    filter((Package.name == ureport_package["name"]) & \
+                           (Build.epoch == ureport_package["epoch"]) & \
+                           (Build.version == ureport_package["version"]) & \
+                           (Build.release == ureport_package["release"]) & \
+                           (Arch.name == ureport_package["architecture"]) & \
+                           (OpSys.name == ureport_os["name"]) & \
+                           (OpSysRelease.version == ureport_os["version"])).first()
+
+        return self._cached_package_lookup(db, self._packages, key, Package, query,
+                                           name=ureport_package["name"])
+
+    def guess_component(self, db, ureport_package, ureport_os):
+        '''
+        Return component of a package named as `ureport_package`
+        in the given operating system release.
+        '''
+        key = (ureport_package["name"], ureport_os["name"], ureport_os["version"])
+
+        def query():
+            # Find a package only by name.
+            pkg = db.session.query(Package).join(Package.build).\
+                    join(Build.component).join(OpSysComponent.opsysreleases).\
+                    join(OpSysRelease.opsys).\
+                    filter((Package.name == ureport_package["name"]) & \
+                           (OpSys.name == ureport_os["name"]) & \
+                           (OpSysRelease.version == ureport_os["version"])).first()
+            if pkg:
+                return pkg.build.component
+            return None
+
+        return self._cached_package_lookup(db, self._guessed_components, key,
+                                           OpSysComponent, query)
+
+dimension_cache = DimensionCache()
@@ -1,6 +1,7 @@
 import os
 import uuid
 import json
+import logging
 import pyfaf
 
 from django.core.urlresolvers import reverse
@@ -13,9 +14,9 @@ from django.views.decorators.csrf import csrf_exempt
 from sqlalchemy import func
 from sqlalchemy.sql.expression import desc, literal
 
-from pyfaf import ureport
-from pyfaf.storage.opsys import (OpSys,
-                                 OpSysRelease,
+from pyfaf import spool, ureport
+from pyfaf.dimensions import dimension_cache
+from pyfaf.storage.opsys import (OpSysRelease,
                                  OpSysComponent,
                                  Package,
                                  Build)
@@ -28,7 +29,6 @@ from pyfaf.storage.report import (Report,
                                   ReportHistoryWeekly,
                                   ReportHistoryMonthly,
                                   ReportPackage,
-                                  ReportRhbz,
                                   ReportUnknownPackage)
 from pyfaf.storage.debug import InvalidUReport
 
@@ -243,6 +243,80 @@ def diff(request, lhs_id, rhs_id):
                                  context_instance=RequestContext(request))
 
 
+def _add_solution(response, solution):
+    response['message'] = ("Your problem seems to be caused by {0}\n\n"
+                           "{1}".format(solution.cause, solution.note_text))
+    if solution.url:
+        response['message'] += ("\n\nYou can get more information at {0}"
+                                .format(solution.url))
+
+    response['solutions'] = [{'cause': solution.cause,
+                              'note':  solution.note_text,
+                              'url':   solution.url}]
+    response['result'] = True
+
+def _add_reported_to(request, response, report_id, bug_ids):
+    site = RequestSite(request)
+    url = reverse('pyfaf.hub.reports.views.item', args=[report_id])
+    parts = [{"reporter": "ABRT Server",
+              "value": "https://{0}{1}".format(site.domain, url),
+              "type": "url"}]
+
+    for bug_id in bug_ids:
+        # ToDo: do not hardcode the URL
+        parts.append({"reporter": "Bugzilla",
+                      "value": "https://bugzilla.redhat.com/show_bug.cgi?id={0}".format(bug_id),
+                      "type": "url"})
+
+    if not 'message' in response:
+        response['message'] = ''
+    else:
+        response['message'] += '\n\n'
+
+    response['message'] += "\n".join(p["value"] for p in parts if p["type"].lower() == "url")
+    response['reported_to'] = parts
+
+def _accept_async(request, report, data, db):
+    '''
+    Queue the report in the spool directory and answer right away.
+
+    The spool file is synced to disk before the answer is sent. Clients
+    accepting JSON get the backtrace hash with the URL where the report
+    appears once it is saved, and the known report and solution found
+    in the in-memory caches.
+    '''
+    spool.save_report(data, durable=True)
+
+    if not 'application/json' in request.META.get('HTTP_ACCEPT'):
+        return render_to_response('reports/success.html',
+            {'report': report, 'accepted': True},
+            context_instance=RequestContext(request))
+
+    response = {'result': False}
+    try:
+        bthash, known_report, solution = ureport.get_submission_info(report, db)
+    except Exception as ex:
+        logging.debug("Unable to check the submitted report: {0}".format(str(ex)))
+        return HttpResponse(json.dumps(response),
+            status=202,
+            mimetype='application/json')
+
+    site = RequestSite(request)
+    url = reverse('pyfaf.hub.reports.views.bthash_forward', args=[bthash])
+    response['bthash'] = bthash
+    response['bthash_url'] = "https://{0}{1}".format(site.domain, url)
+
+    if solution is not None:
+        _add_solution(response, solution)
+
+    if known_report:
+        response['result'] = True
+        _add_reported_to(request, response, *known_report)
+
+    return HttpResponse(json.dumps(response),
+        status=202,
+        mimetype='application/json')
+
 # This function gets notification responses according to specification on
 # http://json-rpc.org/wiki/specification
 @csrf_exempt
@@ -261,71 +335,38 @@ def new(request):
 
                 return HttpResponse(err, status=413, mimetype="application/json")
 
+            if spool.async_submission():
+                return _accept_async(request, report,
+                                     form.cleaned_data['file']['json'], db)
+
             try:
-                dbreport = ureport.is_known(report, db, return_report=True)
+                bthash, known_report, solution = ureport.get_submission_info(report, db)
             except:
-                dbreport = None
-
-            known = bool(dbreport)
-            spool_dir = pyfaf.config.get('Report.SpoolDirectory')
-            fname = str(uuid.uuid4())
-            with open(os.path.join(spool_dir, 'incoming', fname), 'w') as fil:
-                fil.write(form.cleaned_data['file']['json'])
-
-            if 'application/json' in request.META.get('HTTP_ACCEPT'):
-                response = {'result': known }
+                # ToDo - log the exception somehow
+                bthash, known_report = None, None
 
+                # unknown components may still have a solution
                 opsys_id = None
-                opsys = db.session.query(OpSys).filter(OpSys.name == report["os"]["name"]).first()
+                opsys = dimension_cache.get_opsys(db, report["os"]["name"])
                 if opsys:
                     opsys_id = opsys.id
 
                 solution = ureport.find_ureport_kb_solution(report, db, opsys_id=opsys_id)
+
+            known = bool(known_report)
+            spool.save_report(form.cleaned_data['file']['json'])
+
+            if 'application/json' in request.META.get('HTTP_ACCEPT'):
+                response = {'result': known }
+
                 if solution is not None:
-                    response['message'] = ("Your problem seems to be caused by {0}\n\n"
-                                           "{1}".format(solution.cause, solution.note_text))
-                    if solution.url:
-                        response['message'] += ("\n\nYou can get more information at {0}"
-                                                .format(solution.url))
-
-                    response['solutions'] = [{'cause': solution.cause,
-                                              'note':  solution.note_text,
-                                              'url':   solution.url}]
-                    response['result'] = True
-
-                try:
-                    if "component" in report:
-                        component = ureport.get_component(report['component'], report['os'], db)
-                    else:
-                        component = ureport.guess_component(report['installed_package'], report['os'], db)
-
-                    if component:
-                        response['bthash'] = ureport.get_report_hash(report, component.name)[1]
-                except:
-                    # ToDo - log the exception somehow
-                    pass
+                    _add_solution(response, solution)
+
+                if bthash is not None:
+                    response['bthash'] = bthash
 
                 if known:
-                    site = RequestSite(request)
-                    url = reverse('pyfaf.hub.reports.views.item', args=[dbreport.id])
-                    parts = [{"reporter": "ABRT Server",
-                              "value": "https://{0}{1}".format(site.domain, url),
-                              "type": "url"}]
-
-                    bugs = db.session.query(ReportRhbz).filter(ReportRhbz.report_id == dbreport.id).all()
-                    for bug in bugs:
-                        # ToDo: do not hardcode the URL
-                        parts.append({"reporter": "Bugzilla",
-                                      "value": "https://bugzilla.redhat.com/show_bug.cgi?id={0}".format(bug.rhbzbug_id),
-                                      "type": "url"})
-
-                    if not 'message' in response:
-                        response['message'] = ''
-                    else:
-                        response['message'] += '\n\n'
-
-                    response['message'] += "\n".join(p["value"] for p in parts if p["type"].lower() == "url")
-                    response['reported_to'] = parts
+                    _add_reported_to(request, response, *known_report)
 
                 return HttpResponse(json.dumps(response),
                     status=202,
@@ -399,13 +440,28 @@ def attach(request):
 def bthash_forward(request, bthash):
     db = pyfaf.storage.getDatabase()
     reportbt = db.session.query(ReportBtHash).filter(ReportBtHash.hash == bthash).first()
-    if reportbt is None:
+    if reportbt is None and not spool.async_submission():
         raise Http404
 
-    if (reportbt.backtrace is None or
+    if (reportbt is None or
+        reportbt.backtrace is None or
         reportbt.backtrace.report is None):
+        # with asynchronous submission the report may still be queued
+        if 'application/json' in request.META.get('HTTP_ACCEPT', ''):
+            return HttpResponse(json.dumps({'result': False}),
+                status=202,
+                mimetype='application/json')
+
         return render_to_response("reports/waitforit.html")
 
+    if 'application/json' in request.META.get('HTTP_ACCEPT', ''):
+        report = reportbt.backtrace.report
+        bug_ids = [rhbz.rhbzbug_id for rhbz in report.rhbz_bugs]
+        response = {'result': bool(bug_ids)}
+        _add_reported_to(request, response, report.id, bug_ids)
+        return HttpResponse(json.dumps(response),
+            mimetype='application/json')
+
     response = HttpResponse(status=302)
     response["Location"] = reverse('pyfaf.hub.reports.views.item',
                                    args=[reportbt.backtrace.report.id])
@@ -1,64 +1,215 @@
-import logging
 import re
+import time
+import hashlib
+import logging
+
+from sqlalchemy import func
 
 from pyfaf.storage.kb import (KbBacktracePath,
-                              KbPackageName)
+                              KbPackageName,
+                              KbSolution)
+
+def report_in_kb(db, report):
+    '''
+    Check if `report` matches entry in knowledge base.
+    '''
 
-def get_kb_btpath_parsers(db, opsys_id=None):
-    result = {}
-    kbentries = (db.session.query(KbBacktracePath)
-                           .filter((KbBacktracePath.opsys_id == opsys_id) |
-                                   (KbBacktracePath.opsys_id == None)))
+    if report.backtraces:
+        bt = report.backtraces[0]
+        paths = [frame.symbolsource.path for frame in bt.frames]
+        if kb_matcher.match_btpaths(db, paths) is not None:
+            return True
 
-    for kbentry in kbentries:
-        try:
-            parser = re.compile(kbentry.pattern)
-        except Exception as ex:
-            logging.warn("Pattern '{0}' can't be compiled as regexp: {1}"
-                         .format(kbentry.pattern, str(ex)))
+    if report.packages:
+        nvras = [package.installed_package.nvra() for package in report.packages]
+        if kb_matcher.match_pkgnames(db, nvras) is not None:
+            return True
+
+    return False
 
-        result[parser] = kbentry.solution
+# Default number of seconds between checks for changes of the knowledge base
+DEFAULT_CHECK_INTERVAL = 10
 
-    return result
+# Python's re module supports at most 100 groups in one expression
+MAX_GROUPS = 99
 
-def get_kb_pkgname_parsers(db, opsys_id=None):
-    result = {}
-    kbentries = (db.session.query(KbPackageName)
-                           .filter((KbPackageName.opsys_id == opsys_id) |
-                                   (KbPackageName.opsys_id == None)))
+# Patterns that can not be joined with others into one expression:
+# inline flags apply to the whole expression, group references
+# would point to a different group.
+RE_SEPARATE = re.compile(r"\(\?[iLmsux]+\)|\\[0-9]|\(\?P[<=]")
 
-    for kbentry in kbentries:
+class KbPatterns(object):
+    '''
+    Regular expressions of a knowledge base table joined into
+    a few alternations of named groups. `match` returns the solution
+    id of the first pattern matching any of the given strings.
+    '''
+
+    def __init__(self, entries):
+        '''
+        `entries` is a list of (pattern, solution_id) pairs
+        ordered by priority.
+        '''
+        self.solutions = []
+        self.expressions = []
+
+        joined = []
+        groups = 0
+        for pattern, solution_id in entries:
+            try:
+                parser = re.compile(pattern)
+            except Exception as ex:
+                logging.warn("Pattern '{0}' can't be compiled as regexp: {1}"
+                             .format(pattern, str(ex)))
+                continue
+
+            index = len(self.solutions)
+            self.solutions.append(solution_id)
+
+            if RE_SEPARATE.search(pattern):
+                self.expressions.append((parser, {None: index}))
+                continue
+
+            if groups + parser.groups + 1 > MAX_GROUPS:
+                self._join(joined)
+                joined = []
+                groups = 0
+
+            joined.append((index, pattern, parser))
+            groups += parser.groups + 1
+
+        self._join(joined)
+
+    def _join(self, joined):
+        if not joined:
+            return
+
+        alternatives = ["(?P<kb{0}>{1})".format(index, pattern)
+                        for index, pattern, _ in joined]
         try:
-            parser = re.compile(kbentry.pattern)
-        except Exception as ex:
-            logging.warn("Pattern '{0}' can't be compiled as regexp: {1}"
-                         .format(kbentry.pattern, str(ex)))
+            parser = re.compile("|".join(alternatives))
+        except Exception:
+            for index, _, parser in joined:
+                self.expressions.append((parser, {None: index}))
+            return
 
-        result[parser] = kbentry.solution
+        names = dict(("kb{0}".format(index), index) for index, _, _ in joined)
+        self.expressions.append((parser, names))
 
-    return result
+    def match(self, strings):
+        best = None
+        for string in strings:
+            for parser, names in self.expressions:
+                match = parser.match(string)
+                if match is None:
+                    continue
 
+                if None in names:
+                    index = names[None]
+                else:
+                    index = names[match.lastgroup]
 
-def report_in_kb(db, report):
-    '''
-    Check if `report` matches entry in knowledge base.
-    '''
+                if best is None or index < best:
+                    best = index
 
-    if report.backtraces:
-        bt = report.backtraces[0]
-        parsers = get_kb_btpath_parsers(db)
+            if best == 0:
+                break
 
-        for parser in parsers:
-            for frame in bt.frames:
-                if parser.match(frame.symbolsource.path):
-                    return True
+        if best is None:
+            return None
 
-    if report.packages:
-        parsers = get_kb_pkgname_parsers(db)
+        return self.solutions[best]
 
-        for parser in parsers:
-            for package in report.packages:
-                if parser.match(package.installed_package.nvra()):
-                    return True
+class KbMatcher(object):
+    '''
+    Matches backtrace paths and package NVRAs against the knowledge
+    base. Patterns of each operating system, including the global
+    ones, are compiled once and kept until the knowledge base tables
+    change, which is checked at most every `interval` seconds. The
+    pattern tables are small, so their rows are hashed to notice
+    patterns edited in place.
+    '''
 
-    return False
+    def __init__(self, interval=DEFAULT_CHECK_INTERVAL):
+        self.interval = interval
+        self.invalidate()
+
+    def invalidate(self):
+        self._btpaths = {}
+        self._pkgnames = {}
+        self._stamp = None
+        self._checked = 0
+
+    @staticmethod
+    def _get_stamp(db):
+        result = [db.session.query(func.count(KbSolution.id),
+                                   func.max(KbSolution.id)).one()]
+        for table in [KbBacktracePath, KbPackageName]:
+            rows = hashlib.sha1()
+            for row in (db.session.query(table.id, table.pattern,
+                                         table.opsys_id, table.solution_id)
+                                  .order_by(table.id)):
+                rows.update(repr(tuple(row)))
+            result.append(rows.hexdigest())
+        return tuple(result)
+
+    def _check(self, db):
+        now = time.time()
+        if now - self._checked < self.interval:
+            return
+
+        self._checked = now
+        stamp = self._get_stamp(db)
+        if stamp != self._stamp:
+            self._btpaths = {}
+            self._pkgnames = {}
+            self._stamp = stamp
+
+    @staticmethod
+    def _load(db, table, opsys_id):
+        entries = (db.session.query(table.pattern, table.solution_id)
+                             .filter((table.opsys_id == opsys_id) |
+                                     (table.opsys_id == None))
+                             .order_by(table.id))
+        return KbPatterns(entries.all())
+
+    def _get_patterns(self, db, cache_name, table, opsys_id):
+        # the cache is replaced when the knowledge base changes
+        self._check(db)
+        cache = getattr(self, cache_name)
+        if opsys_id not in cache:
+            cache[opsys_id] = self._load(db, table, opsys_id)
+
+        return cache[opsys_id]
+
+    def match_btpaths(self, db, paths, opsys_id=None):
+        '''
+        Return id of the solution of the first backtrace path
+        pattern matching any of `paths` or None.
+        '''
+        patterns = self._get_patterns(db, "_btpaths", KbBacktracePath, opsys_id)
+        return patterns.match(paths)
+
+    def match_pkgnames(self, db, nvras, opsys_id=None):
+        '''
+        Return id of the solution of the first package name
+        pattern matching any of `nvras` or None.
+        '''
+        patterns = self._get_patterns(db, "_pkgnames", KbPackageName, opsys_id)
+        return patterns.match(nvras)
+
+    def find_solution(self, db, paths, nvras, opsys_id=None):
+        '''
+        Return KbSolution matching backtrace `paths`, or if there
+        is none, package `nvras`. None if nothing matches.
+        '''
+        solution_id = self.match_btpaths(db, paths, opsys_id=opsys_id)
+        if solution_id is None:
+            solution_id = self.match_pkgnames(db, nvras, opsys_id=opsys_id)
+
+        if solution_id is None:
+            return None
+
+        return db.session.query(KbSolution).get(solution_id)
+
+kb_matcher = KbMatcher()
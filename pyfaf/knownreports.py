@@ -0,0 +1,214 @@
+import time
+import logging
+import threading
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import pyfaf
+from pyfaf.storage.report import (Report,
+                                  ReportBacktrace,
+                                  ReportBtHash,
+                                  ReportRhbz)
+
+# Default number of seconds between checks for new reports
+DEFAULT_REFRESH_INTERVAL = 10
+
+# Default number of seconds between full reloads of the index
+DEFAULT_RELOAD_INTERVAL = 3600
+
+# Number of rows fetched at once when loading the index
+LOAD_CHUNK_SIZE = 10000
+
+# Backtraces with ids this close to the highest loaded one are read
+# again, transactions are not always committed in the order of ids
+RECENT_WINDOW = 1000
+
+class KnownReports(object):
+    '''
+    In-memory index of backtrace hashes of the stored reports.
+
+    Maps (hash type, hash, component id) to the report id and report
+    ids to the ids of their Bugzilla bugs, so the submission endpoint
+    can tell whether a uReport is known without touching the database.
+
+    The index is kept current by a background thread with its own
+    database session, started by the first lookup. Every `interval`
+    seconds it loads backtraces with ids close to or higher than the
+    last seen one and reloads the bugs if their count has changed.
+    Every `reload_interval` seconds the whole index is built again to
+    pick up late commits and forget deleted reports. New dictionaries
+    are always built aside and swapped in at once, so lookups never
+    see a partially loaded index.
+
+    Until the first full load finishes, lookups are answered by the
+    database. Deleted reports stay known until the next full reload.
+
+    With `interval` 0 no thread is started and the index follows the
+    database only through explicit calls to `refresh`.
+    '''
+
+    def __init__(self, interval=None, reload_interval=None):
+        if interval is None:
+            interval = int(pyfaf.config.CONFIG.get("cache.knownreportsinterval",
+                                                   DEFAULT_REFRESH_INTERVAL))
+        if reload_interval is None:
+            reload_interval = int(pyfaf.config.CONFIG.get("cache.knownreportsreload",
+                                                          DEFAULT_RELOAD_INTERVAL))
+
+        self.interval = interval
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._hashes = {}
+            self._bugs = {}
+            self._recent = set()
+            self._last_backtrace_id = None
+            self._bug_count = None
+            self._loaded = 0
+
+    @staticmethod
+    def _key(hash_type, hash_hash, component_id):
+        return "{0}:{1}:{2}".format(hash_type, hash_hash, component_id)
+
+    def _load_backtraces(self, session, hashes, last_backtrace_id, recent):
+        '''
+        Add backtraces with ids higher than `last_backtrace_id` minus
+        the recent window and not in `recent` to `hashes`. Return tuple
+        of the new highest backtrace id and set of recent backtrace ids.
+        '''
+        query = session.query(ReportBacktrace.id, ReportBtHash.type,
+                              ReportBtHash.hash, Report.component_id,
+                              Report.id).\
+                join(ReportBtHash).join(Report)
+
+        if last_backtrace_id is not None:
+            query = query.filter(ReportBacktrace.id > last_backtrace_id - RECENT_WINDOW)
+
+        loaded = set()
+        for backtrace_id, hash_type, hash_hash, component_id, report_id in \
+                query.order_by(ReportBacktrace.id).yield_per(LOAD_CHUNK_SIZE):
+            if backtrace_id in recent:
+                continue
+
+            key = self._key(hash_type, hash_hash, component_id)
+            hashes.setdefault(key, report_id)
+            last_backtrace_id = max(backtrace_id, last_backtrace_id)
+            loaded.add(backtrace_id)
+
+        if last_backtrace_id is not None:
+            limit = last_backtrace_id - RECENT_WINDOW
+            recent = set(i for i in recent | loaded if i > limit)
+
+        if loaded:
+            logging.debug("Loaded {0} backtraces to the known reports index"
+                          .format(len(loaded)))
+
+        return last_backtrace_id, recent
+
+    def _load_bugs(self, session):
+        bugs = {}
+        for report_id, bug_id in session.query(ReportRhbz.report_id,
+                                               ReportRhbz.rhbzbug_id):
+            bugs.setdefault(report_id, []).append(bug_id)
+
+        return bugs
+
+    def refresh(self, session, reload=False):
+        '''
+        Load reports and bugs stored since the last refresh using
+        `session`. The whole index is loaded again if `reload` is set
+        or the last full load is older than `reload_interval`.
+        '''
+        with self._lock:
+            now = time.time()
+            if reload or now - self._loaded > self.reload_interval:
+                logging.debug("Loading the known reports index")
+                hashes = {}
+                last_backtrace_id, recent = self._load_backtraces(session, hashes,
+                                                                  None, set())
+                bug_count = session.query(func.count(ReportRhbz.report_id)).scalar()
+                bugs = self._load_bugs(session)
+
+                self._hashes, self._bugs = hashes, bugs
+                self._loaded = now
+            else:
+                # adding keys to the dictionary in place is safe for readers
+                last_backtrace_id, recent = self._load_backtraces(session, self._hashes,
+                                                                  self._last_backtrace_id,
+                                                                  self._recent)
+                bug_count = session.query(func.count(ReportRhbz.report_id)).scalar()
+                if bug_count != self._bug_count:
+                    self._bugs = self._load_bugs(session)
+
+            self._last_backtrace_id, self._recent = last_backtrace_id, recent
+            self._bug_count = bug_count
+
+    def _run(self, bind):
+        session = Session(bind, autoflush=False, autocommit=True)
+        while True:
+            try:
+                self.refresh(session)
+            except Exception as ex:
+                logging.error("Unable to refresh the known reports index: {0}"
+                              .format(str(ex)))
+            finally:
+                # do not keep the loaded rows in the identity map
+                session.expunge_all()
+
+            time.sleep(self.interval)
+
+    def start(self, db):
+        '''
+        Start the background thread refreshing the index
+        unless it is running or `interval` is 0.
+        '''
+        if self._thread is not None or not self.interval:
+            return
+
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(target=self._run,
+                                            args=(db.session.bind,),
+                                            name="known-reports")
+            self._thread.daemon = True
+            self._thread.start()
+
+    @staticmethod
+    def _query(db, hash_type, hash_hash, component_id):
+        row = db.session.query(Report.id).join(ReportBacktrace).join(ReportBtHash).\
+                filter((ReportBtHash.hash == hash_hash) &
+                       (ReportBtHash.type == hash_type) &
+                       (Report.component_id == component_id)).\
+                order_by(ReportBacktrace.id).first()
+        if row is None:
+            return None
+
+        bug_ids = [bug_id for (bug_id,) in
+                   db.session.query(ReportRhbz.rhbzbug_id).\
+                           filter(ReportRhbz.report_id == row[0])]
+        return row[0], bug_ids
+
+    def get(self, db, hash_type, hash_hash, component_id):
+        '''
+        Return tuple of id of the report with the given backtrace hash
+        and list of its bug ids or None if there is no such report.
+        '''
+        self.start(db)
+        if not self._loaded:
+            # the index is being loaded, ask the database meanwhile
+            return self._query(db, hash_type, hash_hash, component_id)
+
+        report_id = self._hashes.get(self._key(hash_type, hash_hash, component_id))
+        if report_id is None:
+            return None
+
+        return report_id, self._bugs.get(report_id, [])
+
+known_reports = KnownReports()
@@ -1,6 +1,11 @@
+import json
+import errno
+import fcntl
 import shutil
+import logging
 import os.path
 import tempfile
+import threading
 import subprocess
 
 import pyfaf.config
@@ -9,43 +14,530 @@ import pyfaf.config
 Low-level package packaging operations.
 """
 
-def unpack_rpm_to_tmp(path, prefix="faf"):
+# Default quota of the unpack cache in bytes, 0 disables the cache
+DEFAULT_UNPACK_CACHE_SIZE = 20 << 30
+
+# Name of the unpack cache directory in storage.tmpdir
+UNPACK_CACHE_DIR = "faf-unpack-cache"
+
+def get_tmpdir():
+    """
+    Returns the configured directory for temporary files or None
+    for the platform default.
+    """
+
+    if "storage.tmpdir" in pyfaf.config.CONFIG:
+        return pyfaf.config.CONFIG["storage.tmpdir"]
+
+    return None
+
+# Maximum number of rounds of extracting targets of symbolic links
+MAX_SYMLINK_ROUNDS = 8
+
+def get_cpio_pattern(path, prefix=False):
+    """
+    Returns cpio pattern matching the file (path) in an RPM package
+    or all files below it if prefix is True.
+    """
+
+    pattern = "".join("\\" + char if char in "*?[]\\" else char
+                      for char in path.lstrip("/"))
+    if prefix:
+        pattern = pattern.rstrip("/") + "/*"
+
+    return "./" + pattern
+
+def _extract_cpio(path, dest_dir, patterns=None):
+    """
+    Streams the payload of an RPM package (path) from rpm2cpio to cpio,
+    which extracts files matching the patterns (all files if None)
+    to dest_dir. No intermediate cpio file is written.
+    """
+
+    cmd = ["cpio", "--extract", "-d", "-u", "--quiet"]
+    pattern_file = None
+    if patterns is not None:
+        pattern_file = tempfile.NamedTemporaryFile(prefix="faf-cpio-patterns-")
+        pattern_file.write("".join("{0}\n".format(pattern) for pattern in patterns))
+        pattern_file.flush()
+        cmd.append("--pattern-file={0}".format(pattern_file.name))
+
+    try:
+        with tempfile.TemporaryFile() as rpm2cpio_stderr:
+            rpm2cpio_proc = subprocess.Popen(["rpm2cpio", path],
+                                             stdout=subprocess.PIPE,
+                                             stderr=rpm2cpio_stderr)
+            cpio_proc = subprocess.Popen(cmd, stdin=rpm2cpio_proc.stdout,
+                                         cwd=dest_dir, stderr=subprocess.PIPE)
+            rpm2cpio_proc.stdout.close()
+
+            _, cpio_stderr = cpio_proc.communicate()
+            rpm2cpio_proc.wait()
+
+            rpm2cpio_stderr.seek(0)
+            stderr = rpm2cpio_stderr.read()
+    finally:
+        if pattern_file is not None:
+            pattern_file.close()
+
+    if cpio_proc.returncode != 0:
+        raise Exception("Failed to unpack RPM using cpio: {0}".format(cpio_stderr))
+
+    if rpm2cpio_proc.returncode != 0:
+        # WORKAROUND - rpm2cpio returns wrong exitcode for large
+        # resulting cpio files remove this once
+        # https://bugzilla.redhat.com/show_bug.cgi?id=790396 is fixed
+        if stderr != '':
+            raise Exception("Failed to convert RPM to cpio using rpm2cpio: {0}".format(path))
+
+def _get_symlink_target(dest_dir, path):
+    """
+    Returns path in the package of the target of a symbolic link (path)
+    extracted to dest_dir or None if it is not a dangling symbolic link.
+    """
+
+    location = os.path.join(dest_dir, path.lstrip("/"))
+    if not os.path.islink(location) or os.path.exists(location):
+        return None
+
+    target = os.readlink(location)
+    if not target.startswith("/"):
+        target = os.path.join(os.path.dirname(path), target)
+
+    return os.path.normpath(target)
+
+def extract_rpm(path, dest_dir, paths=None, prefixes=None):
+    """
+    Extracts files of an RPM package (path) to dest_dir. If paths
+    or prefixes are given, only files with the paths and files below
+    the prefixes are extracted, otherwise the whole package. Targets
+    of the extracted symbolic links are extracted as well.
+
+    Returns set of the paths requested from the package including
+    the targets of symbolic links or None after a full unpack.
+
+    Raises an exception in the case of failure.
+    """
+
+    if paths is None and prefixes is None:
+        _extract_cpio(path, dest_dir)
+        return None
+
+    requested = set(paths or [])
+    patterns = [get_cpio_pattern(p) for p in requested]
+    patterns.extend(get_cpio_pattern(p, prefix=True) for p in prefixes or [])
+
+    rounds = 0
+    while patterns and rounds < MAX_SYMLINK_ROUNDS:
+        rounds += 1
+        _extract_cpio(path, dest_dir, patterns)
+
+        patterns = []
+        for file_path in list(requested):
+            target = _get_symlink_target(dest_dir, file_path)
+            if target is not None and target not in requested:
+                requested.add(target)
+                patterns.append(get_cpio_pattern(target))
+
+    return requested
+
+def locate_files(dest_dir, paths):
+    """
+    Returns dict mapping the paths of files in a package to their
+    locations in dest_dir, where the package was extracted. Paths
+    which were not extracted are omitted.
+    """
+
+    result = {}
+    for path in paths:
+        location = os.path.join(dest_dir, path.lstrip("/"))
+        if os.path.exists(location):
+            result[path] = location
+
+    return result
+
+def unpack_rpm_to_tmp(path, prefix="faf", tmpdir=None, paths=None, prefixes=None):
     """
     Unpacks an RPM package (path) to a temp directory.  Returns path
     to that directory.
 
     Parameter prefix: prefix of the temp directory.
+    Parameter tmpdir: parent of the temp directory, storage.tmpdir
+    by default.
+    Parameters paths and prefixes: extract only the files, see extract_rpm.
 
     Raises an exception in the case of failure.
     """
 
-    tmpdir = None
-    if "storage.tmpdir" in pyfaf.config.CONFIG:
-        tmpdir = pyfaf.config.CONFIG["storage.tmpdir"]
+    if tmpdir is None:
+        tmpdir = get_tmpdir()
 
     temp_dir = tempfile.mkdtemp(prefix=prefix, dir=tmpdir)
-    with open(os.path.join(temp_dir, "package.cpio"), "w+b") as cpio_file:
-        rpm2cpio_proc = subprocess.Popen(["rpm2cpio", path],
-                                         stdout=cpio_file, stderr=subprocess.PIPE)
-
-        _, stderr = rpm2cpio_proc.communicate()
-        if rpm2cpio_proc.returncode != 0:
-            # WORKAROUND - rpm2cpio returns wrong exitcode for large
-            # resulting cpio files remove this once
-            # https://bugzilla.redhat.com/show_bug.cgi?id=790396 is fixed
-            if not (stderr == ''
-                    and os.path.exists(cpio_file.name)
-                    and os.path.getsize(cpio_file.name) > 2 * (1024**3)):
-                shutil.rmtree(temp_dir)
-                raise Exception("Failed to convert RPM to cpio using rpm2cpio: {0}".format(path))
-        cpio_file.seek(0)
-
-        cpio_proc = subprocess.Popen(["cpio", "--extract", "-d", "--quiet"],
-                                     stdin=cpio_file, cwd=temp_dir,
-                                     stderr=subprocess.PIPE)
-        cpio_proc.wait()
-        if cpio_proc.returncode != 0:
+    try:
+        extract_rpm(path, temp_dir, paths=paths, prefixes=prefixes)
+    except:
+        shutil.rmtree(temp_dir)
+        raise
+
+    return temp_dir
+
+def get_dir_size(path):
+    """
+    Returns total size in bytes of the files in the directory tree.
+    """
+
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+
+    return size
+
+class UnpackedRpm(object):
+    """
+    RPM unpacked by UnpackCache. Its directory (path) exists until
+    release() is called.
+    """
+
+    def __init__(self, path, lock=None):
+        self.path = path
+        self._lock = lock
+
+    def locate(self, paths):
+        """
+        Returns dict mapping the paths in the RPM to the locations
+        of the unpacked files, see locate_files.
+        """
+
+        return locate_files(self.path, paths)
+
+    def release(self):
+        """
+        Releases the reference to a cached directory or removes
+        a temporary one.
+        """
+
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+            return
+
+        if self.path is None:
+            return
+
+        logging.debug("Deleting {0}".format(self.path))
+        # sometimes empty directories are write-only (e.g. ftp dropbox)
+        # they can't be listed, but can be deleted - just ignore the error
+        try:
+            shutil.rmtree(self.path)
+        except Exception as ex:
+            logging.error(str(ex))
+        self.path = None
+
+class UnpackCache(object):
+    """
+    Persistent cache of unpacked RPMs shared by threads and processes.
+
+    Every entry is a directory named by its key with the unpacked RPM,
+    a file with its size and a lock file. Users of an entry hold
+    a shared flock of the lock file, which works as a reference count
+    surviving crashes of the processes. The least recently used entries
+    without users are removed when the cache is larger than the quota.
+    """
+
+    def __init__(self, cache_dir=None, quota=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(get_tmpdir() or tempfile.gettempdir(),
+                                     UNPACK_CACHE_DIR)
+        if quota is None:
+            quota = int(pyfaf.config.CONFIG.get("storage.unpackcachesize",
+                                                DEFAULT_UNPACK_CACHE_SIZE))
+
+        self.cache_dir = cache_dir
+        self.quota = quota
+
+        if self.quota > 0 and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def _path(self, key, suffix=""):
+        return os.path.join(self.cache_dir, "{0}{1}".format(key, suffix))
+
+    def _lock(self, key, operation):
+        """
+        Returns the lock file of the entry locked by `operation`.
+        The lock file may be removed by eviction while waiting
+        for the lock, in that case the new lock file is locked.
+        """
+
+        lock_path = self._path(key, ".lock")
+        while True:
+            lock = open(lock_path, "a")
+            try:
+                fcntl.flock(lock, operation)
+            except:
+                lock.close()
+                raise
+
+            try:
+                if os.fstat(lock.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    return lock
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    lock.close()
+                    raise
+
+            lock.close()
+
+    def _write(self, key, suffix, data):
+        tmpname = self._path(".{0}".format(key), "{0}.tmp".format(suffix))
+        with open(tmpname, "w") as fil:
+            fil.write(data)
+
+        os.rename(tmpname, self._path(key, suffix))
+
+    def _write_contents(self, key, paths, prefixes):
+        """
+        Stores the paths and prefixes extracted to a partial entry,
+        None means the whole RPM was unpacked.
+        """
+
+        if paths is None:
+            try:
+                os.unlink(self._path(key, ".files"))
+            except OSError:
+                pass
+            return
+
+        self._write(key, ".files", json.dumps({"paths": sorted(paths),
+                                               "prefixes": sorted(prefixes)}))
+
+    def _read_contents(self, key):
+        """
+        Returns tuple of sets of the paths and prefixes extracted
+        to the entry or None if the whole RPM was unpacked.
+        """
+
+        try:
+            with open(self._path(key, ".files"), "r") as fil:
+                contents = json.load(fil)
+        except IOError as ex:
+            if ex.errno == errno.ENOENT:
+                return None
+            raise
+
+        return set(contents["paths"]), set(contents["prefixes"])
+
+    def _missing(self, key, paths, prefixes):
+        """
+        Returns tuple of the paths and prefixes which are not extracted
+        to the entry yet, (None, None) if the whole RPM is needed,
+        or None if nothing is missing.
+        """
+
+        contents = self._read_contents(key)
+        if contents is None:
+            return None
+
+        if paths is None and prefixes is None:
+            return None, None
+
+        done_paths, done_prefixes = contents
+        def covered(path):
+            return any(path.startswith(done_prefix.rstrip("/") + "/")
+                       for done_prefix in done_prefixes)
+
+        missing_paths = set(path for path in paths or []
+                            if path not in done_paths and not covered(path))
+        missing_prefixes = set(path_prefix for path_prefix in prefixes or []
+                               if path_prefix not in done_prefixes and
+                                  not covered(path_prefix))
+        if not missing_paths and not missing_prefixes:
+            return None
+
+        return missing_paths, missing_prefixes
+
+    def _unpack(self, key, rpm_path, prefix, paths, prefixes):
+        """
+        Unpacks the RPM to the entry, must be called with
+        the exclusive lock of the entry held.
+        """
+
+        # remove leftovers of an interrupted unpacking
+        tmp_prefix = ".unpack-{0}-".format(key)
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(tmp_prefix):
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+        logging.debug("Unpacking {0} to the unpack cache".format(rpm_path))
+        temp_dir = tempfile.mkdtemp(prefix=tmp_prefix + prefix, dir=self.cache_dir)
+        try:
+            requested = extract_rpm(rpm_path, temp_dir, paths=paths, prefixes=prefixes)
+        except:
             shutil.rmtree(temp_dir)
-            raise Exception("Failed to unpack RPM using cpio: {0}".format(cpio_proc.stderr.read()))
-        os.remove(cpio_file.name)
-        return temp_dir
+            raise
+
+        self._write_contents(key, requested, prefixes or [])
+        self._write(key, ".size", str(get_dir_size(temp_dir)))
+        os.rename(temp_dir, self._path(key))
+
+    def _extend(self, key, rpm_path, paths, prefixes):
+        """
+        Extracts files missing in the entry, must be called with
+        the shared lock of the entry held. Users of the entry are
+        not affected, files are only added.
+        """
+
+        with open(self._path(key, ".extract"), "a") as extract_lock:
+            fcntl.flock(extract_lock, fcntl.LOCK_EX)
+
+            missing = self._missing(key, paths, prefixes)
+            if missing is None:
+                return
+
+            logging.debug("Extracting more files of {0} to the unpack cache"
+                          .format(rpm_path))
+            missing_paths, missing_prefixes = missing
+            requested = extract_rpm(rpm_path, self._path(key), paths=missing_paths,
+                                    prefixes=missing_prefixes)
+            if requested is None:
+                self._write_contents(key, None, None)
+            else:
+                done_paths, done_prefixes = self._read_contents(key)
+                self._write_contents(key, done_paths | requested,
+                                     done_prefixes | missing_prefixes)
+
+            self._write(key, ".size", str(get_dir_size(self._path(key))))
+
+    def acquire(self, key, rpm_path, prefix="faf", paths=None, prefixes=None):
+        """
+        Returns UnpackedRpm with the RPM (rpm_path) unpacked. The RPM
+        is unpacked only if there is no entry with the key yet. If paths
+        or prefixes are given, only the files are extracted (see
+        extract_rpm) and later requests extract the missing files
+        to the same entry. The entry can not be evicted until
+        the UnpackedRpm is released.
+
+        Raises an exception in the case of failure.
+        """
+
+        if self.quota <= 0:
+            return UnpackedRpm(unpack_rpm_to_tmp(rpm_path, prefix=prefix, paths=paths,
+                                                 prefixes=prefixes))
+
+        path = self._path(key)
+        while True:
+            lock = self._lock(key, fcntl.LOCK_SH)
+            if os.path.isdir(path):
+                break
+
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.isdir(path):
+                    self._unpack(key, rpm_path, prefix, paths, prefixes)
+                # converting the lock is not atomic, the entry
+                # may be evicted before the shared lock is taken
+                fcntl.flock(lock, fcntl.LOCK_SH)
+            except:
+                lock.close()
+                raise
+
+            if os.path.isdir(path):
+                break
+
+            lock.close()
+
+        try:
+            if self._missing(key, paths, prefixes) is not None:
+                self._extend(key, rpm_path, paths, prefixes)
+        except:
+            lock.close()
+            raise
+
+        # the modification time of the directory marks the last use
+        os.utime(path, None)
+        self.evict()
+
+        return UnpackedRpm(path, lock)
+
+    def get_entries(self):
+        """
+        Returns list of tuples of the time of the last use, key and size
+        of the cached entries.
+        """
+
+        result = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+
+            try:
+                with open(self._path(name, ".size"), "r") as fil:
+                    size = int(fil.read())
+                last_used = os.stat(path).st_mtime
+            except (IOError, OSError, ValueError):
+                continue
+
+            result.append((last_used, name, size))
+
+        return result
+
+    def evict(self):
+        """
+        Removes the least recently used entries without users
+        until the cache fits into the quota.
+        """
+
+        entries = self.get_entries()
+        total = sum(size for _, _, size in entries)
+        for last_used, key, size in sorted(entries):
+            if total <= self.quota:
+                break
+
+            try:
+                lock = self._lock(key, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as ex:
+                if ex.errno in [errno.EAGAIN, errno.EACCES]:
+                    # the entry is in use
+                    continue
+                raise
+
+            try:
+                path = self._path(key)
+                if os.path.isdir(path):
+                    logging.debug("Evicting {0} from the unpack cache".format(key))
+                    # the entry disappears at once, the files are removed later
+                    evicted = tempfile.mkdtemp(prefix=".evict-", dir=self.cache_dir)
+                    os.rename(path, os.path.join(evicted, key))
+                    shutil.rmtree(evicted, ignore_errors=True)
+                    total -= size
+
+                for suffix in [".size", ".files", ".extract", ".lock"]:
+                    try:
+                        os.unlink(self._path(key, suffix))
+                    except OSError:
+                        pass
+            finally:
+                lock.close()
+
+_unpack_caches = {}
+_unpack_caches_lock = threading.Lock()
+
+def get_unpack_cache(cache_dir=None):
+    """
+    Returns UnpackCache of the directory, by default the one
+    in storage.tmpdir.
+    """
+
+    with _unpack_caches_lock:
+        if cache_dir not in _unpack_caches:
+            _unpack_caches[cache_dir] = UnpackCache(cache_dir)
+
+        return _unpack_caches[cache_dir]
@@ -20,16 +20,24 @@ import logging
 import subprocess
 import threading
 
+import pyfaf
 from pyfaf import package
 from pyfaf import support
-from pyfaf.common import get_libname, cpp_demangle
-from pyfaf.storage.opsys import (Package, PackageDependency)
+from pyfaf.common import get_libname, cpp_demangle, get_debug_file
+from pyfaf.storage.opsys import (Package, PackageBuildId, PackageDependency)
 from pyfaf.storage.symbol import (Symbol, SymbolSource)
-from pyfaf.storage import ReportBtFrame, Arch, Build
+from pyfaf.storage import (Report, ReportBacktrace, ReportBtFrame, ReportBtThread,
+                           ReportChanged, Arch, Build)
 from subprocess import call, Popen, PIPE, STDOUT
 
 INLINED_PARSER = re.compile("^(.+) inlined at ([^:]+):([0-9]+) in (.*)$")
 
+# DWARF shared by the debug files of a debuginfo package (dwz)
+DWZ_DIR = "/usr/lib/debug/.dwz"
+
+# Sources in debuginfo packages
+DEBUG_SOURCE_DIR = "/usr/src/debug"
+
 def bt_shift_frames(session, backtrace, first):
     shift = [f for f in backtrace.frames if f.order >= first]
     logging.debug("Shifting {0} frames for backtrace #{1}" \
@@ -69,19 +77,86 @@ def parse_inlined(raw):
 
     return match.group(1), (match.group(4), match.group(2), match.group(3))
 
-def retrace_symbol(binary_path, binary_offset, binary_dir, debuginfo_dir, absolute_offset=False):
+# Maximum number of addresses passed to one eu-addr2line call
+ADDR2LINE_CHUNK_SIZE = 1000
+
+def parse_addr2line_output(stdout, count):
     '''
-    Handle actual retracing. Call eu-unstrip and eu-addr2line
-    on unpacked rpms.
+    Parse output of eu-addr2line --functions called with `count`
+    addresses. Every address is described by a line with the function
+    name and a line with the source file and line number.
 
-    Returns list of tuples containing function, source code file and line or
-    None if retracing failed.
+    Returns list of results in the format of retrace_symbol.
+    '''
+
+    lines = stdout.splitlines()
+    if len(lines) != 2 * count:
+        raise Exception, "Unexpected output of eu-addr2line: {0} lines for " \
+                         "{1} addresses".format(len(lines), count)
+
+    results = []
+    for i in xrange(count):
+        function_name = lines[2 * i]
+        source = lines[2 * i + 1].split(":")
+
+        source_file = source[0]
+        line_number = source[1]
+        inlined = None
+
+        if " inlined at " in function_name:
+            function_name, inlined = parse_inlined(function_name)
+
+        result = [(function_name, source_file, line_number)]
+        if inlined:
+            result.insert(0, inlined)
+
+        results.append(result)
+
+    return results
+
+class Symbolizer(object):
+    '''
+    Batched retracing of offsets in binaries.
+
+    Offsets are queued by add() and grouped by binary and debuginfo
+    directory. resolve() calls eu-unstrip once per binary to get its
+    bias and eu-addr2line once for all queued offsets of the binary,
+    results are then available from get().
     '''
 
-    offset = 0
-    if not absolute_offset:
-        cmd = ["eu-unstrip", "-n", "-e",
-            os.path.join(binary_dir, binary_path[1:])]
+    def __init__(self):
+        self._pending = {}
+        self._biases = {}
+        self._results = {}
+
+    @staticmethod
+    def _executable(binary_path, binary_dir):
+        return os.path.join(binary_dir, binary_path[1:])
+
+    def add(self, binary_path, binary_offset, binary_dir, debuginfo_dir,
+            absolute_offset=False):
+        executable = self._executable(binary_path, binary_dir)
+        key = (executable, debuginfo_dir)
+        if key not in self._pending:
+            self._pending[key] = set()
+        self._pending[key].add((binary_offset, absolute_offset))
+
+    def get(self, binary_path, binary_offset, binary_dir, debuginfo_dir,
+            absolute_offset=False):
+        '''
+        Return list of tuples containing function, source code file
+        and line or None if retracing failed or the offset was not
+        resolved yet.
+        '''
+        executable = self._executable(binary_path, binary_dir)
+        return self._results.get((executable, debuginfo_dir,
+                                  binary_offset, absolute_offset))
+
+    def _get_bias(self, executable):
+        if executable in self._biases:
+            return self._biases[executable]
+
+        cmd = ["eu-unstrip", "-n", "-e", executable]
 
         logging.debug("Calling {0}".format(' '.join(cmd)))
 
@@ -91,49 +166,108 @@ def retrace_symbol(binary_path, binary_offset, binary_dir, debuginfo_dir, absolu
             logging.error('eu-unstrip failed.'
                 ' command {0} \n stdout: {1} \n stderr: {2} \n'.format(
                 ' '.join(cmd), stdout, stderr))
+            bias = None
+        else:
+            offset_match = re.match("((0x)?[0-9a-f]+)", stdout)
+            bias = int(offset_match.group(0), 16)
+
+        self._biases[executable] = bias
+        return bias
+
+    def _addr2line(self, executable, debuginfo_dir, addresses):
+        '''
+        Return list of results for `addresses` or None if eu-addr2line
+        failed. Raise an exception if its output can not be parsed.
+        '''
+        cmd = ["eu-addr2line",
+               "--executable={0}".format(executable),
+               "--debuginfo-path={0}".format(
+                  os.path.join(debuginfo_dir, "usr/lib/debug")),
+               "--functions"] + [str(address) for address in addresses]
+
+        logging.debug("Calling eu-addr2line --executable={0} with {1} addresses"
+                      .format(executable, len(addresses)))
+
+        addr2line_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+        stdout, stderr = addr2line_proc.communicate()
+        if addr2line_proc.returncode != 0:
+            logging.error('eu-addr2line failed.'
+                ' command {0} \n stdout: {1} \n stderr: {2} \n'.format(
+                ' '.join(cmd), stdout, stderr))
             return None
 
-        offset_match = re.match("((0x)?[0-9a-f]+)", stdout)
-        offset = int(offset_match.group(0), 16)
-
-    cmd = ["eu-addr2line",
-           "--executable={0}".format(
-              os.path.join(binary_dir, binary_path[1:])),
-           "--debuginfo-path={0}".format(
-              os.path.join(debuginfo_dir, "usr/lib/debug")),
-           "--functions",
-              str(offset + binary_offset)]
-
-    logging.debug("Calling {0}".format(' '.join(cmd)))
+        return parse_addr2line_output(stdout, len(addresses))
 
-    addr2line_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    def _resolve_chunk(self, executable, debuginfo_dir, chunk):
+        '''
+        Retrace `chunk` of (address, binary offset, absolute offset)
+        requests. If the output for the chunk can not be parsed, its
+        halves are retraced separately so that a single unparsable
+        address does not drop the others.
+        '''
+        try:
+            results = self._addr2line(executable, debuginfo_dir,
+                                      [request[0] for request in chunk])
+        except Exception as ex:
+            if len(chunk) == 1:
+                logging.error("Unable to parse output of eu-addr2line --executable={0} "
+                              "for address {1}: {2}".format(executable, chunk[0][0], str(ex)))
+                return
+
+            logging.debug("Unable to parse output of eu-addr2line --executable={0} "
+                          "for {1} addresses, splitting them: {2}"
+                          .format(executable, len(chunk), str(ex)))
+            half = len(chunk) // 2
+            self._resolve_chunk(executable, debuginfo_dir, chunk[:half])
+            self._resolve_chunk(executable, debuginfo_dir, chunk[half:])
+            return
+
+        if results is None:
+            return
+
+        for (_, binary_offset, absolute_offset), result in zip(chunk, results):
+            self._results[(executable, debuginfo_dir,
+                           binary_offset, absolute_offset)] = result
+
+    def resolve(self):
+        '''
+        Retrace all queued offsets.
+        '''
+        for (executable, debuginfo_dir), offsets in self._pending.items():
+            requests = []
+            for binary_offset, absolute_offset in sorted(offsets):
+                if absolute_offset:
+                    address = binary_offset
+                else:
+                    bias = self._get_bias(executable)
+                    if bias is None:
+                        continue
+                    address = bias + binary_offset
 
-    stdout, stderr = addr2line_proc.communicate()
-    if addr2line_proc.returncode != 0:
-        logging.error('eu-addr2line failed.'
-            ' command {0} \n stdout: {1} \n stderr: {2} \n'.format(
-            ' '.join(cmd), stdout, stderr))
-        return None
+                requests.append((address, binary_offset, absolute_offset))
 
-    #pylint: disable=E1103
-    # Instance of 'list' has no 'splitlines' member (but some types
-    # could not be inferred)
-    lines = stdout.splitlines()
-    source = lines[1].split(":")
+            for i in xrange(0, len(requests), ADDR2LINE_CHUNK_SIZE):
+                self._resolve_chunk(executable, debuginfo_dir,
+                                    requests[i:i + ADDR2LINE_CHUNK_SIZE])
 
-    function_name = lines[0]
-    source_file = source[0]
-    line_number = source[1]
-    inlined = None
+        self._pending = {}
 
-    if " inlined at " in function_name:
-        function_name, inlined = parse_inlined(function_name)
+def retrace_symbol(binary_path, binary_offset, binary_dir, debuginfo_dir, absolute_offset=False):
+    '''
+    Handle actual retracing. Call eu-unstrip and eu-addr2line
+    on unpacked rpms. Use Symbolizer to retrace more offsets at once.
 
-    result = [(function_name, source_file, line_number)]
-    if inlined:
-        result.insert(0, inlined)
+    Returns list of tuples containing function, source code file and line or
+    None if retracing failed.
+    '''
 
-    return result
+    symbolizer = Symbolizer()
+    symbolizer.add(binary_path, binary_offset, binary_dir, debuginfo_dir,
+                   absolute_offset=absolute_offset)
+    symbolizer.resolve()
+    return symbolizer.get(binary_path, binary_offset, binary_dir, debuginfo_dir,
+                          absolute_offset=absolute_offset)
 
 def is_duplicate_source(session, source):
     '''
@@ -163,15 +297,42 @@ def is_duplicate_source(session, source):
 
     return False
 
-def retrace_symbol_wrapper(session, source, binary_dir, debuginfo_dir):
+def mark_changed_reports(session, symbolsource_ids, chunk_size=500):
+    '''
+    Mark reports with frames pointing to the given symbol sources
+    as changed, so that the incremental clustering processes them
+    again, and remove the cached normalized threads of their backtraces.
+    '''
+    symbolsource_ids = list(symbolsource_ids)
+    for i in xrange(0, len(symbolsource_ids), chunk_size):
+        ids = ", ".join(str(int(ssid)) for ssid in symbolsource_ids[i:i + chunk_size])
+        session.execute("DELETE FROM {0} WHERE backtrace_id IN "
+                        "(SELECT backtrace_id FROM {1} WHERE symbolsource_id IN ({2}))" \
+                        .format(ReportBtThread.__tablename__,
+                                ReportBtFrame.__tablename__, ids))
+        session.execute("INSERT INTO {0} (report_id) "
+                        "SELECT DISTINCT b.report_id FROM {1} f "
+                        "JOIN {2} b ON b.id = f.backtrace_id "
+                        "WHERE f.symbolsource_id IN ({3}) AND "
+                        "      b.report_id NOT IN (SELECT report_id FROM {0})" \
+                        .format(ReportChanged.__tablename__,
+                                ReportBtFrame.__tablename__,
+                                ReportBacktrace.__tablename__, ids))
+
+def retrace_symbol_wrapper(session, source, binary_dir, debuginfo_dir, symbolizer=None):
     '''
     Handle database references. Delete old symbol with '??' if
     reference count is 1 and add new symbol if there is no such
-    symbol already.
+    symbol already. If `symbolizer` is given, the result is taken
+    from its already resolved offsets.
     '''
 
-    result = retrace_symbol(source.path, source.offset, binary_dir,
-        debuginfo_dir)
+    if symbolizer is None:
+        result = retrace_symbol(source.path, source.offset, binary_dir,
+            debuginfo_dir)
+    else:
+        result = symbolizer.get(source.path, source.offset, binary_dir,
+            debuginfo_dir)
 
     logging.info('Result: {0}'.format(result))
     if result is not None:
@@ -292,6 +453,8 @@ def retrace_symbol_wrapper(session, source, binary_dir, debuginfo_dir):
             session.add(symbol)
             source.symbol = symbol
 
+        mark_changed_reports(session, [source.id])
+
         if not is_duplicate_source(session, source):
             session.add(source)
 
@@ -304,6 +467,27 @@ def retrace_symbol_wrapper(session, source, binary_dir, debuginfo_dir):
 
         check_duplicate_backtraces(session, possible_duplicates)
 
+def get_debuginfo_packages(session, build_id):
+    '''
+    Find debuginfo packages with the build id in the build id table
+    or, for packages stored before it was filled, by their debug files.
+    '''
+
+    debuginfo_packages = (session.query(Package)
+        .join(PackageBuildId, Package.id == PackageBuildId.debuginfo_id)
+        .filter(PackageBuildId.build_id == build_id)
+        .order_by(Package.id)).all()
+    if debuginfo_packages:
+        return debuginfo_packages
+
+    # FEDORA/RHEL SPECIFIC
+    return (session.query(Package)
+        .join(PackageDependency)
+        .filter(
+            (PackageDependency.name == get_debug_file(build_id)) &
+            (PackageDependency.type == "PROVIDES")
+        )).all()
+
 def retrace_symbols(session):
     '''
     Find all Symbol Sources of Symbols that require retracing.
@@ -334,18 +518,9 @@ def retrace_symbols(session):
             continue
 
         # Find debuginfo and then binary package providing the build id.
-        # FEDORA/RHEL SPECIFIC
-        debuginfo_path = "/usr/lib/debug/.build-id/{0}/{1}.debug".format(
-            source.build_id[:2], source.build_id[2:])
+        logging.debug('Looking for: {0}'.format(source.build_id))
 
-        logging.debug('Looking for: {0}'.format(debuginfo_path))
-
-        debuginfo_packages = (session.query(Package)
-            .join(PackageDependency)
-            .filter(
-                (PackageDependency.name == debuginfo_path) &
-                (PackageDependency.type == "PROVIDES")
-            )).all()
+        debuginfo_packages = get_debuginfo_packages(session, source.build_id)
 
         logging.debug("Found {0} debuginfo packages".format(
             len(debuginfo_packages)))
@@ -418,9 +593,10 @@ def retrace_symbols(session):
                 source = conflict
 
             try:
-                binary_dir = package.unpack_rpm_to_tmp(
+                binary_unpacked = unpack_package(
                     binary_package.get_lob_path("package"),
-                    prefix="faf-symbol-retrace")
+                    get_unpack_key(binary_package),
+                    prefix="faf-symbol-retrace", paths=[source.path])
             except Exception, e:
                 logging.error("Unable to extract binary package RPM: {0},"
                     " path: {1}, reason: {2}".format(binary_package.nvra(),
@@ -428,15 +604,22 @@ def retrace_symbols(session):
                 continue
 
             try:
-                debuginfo_dir = package.unpack_rpm_to_tmp(
+                debuginfo_unpacked = unpack_package(
                     debuginfo_package.get_lob_path("package"),
-                    prefix="faf-symbol-retrace")
-            except:
+                    get_unpack_key(debuginfo_package),
+                    prefix="faf-symbol-retrace",
+                    paths=[get_debug_file(source.build_id)],
+                    prefixes=[DWZ_DIR])
+            except Exception, e:
+                binary_unpacked.release()
                 logging.error("Unable to extract debuginfo RPM: {0},"
                     " path: {1}, reason: {2}".format(debuginfo_package.nvra(),
                     debuginfo_package.get_lob_path("package"), e))
                 continue
 
+            binary_dir = binary_unpacked.path
+            debuginfo_dir = debuginfo_unpacked.path
+
             logging.debug("Binary package RPM: {0},"
                 " path: {1}".format(binary_package.nvra(),
                 binary_package.get_lob_path("package")))
@@ -451,23 +634,31 @@ def retrace_symbols(session):
         if not packages_found:
             continue
 
-        retrace_symbol_wrapper(session, source, binary_dir, debuginfo_dir)
-
+        sources = [source]
         while (symbol_sources and
             symbol_sources[-1].build_id == source.build_id and
             symbol_sources[-1].path == source.path):
 
             logging.debug("Reusing extracted directories")
-            retraced += 1
-            source = symbol_sources.pop()
-            logging.info('[{0}/{1}] Retracing {2} with offset {3}'.format(
-                retraced, total, source.path, source.offset))
+            sources.append(symbol_sources.pop())
+
+        # Retrace all offsets in the binary at once.
+        symbolizer = Symbolizer()
+        for source in sources:
+            symbolizer.add(source.path, source.offset, binary_dir, debuginfo_dir)
+        symbolizer.resolve()
+
+        for i, source in enumerate(sources):
+            if i > 0:
+                retraced += 1
+                logging.info('[{0}/{1}] Retracing {2} with offset {3}'.format(
+                    retraced, total, source.path, source.offset))
 
             retrace_symbol_wrapper(session, source, binary_dir,
-                debuginfo_dir)
+                debuginfo_dir, symbolizer=symbolizer)
 
-        shutil.rmtree(binary_dir)
-        shutil.rmtree(debuginfo_dir)
+        binary_unpacked.release()
+        debuginfo_unpacked.release()
 
 def check_duplicate_backtraces(session, bts):
     '''
@@ -526,17 +717,23 @@ Task format:
                  "package": <pyfaf.storage.Package object>,
                  "nvra": "glibc-debuginfo-2.12-1.89.el6.x86_64",
                  "rpm_path": "/var/spool/faf/lob/Package/package/00/00/1",
+                 "unpack_key": "1-1048576-1356994800",
+                 "paths": set(["/usr/lib/debug/.build-id/0b/a1c2d3e4f5.debug"]),
+                 "prefixes": ["/usr/lib/debug/.dwz"],
                },
   "source":    {
                  "package": <pyfaf.storage.Package object>,
                  "nvra": "glibc-2.12-1.89.el6.src",
                  "rpm_path": "/var/spool/faf/lob/Package/package/00/00/0",
+                 "prefixes": None,
                },
   "packages":  [
                  {
                    "package": <pyfaf.storage.Package object>,
                    "nvra": "glibc-2.12-1.89.el6.x86_64",
                    "rpm_path": "/var/spool/faf/lob/Package/package/00/00/2",
+                   "unpack_key": "2-524288-1356994800",
+                   "paths": set(["/lib64/libc.so.6"]),
                    "symbols": set([<pyfaf.storage.SymbolSource object>,
                                    <pyfaf.storage.SymbolSource object>,
                                    <pyfaf.storage.SymbolSource object>]),
@@ -545,6 +742,8 @@ Task format:
                    "package": <pyfaf.storage.Package object>,
                    "nvra": "glibc-common-2.12-1.89.el6.x86_64",
                    "rpm_path": "/var/spool/faf/lob/Package/package/00/00/3",
+                   "unpack_key": "3-262144-1356994800",
+                   "paths": set(["/usr/bin/iconv"]),
                    "symbols": set([<pyfaf.storage.SymbolSource object>,
                                    <pyfaf.storage.SymbolSource object>,
                                    <pyfaf.storage.SymbolSource object>]),
@@ -556,7 +755,11 @@ pyfaf.storage objects are not thread-safe,
 do not access them in FafAsyncRpmUnpacker!!!
 
 FafAsyncRpmUnpacker adds "unpacked_path" field to each
-package (including source and debuginfo)
+package (including source and debuginfo). Debuginfo and binary
+packages are unpacked through the unpack cache and get also
+"unpacked" field with the UnpackedRpm, which retrace_task releases.
+Only the files listed in "paths" and below "prefixes" are
+extracted, None in both means the whole package.
 """
 
 def get_function_offset_map(kernel_debuginfo_dir):
@@ -587,10 +790,6 @@ def get_function_offset_map(kernel_debuginfo_dir):
 
     return result
 
-def get_debug_file(build_id):
-    return "/usr/lib/debug/.build-id/{0}/{1}.debug".format(build_id[:2],
-                                                           build_id[2:])
-
 def walk(directory):
     """
     Walks the directory and its subdirectories
@@ -683,6 +882,64 @@ def read_source_snippets(srcfile, line):
 
     return pre_line, exact_line, post_line
 
+def get_unpack_key(pkg):
+    """
+    Returns key of the package in the unpack cache. The size and
+    modification time of the lob identify its content.
+    """
+    stat = os.stat(pkg.get_lob_path("package"))
+    return "{0}-{1}-{2}".format(pkg.id, stat.st_size, int(stat.st_mtime))
+
+def unpack_package(rpm_path, unpack_key, prefix, paths=None, prefixes=None):
+    """
+    Unpacks the package through the unpack cache, only the files
+    with the paths and below the prefixes if given. Returns
+    UnpackedRpm, which must be released when the unpacked files
+    are not needed.
+    """
+    return package.get_unpack_cache().acquire(unpack_key, rpm_path,
+                                              prefix=prefix, paths=paths,
+                                              prefixes=prefixes)
+
+def get_kernel_debug_files(db, debuginfo, modules):
+    """
+    Returns set of paths of vmlinux and debug files of the kernel
+    modules in the kernel debuginfo package or None if they are
+    not known.
+    """
+    filenames = set()
+    for module in modules:
+        if module == "vmlinux":
+            filenames.add("vmlinux")
+        else:
+            filenames.add("{0}.ko.debug".format(module))
+            filenames.add("{0}.ko.debug".format(module.replace("_", "-")))
+
+    result = set()
+    for (name,) in db.session.query(PackageDependency.name) \
+                             .filter((PackageDependency.package_id == debuginfo.id) &
+                                     (PackageDependency.type == "PROVIDES") &
+                                     (PackageDependency.name.like("/%"))):
+        if name.rsplit("/", 1)[1] in filenames:
+            result.add(name)
+
+    if not result:
+        return None
+
+    return result
+
+def get_userspace_debug_files(symbols):
+    """
+    Returns set of paths of the .build-id links to debug files of the
+    symbols in a userspace debuginfo package or None if the build ids
+    are not known. The links are followed when extracted.
+    """
+    build_ids = set(symbol.build_id for symbol in symbols)
+    if not build_ids or None in build_ids:
+        return None
+
+    return set(get_debug_file(build_id) for build_id in build_ids)
+
 class FafAsyncRpmUnpacker(threading.Thread):
     """
     Unpacks RPMs asynchronously. Operates on tasks described above.
@@ -696,9 +953,13 @@ class FafAsyncRpmUnpacker(threading.Thread):
         task = self.inqueue.popleft()
         logging.info("{0} unpacking {1}".format(self.name,
                                                 task["debuginfo"]["nvra"]))
-        task["debuginfo"]["unpacked_path"] = \
-                package.unpack_rpm_to_tmp(task["debuginfo"]["rpm_path"],
-                                          prefix=task["debuginfo"]["nvra"])
+        task["debuginfo"]["unpacked"] = \
+                unpack_package(task["debuginfo"]["rpm_path"],
+                               task["debuginfo"]["unpack_key"],
+                               prefix=task["debuginfo"]["nvra"],
+                               paths=task["debuginfo"]["paths"],
+                               prefixes=task["debuginfo"]["prefixes"])
+        task["debuginfo"]["unpacked_path"] = task["debuginfo"]["unpacked"].path
         if task["debuginfo"]["nvra"].startswith("kernel-"):
             logging.info("Generating function offset map for kernel modules")
             task["function_offset_map"] = \
@@ -707,7 +968,8 @@ class FafAsyncRpmUnpacker(threading.Thread):
         logging.info("{0} unpacking {1}".format(self.name, task["source"]["nvra"]))
         task["source"]["unpacked_path"] = \
                 package.unpack_rpm_to_tmp(task["source"]["rpm_path"],
-                                          prefix=task["source"]["nvra"])
+                                          prefix=task["source"]["nvra"],
+                                          prefixes=task["source"]["prefixes"])
 
         if not task["source"]["nvra"].startswith("kernel-debuginfo-common"):
             specfile = None
@@ -741,9 +1003,9 @@ class FafAsyncRpmUnpacker(threading.Thread):
                 pkg["unpacked_path"] = task["debuginfo"]["unpacked_path"]
                 continue
 
-            pkg["unpacked_path"] = \
-                    package.unpack_rpm_to_tmp(pkg["rpm_path"],
-                                              prefix=pkg["nvra"])
+            pkg["unpacked"] = unpack_package(pkg["rpm_path"], pkg["unpack_key"],
+                                             prefix=pkg["nvra"], paths=pkg["paths"])
+            pkg["unpacked_path"] = pkg["unpacked"].path
         self.outqueue.put(task)
 
     def run(self):
@@ -757,61 +1019,105 @@ class FafAsyncRpmUnpacker(threading.Thread):
                 logging.error("{0}: {1}".format(self.name, str(ex)))
                 break
 
+def get_kernel_debuginfo(db, build_id):
+    """
+    Returns kernel debuginfo package for kernel build id
+    or None if it is not available.
+    """
+    try:
+        version, release, arch, flavour = parse_kernel_build_id(build_id)
+    except Exception as ex:
+        logging.error(str(ex))
+        return None
+
+    logging.debug("Version = {0}; Release = {1}; Arch = {2}; Flavour = {3}" \
+                  .format(version, release, arch, flavour))
+    pkgname = "kernel"
+    if not flavour is None:
+        pkgname = "kernel-{0}".format(flavour)
+
+    debugpkgname = "{0}-debuginfo".format(pkgname)
+    debuginfo = db.session.query(Package) \
+                          .join(Build) \
+                          .join(Arch) \
+                          .filter((Package.name == debugpkgname) &
+                                  (Build.version == version) &
+                                  (Build.release == release) &
+                                  (Arch.name == arch)) \
+                          .first()
+    if not debuginfo:
+        logging.debug("Matching kernel debuginfo not found")
+        return None
+
+    if not os.path.isfile(debuginfo.get_lob_path("package")):
+        logging.debug("Package metadata found, but the actual package "
+                      "is not available in storage.")
+        return None
+
+    return debuginfo
+
+def get_path_fixes(path):
+    """
+    Returns list of paths to look for a binary in packages:
+    the path itself, the normalized path (AbsPath fix) and
+    the normalized path with /usr added or stripped (UsrMove fix).
+    """
+    abspath = os.path.abspath(path)
+    if abspath.startswith("/usr"):
+        newpath = abspath[4:]
+    else:
+        newpath = "/usr{0}".format(abspath)
+
+    result = [path]
+    for fixed in [abspath, newpath]:
+        if fixed not in result:
+            result.append(fixed)
+
+    return result
+
 def prepare_debuginfo_map(db):
     """
     Prepares the mapping debuginfo ~> packages ~> symbols
     """
     result = {}
     symbolsources = db.session.query(SymbolSource) \
-                              .filter(SymbolSource.source_path == None).all()
-    todelete = set()
-    total = len(symbolsources)
-    i = 0
+                              .filter(SymbolSource.source_path == None) \
+                              .order_by(SymbolSource.id) \
+                              .all()
+    logging.info("Processing {0} symbol sources".format(len(symbolsources)))
+
+    # Type of reports with frames pointing to the symbol sources
+    report_types = {}
+    for symbolsource_id, report_type in \
+            db.session.query(ReportBtFrame.symbolsource_id, Report.type) \
+                      .join(ReportBacktrace) \
+                      .join(Report) \
+                      .filter(ReportBtFrame.symbolsource_id.in_(
+                          db.session.query(SymbolSource.id)
+                                    .filter(SymbolSource.source_path == None))) \
+                      .distinct():
+        report_types.setdefault(symbolsource_id, report_type.lower())
+
+    kernel_debuginfos = {}
+    userspace = []
     for symbolsource in symbolsources:
-        i += 1
-        try:
-            if not symbolsource.symbol:
-                logging.info("Empty symbol for symbolsource #{0} @ '{1}'" \
-                              .format(symbolsource.id, symbolsource.path))
-                continue
-        except:
+        if symbolsource.symbol_id is None:
+            logging.debug("Empty symbol for symbolsource #{0} @ '{1}'" \
+                          .format(symbolsource.id, symbolsource.path))
             continue
 
-        logging.info("[{0}/{1}] Processing {2} @ '{3}'" \
-                     .format(i, total, symbolsource.symbol.name, symbolsource.path))
-        if not symbolsource.frames:
-            logging.info("No frames found")
+        if not symbolsource.id in report_types:
+            logging.debug("No frames found for symbolsource #{0}" \
+                          .format(symbolsource.id))
             continue
 
-        if symbolsource.frames[0].backtrace.report.type.lower() == "kerneloops":
-            try:
-                version, release, arch, flavour = parse_kernel_build_id(symbolsource.build_id)
-            except Exception as ex:
-                logging.error(str(ex))
-                continue
-
-            logging.debug("Version = {0}; Release = {1}; Arch = {2}; Flavour = {3}" \
-                          .format(version, release, arch, flavour))
-            pkgname = "kernel"
-            if not flavour is None:
-                pkgname = "kernel-{0}".format(flavour)
-
-            debugpkgname = "{0}-debuginfo".format(pkgname)
-            debuginfo = db.session.query(Package) \
-                                  .join(Build) \
-                                  .join(Arch) \
-                                  .filter((Package.name == debugpkgname) &
-                                          (Build.version == version) &
-                                          (Build.release == release) &
-                                          (Arch.name == arch)) \
-                                  .first()
-            if not debuginfo:
-                logging.debug("Matching kernel debuginfo not found")
-                continue
+        if report_types[symbolsource.id] == "kerneloops":
+            if not symbolsource.build_id in kernel_debuginfos:
+                kernel_debuginfos[symbolsource.build_id] = \
+                        get_kernel_debuginfo(db, symbolsource.build_id)
 
-            if not os.path.isfile(debuginfo.get_lob_path("package")):
-                logging.debug("Package metadata found, but the actual package "
-                              "is not available in storage.")
+            debuginfo = kernel_debuginfos[symbolsource.build_id]
+            if debuginfo is None:
                 continue
 
             if not debuginfo in result:
@@ -822,98 +1128,121 @@ def prepare_debuginfo_map(db):
                 result[debuginfo][debuginfo] = set()
 
             result[debuginfo][debuginfo].add(symbolsource)
-
             continue
 
-        if symbolsource.frames[0].backtrace.report.type.lower() != "userspace":
-            logging.info("Skipping non-userspace symbol")
+        if report_types[symbolsource.id] != "userspace":
+            logging.debug("Skipping non-userspace symbol")
             continue
 
         if symbolsource.build_id is None:
-            logging.info("No build-id available")
+            logging.debug("No build-id available")
             continue
 
-        debug_file = get_debug_file(symbolsource.build_id)
-        debuginfos = db.session.query(Package) \
-                               .join(PackageDependency) \
-                               .filter((PackageDependency.name == debug_file) &
-                                       (PackageDependency.type == "PROVIDES")) \
-                               .all()
-        logging.debug("Found {0} debuginfo packages".format(len(debuginfos)))
-        for debuginfo in debuginfos:
-            package = db.session.query(Package) \
-                                .join(PackageDependency) \
-                                .filter((PackageDependency.name == symbolsource.path) &
-                                        (Package.arch == debuginfo.arch) &
-                                        (Package.build_id == debuginfo.build_id)) \
-                                .first()
-            if not package:
-                logging.debug("Trying AbsPath fix")
-                abspath = os.path.abspath(symbolsource.path)
-                if symbolsource.path != abspath:
-                    logging.info("Applying AbsPath fix")
-                    conflict = db.session.query(SymbolSource) \
-                                         .filter((SymbolSource.path == abspath) &
-                                                 (SymbolSource.offset == symbolsource.offset) &
-                                                 (SymbolSource.build_id == symbolsource.build_id)) \
-                                         .first()
-                    if conflict:
-                        db.session.execute("UPDATE {0} SET symbolsource_id = :newid " \
-                                           "WHERE symbolsource_id = :oldid" \
-                                           .format(ReportBtFrame.__tablename__),
-                                           {"oldid": symbolsource.id, "newid": conflict.id })
-                        todelete.add(symbolsource.id)
-                        db.session.expunge(symbolsource)
-                        symbolsource = conflict
-                    else:
-                        symbolsource.path = abspath
-
-                    package = db.session.query(Package) \
-                                        .join(PackageDependency) \
-                                        .filter((PackageDependency.name == symbolsource.path) &
-                                                (Package.arch == debuginfo.arch) &
-                                                (Package.build_id == debuginfo.build_id)) \
-                                        .first()
-
-            if not package:
-                logging.debug("Trying UsrMove fix")
-                if symbolsource.path.startswith("/usr"):
-                    newpath = symbolsource.path[4:]
-                else:
-                    newpath = "/usr{0}".format(symbolsource.path)
+        userspace.append(symbolsource)
+
+    # Debuginfo packages with the build ids and binary packages
+    # with the build ids when known
+    debuginfos = {}
+    binaries = {}
+    build_ids = set(symbolsource.build_id for symbolsource in userspace)
+    for build_ids_chunk in pyfaf.ureport.chunks(sorted(build_ids)):
+        for package_build_id, debuginfo in \
+                db.session.query(PackageBuildId, Package) \
+                          .join(Package, Package.id == PackageBuildId.debuginfo_id) \
+                          .filter(PackageBuildId.build_id.in_(build_ids_chunk)) \
+                          .order_by(Package.id):
+            debuginfos.setdefault(package_build_id.build_id, []).append(debuginfo)
+            if package_build_id.package_id is not None:
+                binaries.setdefault((debuginfo.build_id, debuginfo.arch_id,
+                                     package_build_id.path),
+                                    package_build_id.package_id)
+
+    # Packages stored before the build id table was filled
+    # are found by their debug files.
+    debug_files = dict((get_debug_file(build_id), build_id)
+                       for build_id in build_ids if build_id not in debuginfos)
+    for debug_files_chunk in pyfaf.ureport.chunks(sorted(debug_files)):
+        for debuginfo, debug_file in \
+                db.session.query(Package, PackageDependency.name) \
+                          .join(PackageDependency) \
+                          .filter((PackageDependency.name.in_(debug_files_chunk)) &
+                                  (PackageDependency.type == "PROVIDES")) \
+                          .order_by(Package.id):
+            debuginfos.setdefault(debug_files[debug_file], []).append(debuginfo)
+
+    # Packages from the builds of the debuginfo packages providing
+    # the binaries or their fixed paths, unless they are known
+    builds = set(debuginfo.build_id for packages in debuginfos.values()
+                 for debuginfo in packages)
+    arches = set(debuginfo.arch_id for packages in debuginfos.values()
+                 for debuginfo in packages)
+    paths = set()
+    for symbolsource in userspace:
+        fixes = get_path_fixes(symbolsource.path)
+        if not any((debuginfo.build_id, debuginfo.arch_id, path) in binaries
+                   for debuginfo in debuginfos.get(symbolsource.build_id, [])
+                   for path in fixes):
+            paths.update(fixes)
+
+    for paths_chunk in pyfaf.ureport.chunks(sorted(paths)):
+        for builds_chunk in pyfaf.ureport.chunks(sorted(builds)):
+            for package_id, build_id, arch_id, path in \
+                    db.session.query(Package.id, Package.build_id, Package.arch_id,
+                                     PackageDependency.name) \
+                              .join(PackageDependency) \
+                              .filter((PackageDependency.name.in_(paths_chunk)) &
+                                      (Package.build_id.in_(builds_chunk)) &
+                                      (Package.arch_id.in_(arches))) \
+                              .order_by(Package.id):
+                binaries.setdefault((build_id, arch_id, path), package_id)
+
+    packages = {}
+    for package_ids_chunk in pyfaf.ureport.chunks(sorted(set(binaries.values()))):
+        for binary in db.session.query(Package).filter(Package.id.in_(package_ids_chunk)):
+            packages[binary.id] = binary
+
+    lob_available = {}
+    def is_available(pkg):
+        if not pkg in lob_available:
+            lob_available[pkg] = os.path.isfile(pkg.get_lob_path("package"))
+        return lob_available[pkg]
 
-                package = db.session.query(Package) \
-                                    .join(PackageDependency) \
-                                    .filter((PackageDependency.name == newpath) &
-                                            (Package.arch == debuginfo.arch) &
-                                            (Package.build_id == debuginfo.build_id)) \
-                                    .first()
-                if package:
-                    logging.info("Applying UsrMove fix")
+    todelete = set()
+    renamed = {}
+    for symbolsource in userspace:
+        for debuginfo in debuginfos.get(symbolsource.build_id, []):
+            for path in get_path_fixes(symbolsource.path):
+                key = (debuginfo.build_id, debuginfo.arch_id, path)
+                if key in binaries:
+                    binary = packages[binaries[key]]
+                    break
+            else:
+                continue
+
+            if path != symbolsource.path:
+                logging.info("Fixing path {0} to {1}".format(symbolsource.path, path))
+                # renames are flushed at the end, the query does not see them
+                renamed_key = (symbolsource.build_id, path, symbolsource.offset)
+                conflict = renamed.get(renamed_key)
+                if conflict is None:
                     conflict = db.session.query(SymbolSource) \
-                                         .filter((SymbolSource.path == newpath) &
+                                         .filter((SymbolSource.path == path) &
                                                  (SymbolSource.offset == symbolsource.offset) &
                                                  (SymbolSource.build_id == symbolsource.build_id)) \
                                          .first()
-                    if conflict:
-                        db.session.execute("UPDATE {0} SET symbolsource_id = :newid " \
-                                           "WHERE symbolsource_id = :oldid" \
-                                           .format(ReportBtFrame.__tablename__),
-                                           {"oldid": symbolsource.id, "newid": conflict.id })
-                        todelete.add(symbolsource.id)
-                        db.session.expunge(symbolsource)
-                        symbolsource = conflict
-                    else:
-                        symbolsource.path = newpath
-
-            db.session.flush()
-
-            if not package:
-                logging.debug("Matching binary package not found")
-                continue
+                if conflict:
+                    db.session.execute("UPDATE {0} SET symbolsource_id = :newid " \
+                                       "WHERE symbolsource_id = :oldid" \
+                                       .format(ReportBtFrame.__tablename__),
+                                       {"oldid": symbolsource.id, "newid": conflict.id })
+                    todelete.add(symbolsource.id)
+                    db.session.expunge(symbolsource)
+                    symbolsource = conflict
+                else:
+                    symbolsource.path = path
+                    renamed[renamed_key] = symbolsource
 
-            if not os.path.isfile(package.get_lob_path("package")) or \
-               not os.path.isfile(debuginfo.get_lob_path("package")):
+            if not is_available(binary) or not is_available(debuginfo):
                 logging.debug("Package metadata found, but the actual package "
                               "is not available in storage.")
                 continue
@@ -921,13 +1250,14 @@ def prepare_debuginfo_map(db):
             if not debuginfo in result:
                 result[debuginfo] = {}
 
-            if not package in result[debuginfo]:
-                result[debuginfo][package] = set()
+            if not binary in result[debuginfo]:
+                result[debuginfo][binary] = set()
 
-            result[debuginfo][package].add(symbolsource)
+            result[debuginfo][binary].add(symbolsource)
             break
         else:
-            logging.warn("Unable to find a suitable package combination")
+            logging.warn("Unable to find a suitable package combination for "
+                         "symbolsource #{0}".format(symbolsource.id))
 
     db.session.flush()
     if todelete:
@@ -953,13 +1283,26 @@ def prepare_tasks(db, debuginfo_map):
     for debuginfo in debuginfo_map:
         packages = []
         for package in debuginfo_map[debuginfo]:
+            symbols = debuginfo_map[debuginfo][package]
             pkg_entry = { "package": package,
                           "nvra": package.nvra(),
                           "rpm_path": package.get_lob_path("package"),
-                          "symbols": debuginfo_map[debuginfo][package] }
+                          "unpack_key": get_unpack_key(package),
+                          "paths": set(symbol.path for symbol in symbols),
+                          "symbols": symbols }
             packages.append(pkg_entry)
 
+        # Only the debug files of the symbols are extracted: kernel modules
+        # from kernel debuginfo packages and the .build-id links (with their
+        # targets) from userspace ones. Kernel sources are extracted from
+        # kernel-debuginfo-common, source RPMs whole for rpmbuild -bp.
+        debuginfo_paths = None
+        debuginfo_prefixes = None
+        source_prefixes = None
         if debuginfo.name.startswith("kernel"):
+            debuginfo_paths = get_kernel_debug_files(db, debuginfo,
+                    set(symbol.path for symbol in debuginfo_map[debuginfo][debuginfo]))
+
             common = "kernel-debuginfo-common-{0}".format(debuginfo.arch.name)
             source = db.session.query(Package) \
                                .join(Arch) \
@@ -968,7 +1311,14 @@ def prepare_tasks(db, debuginfo_map):
                                        (Package.arch == debuginfo.arch) &
                                        (Package.name == common)) \
                                .one()
+            source_prefixes = [DEBUG_SOURCE_DIR]
         else:
+            debuginfo_paths = get_userspace_debug_files(
+                    symbol for symbols in debuginfo_map[debuginfo].values()
+                    for symbol in symbols)
+            if debuginfo_paths is not None:
+                debuginfo_prefixes = [DWZ_DIR]
+
             try:
                 source = db.session.query(Package) \
                                    .join(Arch) \
@@ -982,10 +1332,14 @@ def prepare_tasks(db, debuginfo_map):
 
         task = { "debuginfo": { "package": debuginfo,
                                 "nvra": debuginfo.nvra(),
-                                "rpm_path": debuginfo.get_lob_path("package") },
+                                "rpm_path": debuginfo.get_lob_path("package"),
+                                "unpack_key": get_unpack_key(debuginfo),
+                                "paths": debuginfo_paths,
+                                "prefixes": debuginfo_prefixes },
                  "source":    { "package": source,
                                 "nvra": source.nvra(),
-                                "rpm_path": source.get_lob_path("package") },
+                                "rpm_path": source.get_lob_path("package"),
+                                "prefixes": source_prefixes },
                  "packages":  packages }
 
         result.append(task)
@@ -997,16 +1351,18 @@ def retrace_task(db, task):
     Runs the retrace logic on a task and saves results to storage
     """
 
+    retraced = []
     for pkg in task["packages"]:
+        # Queue offsets of all symbols of the package first,
+        # so that every binary is processed only once.
+        symbolizer = Symbolizer()
+        pending = []
         for symbolsource in pkg["symbols"]:
-            normalized_path = get_libname(symbolsource.path)
-
             # userspace
             if symbolsource.path.startswith("/"):
-                result = retrace_symbol(symbolsource.path,
-                                        symbolsource.offset,
-                                        pkg["unpacked_path"],
-                                        task["debuginfo"]["unpacked_path"])
+                args = (symbolsource.path, symbolsource.offset,
+                        pkg["unpacked_path"], task["debuginfo"]["unpacked_path"],
+                        False)
             # kerneloops
             else:
                 filename = "vmlinux"
@@ -1045,12 +1401,18 @@ def retrace_task(db, task):
                     continue
 
                 offset = task["function_offset_map"][symbolsource.path][symbolsource.symbol.name]
-                result = retrace_symbol(dep.name,
-                                        symbolsource.offset + offset,
-                                        pkg["unpacked_path"],
-                                        task["debuginfo"]["unpacked_path"],
-                                        absolute_offset=True)
+                args = (dep.name, symbolsource.offset + offset,
+                        pkg["unpacked_path"], task["debuginfo"]["unpacked_path"],
+                        True)
+
+            symbolizer.add(*args)
+            pending.append((symbolsource, args))
+
+        symbolizer.resolve()
 
+        for symbolsource, args in pending:
+            normalized_path = get_libname(symbolsource.path)
+            result = symbolizer.get(*args)
             if result is None:
                 logging.warn("eu-unstrip failed")
                 continue
@@ -1183,6 +1545,7 @@ def retrace_task(db, task):
                 db.session.flush()
 
             symbolsource.symbol = symbol
+            retraced.append(symbolsource.id)
 
             logging.debug("Trying to read source snippet")
             srcfile = find_source_in_dir(symbolsource.source_path,
@@ -1202,19 +1565,14 @@ def retrace_task(db, task):
                 logging.debug("Source file not found")
 
         # pkg == debuginfo for kerneloops
-        if pkg["unpacked_path"] != task["debuginfo"]["unpacked_path"]:
-            logging.debug("Deleting {0}".format(pkg["unpacked_path"]))
-            # sometimes empty directories are write-only (e.g. ftp dropbox)
-            # they can't be listed, but can be deleted - just ignore the error
-            try:
-                shutil.rmtree(pkg["unpacked_path"])
-            except Exception as ex:
-                logging.error(str(ex))
+        if "unpacked" in pkg:
+            pkg["unpacked"].release()
+
+    mark_changed_reports(db.session, retraced)
 
     logging.debug("Deleting {0}".format(task["source"]["unpacked_path"]))
     shutil.rmtree(task["source"]["unpacked_path"])
 
-    logging.debug("Deleting {0}".format(task["debuginfo"]["unpacked_path"]))
-    shutil.rmtree(task["debuginfo"]["unpacked_path"])
+    task["debuginfo"]["unpacked"].release()
 
     db.session.flush()
@@ -0,0 +1,443 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+
+import pyfaf
+
+# Subdirectories of the report spool directory
+INCOMING = "incoming"
+SAVED = "saved"
+DEFERRED = "deferred"
+ATTACHMENTS = "attachments"
+
+def get_spool_dir():
+    return pyfaf.config.get("Report.SpoolDirectory")
+
+def async_submission():
+    '''
+    Return True if the hub should accept uReports without
+    waiting for the database.
+    '''
+    value = pyfaf.config.CONFIG.get("report.asyncsubmission", "False")
+    return value.lower() in ["true", "yes", "1"]
+
+def _fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_durable(dirname, data, fname=None):
+    '''
+    Write `data` to a new file in `dirname` and return its name.
+
+    The data are written to a hidden temporary file, synced to disk
+    and renamed, so the file is either complete or not present at all
+    even if the machine crashes. Hidden files are skipped by readers
+    of the spool directory.
+    '''
+    if fname is None:
+        fname = str(uuid.uuid4())
+
+    tmpname = os.path.join(dirname, ".{0}.tmp".format(fname))
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+    try:
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+        os.fsync(fd)
+    except:
+        os.close(fd)
+        os.unlink(tmpname)
+        raise
+
+    os.close(fd)
+    os.rename(tmpname, os.path.join(dirname, fname))
+    _fsync_dir(dirname)
+    return fname
+
+def save_report(data, spool_dir=None, durable=False):
+    '''
+    Store uReport `data` to the incoming directory or log
+    of the spool and return name of the created file or record.
+    '''
+    if spool_dir is None:
+        spool_dir = get_spool_dir()
+
+    if get_backend() == BACKEND_LOG:
+        position = get_log(INCOMING, spool_dir, durable=durable).append(data)
+        return record_name(position)
+
+    dirname = os.path.join(spool_dir, INCOMING)
+    if durable:
+        return write_durable(dirname, data)
+
+    fname = str(uuid.uuid4())
+    with open(os.path.join(dirname, fname), "w") as fil:
+        fil.write(data)
+
+    return fname
+
+# Spool backends
+BACKEND_DIRECTORY = "directory"
+BACKEND_LOG = "log"
+
+# Segmented logs are stored in the spool directory as <queue>.log
+LOG_SUFFIX = ".log"
+SEGMENT_SUFFIX = ".seg"
+STATE_FILE = "state"
+LOCK_FILE = "lock"
+
+# Default size in bytes and age in seconds of a log segment
+DEFAULT_SEGMENT_SIZE = 64 << 20
+DEFAULT_SEGMENT_AGE = 3600
+
+# Maximum length of a record header
+MAX_HEADER_LENGTH = 64
+
+def get_backend():
+    return pyfaf.config.CONFIG.get("report.spoolbackend", BACKEND_DIRECTORY).lower()
+
+class SpoolLog(object):
+    '''
+    Append-only log of records stored in numbered segment files.
+
+    Segments are named by their number and time of creation. Every
+    record is a header line with the length of the data and the unix
+    time of the report followed by the data and a newline:
+
+        <length> <time>\\n<data>\\n
+
+    A new segment is started when the last one reaches `segment_size`
+    bytes or is older than `segment_age` seconds and by the first
+    append of every writer, so that a record truncated by a crash of
+    the machine is never followed by other records in the same
+    segment. Appends are serialized by a lock file and a failed
+    append is truncated away.
+
+    A position in the log is a tuple of segment number and offset.
+    Readers keep the position of the first unprocessed record in a
+    state file, which is replaced atomically.
+    '''
+
+    def __init__(self, dirname, segment_size=None, segment_age=None,
+                 durable=False):
+        if segment_size is None:
+            segment_size = int(pyfaf.config.CONFIG.get("report.spoolsegmentsize",
+                                                       DEFAULT_SEGMENT_SIZE))
+        if segment_age is None:
+            segment_age = int(pyfaf.config.CONFIG.get("report.spoolsegmentage",
+                                                      DEFAULT_SEGMENT_AGE))
+
+        self.dirname = dirname
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.durable = durable
+        self._started = False
+        self._names = {}
+
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+
+    def segments(self):
+        '''
+        Return sorted list of numbers of the segments.
+        '''
+        self._names = {}
+        for fname in os.listdir(self.dirname):
+            if fname.endswith(SEGMENT_SUFFIX):
+                try:
+                    number, created = fname[:-len(SEGMENT_SUFFIX)].split("-")
+                    self._names[int(number)] = (fname, int(created))
+                except ValueError:
+                    continue
+
+        return sorted(self._names.keys())
+
+    def _segment_path(self, number):
+        if number not in self._names:
+            created = int(time.time())
+            fname = "{0:012d}-{1}{2}".format(number, created, SEGMENT_SUFFIX)
+            self._names[number] = (fname, created)
+
+        return os.path.join(self.dirname, self._names[number][0])
+
+    @staticmethod
+    def _read_header(fil):
+        line = fil.readline(MAX_HEADER_LENGTH)
+        if not line.endswith("\n"):
+            return None
+
+        try:
+            length, mtime = line.split()
+            return int(length), float(mtime), len(line)
+        except ValueError:
+            return None
+
+    def _segment_expired(self, number):
+        if os.path.getsize(self._segment_path(number)) >= self.segment_size:
+            return True
+
+        return time.time() - self._names[number][1] > self.segment_age
+
+    def _append_segment(self, segments):
+        '''
+        Return number of the segment to append to,
+        must be called with the lock held.
+        '''
+        if not segments:
+            return 1
+
+        last = segments[-1]
+        if not self._started or self._segment_expired(last):
+            if os.path.getsize(self._segment_path(last)) > 0:
+                return last + 1
+
+        return last
+
+    def append(self, data, mtime=None):
+        '''
+        Append `data` to the log and return position of the new record.
+        '''
+        if mtime is None:
+            mtime = time.time()
+
+        record = "{0} {1:.6f}\n{2}\n".format(len(data), mtime, data)
+
+        with open(os.path.join(self.dirname, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            segment = self._append_segment(self.segments())
+            path = self._segment_path(segment)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+            try:
+                offset = os.fstat(fd).st_size
+                try:
+                    while record:
+                        written = os.write(fd, record)
+                        record = record[written:]
+                    if self.durable:
+                        os.fsync(fd)
+                except:
+                    os.ftruncate(fd, offset)
+                    raise
+            finally:
+                os.close(fd)
+
+            if self.durable and offset == 0:
+                _fsync_dir(self.dirname)
+
+            self._started = True
+
+        return segment, offset
+
+    def read(self, position=None):
+        '''
+        Yield tuples of position, position of the next record, time
+        of the append and data of the records starting at `position`.
+        '''
+        segments = self.segments()
+        for number in segments:
+            offset = 0
+            if position is not None:
+                if number < position[0]:
+                    continue
+                if number == position[0]:
+                    offset = position[1]
+
+            with open(self._segment_path(number), "r") as fil:
+                fil.seek(offset)
+                while True:
+                    header = self._read_header(fil)
+                    if header is None:
+                        data = None
+                    else:
+                        length, mtime, header_length = header
+                        data = fil.read(length + 1)
+
+                    if data is None or len(data) != length + 1 or data[-1] != "\n":
+                        if fil.tell() > offset and number != segments[-1]:
+                            logging.warning("Skipping truncated record at {0} in {1}"
+                                            .format(offset, self._segment_path(number)))
+                        break
+
+                    next_offset = offset + header_length + length + 1
+                    yield (number, offset), (number, next_offset), mtime, data[:-1]
+                    offset = next_offset
+
+    def get_position(self, reader=STATE_FILE):
+        '''
+        Return position stored by `reader` or None.
+        '''
+        try:
+            with open(os.path.join(self.dirname, reader), "r") as fil:
+                state = json.load(fil)
+        except IOError:
+            return None
+
+        return state["segment"], state["offset"]
+
+    def set_position(self, position, reader=STATE_FILE):
+        '''
+        Store `position` of `reader` atomically.
+        '''
+        data = json.dumps({"segment": position[0], "offset": position[1]})
+        tmpname = os.path.join(self.dirname, ".{0}.tmp".format(reader))
+        with open(tmpname, "w") as fil:
+            fil.write(data)
+            fil.flush()
+            os.fsync(fil.fileno())
+
+        os.rename(tmpname, os.path.join(self.dirname, reader))
+        _fsync_dir(self.dirname)
+
+    def purge(self, position):
+        '''
+        Remove segments before the one of `position`.
+        '''
+        for number in self.segments():
+            if number >= position[0]:
+                break
+
+            logging.debug("Removing log segment {0}".format(self._segment_path(number)))
+            os.unlink(self._segment_path(number))
+
+_logs = {}
+
+def get_log(queue, spool_dir=None, durable=False):
+    '''
+    Return SpoolLog of `queue` (INCOMING, SAVED, DEFERRED)
+    in the spool directory.
+    '''
+    if spool_dir is None:
+        spool_dir = get_spool_dir()
+
+    dirname = os.path.join(spool_dir, queue + LOG_SUFFIX)
+    key = (dirname, durable)
+    if key not in _logs:
+        _logs[key] = SpoolLog(dirname, durable=durable)
+
+    return _logs[key]
+
+def get_queue_log(queue, spool_dir=None):
+    '''
+    Return SpoolLog of `queue` if the log backend is active or the log
+    exists, None otherwise. Records left in the log after switching
+    to the directory backend are still read only once.
+    '''
+    if spool_dir is None:
+        spool_dir = get_spool_dir()
+
+    if (get_backend() != BACKEND_LOG and
+        not os.path.isdir(os.path.join(spool_dir, queue + LOG_SUFFIX))):
+        return None
+
+    return get_log(queue, spool_dir)
+
+def move_entry(entry, queue):
+    '''
+    Move SpoolFile or SpoolRecord `entry` to `queue` of its spool,
+    to the log of the queue with the log backend.
+    '''
+    if get_backend() == BACKEND_LOG and entry.spool_dir:
+        get_log(queue, entry.spool_dir).append(entry.read(),
+                                               mtime=entry.get_mtime())
+        if entry.position is None:
+            os.unlink(entry.path)
+    else:
+        entry.move(queue)
+
+def finish_entries(log, entries):
+    '''
+    Remember the position in `log` after the processed `entries`
+    and remove the segments before it.
+    '''
+    positions = [entry.position for entry in entries if entry.position is not None]
+    if log and positions:
+        log.set_position(positions[-1])
+        log.purge(positions[-1])
+
+def record_name(position):
+    return "{0:012d}-{1:012d}".format(*position)
+
+class SpoolFile(object):
+    '''
+    uReport stored in a file of a spool directory.
+    '''
+
+    def __init__(self, path, spool_dir=None):
+        self.name = path
+        self.path = path
+        self.spool_dir = spool_dir
+        self.position = None
+
+    def read(self):
+        with open(self.path, "r") as fil:
+            return fil.read()
+
+    def get_mtime(self):
+        return os.stat(self.path).st_mtime
+
+    def move(self, queue):
+        '''
+        Move the file to the `queue` directory of the spool.
+        '''
+        if self.spool_dir is None:
+            return
+
+        target = os.path.join(self.spool_dir, queue, os.path.basename(self.path))
+        os.rename(self.path, target)
+
+class SpoolRecord(object):
+    '''
+    uReport stored in a record of a spool log.
+    '''
+
+    def __init__(self, log, position, next_position, mtime, data, spool_dir):
+        self.name = "{0}:{1}".format(log.dirname, record_name(position))
+        self.record = position
+        self.position = next_position
+        self.mtime = mtime
+        self.data = data
+        self.spool_dir = spool_dir
+
+    def read(self):
+        return self.data
+
+    def get_mtime(self):
+        return self.mtime
+
+    def move(self, queue):
+        '''
+        Append the record to the `queue` log of the spool.
+        '''
+        get_log(queue, self.spool_dir).append(self.data, mtime=self.mtime)
+
+def iter_queue(queue, spool_dir=None, position=None):
+    '''
+    Yield SpoolFile for every file in the `queue` directory
+    and SpoolRecord for every record of the `queue` log starting
+    at `position`, both layouts are read regardless of the backend.
+    '''
+    if spool_dir is None:
+        spool_dir = get_spool_dir()
+
+    dirname = os.path.join(spool_dir, queue)
+    if os.path.isdir(dirname):
+        for fname in sorted(os.listdir(dirname)):
+            if not fname.startswith("."):
+                yield SpoolFile(os.path.join(dirname, fname), spool_dir)
+
+    if os.path.isdir(os.path.join(spool_dir, queue + LOG_SUFFIX)):
+        log = get_log(queue, spool_dir)
+        for record_position, next_position, mtime, data in log.read(position):
+            yield SpoolRecord(log, record_position, next_position,
+                              mtime, data, spool_dir)
@@ -2,6 +2,7 @@ import sys
 import os
 import time
 import math
+import bisect
 import random
 import urllib2
 import tarfile
@@ -9,6 +10,8 @@ import itertools
 
 from datetime import datetime, timedelta
 
+from sqlalchemy import func
+
 import pyfaf
 from pyfaf import config
 from pyfaf.common import store_package_deps
@@ -367,6 +370,126 @@ class Generator(object):
                 report.last_occurence = last_occ
             self.commit()
 
+    def clustering_reports(self, count=10000, seed=0, batch_size=10000):
+        '''
+        Generate `count` reports with backtraces resembling real crashes
+        for benchmarks of clustering. The reports are variations of
+        crashes whose popularity follows a power law. The crashes share
+        frames of libc and use functions with a long tailed distribution.
+        The same count and seed always generate the same reports.
+        '''
+        rand = random.Random(seed)
+
+        def zipf_picker(items, exponent):
+            cumulative = []
+            total = 0.0
+            for rank in xrange(len(items)):
+                total += 1.0 / (rank + 1) ** exponent
+                cumulative.append(total)
+            return lambda: items[min(bisect.bisect(cumulative, rand.random() * total),
+                                     len(items) - 1)]
+
+        comps = self.ses.query(OpSysComponent).order_by(OpSysComponent.id).all()
+
+        libs = ['/usr/lib64/{0}.so.{1}'.format(lib, rand.randrange(0, 4))
+                for lib in data.LIBS]
+        funs = [('fun_{0}'.format(i), rand.choice(libs))
+                for i in xrange(max(1000, count / 10))]
+        pick_fun = zipf_picker(funs, 1.1)
+
+        libc = '/lib64/libc.so.6'
+        top_frames = [[('raise', libc), ('abort', libc)],
+                      [('__strlen_sse2', libc)],
+                      [('__GI___assert_fail', libc)],
+                      []]
+        pick_top = zipf_picker(top_frames, 1.0)
+
+        self.begin('Clustering reports')
+
+        # ids of symbol sources by function name (None if unknown) and path
+        sources = {}
+        symbol_id = (self.ses.query(func.max(Symbol.id)).scalar() or 0) + 1
+        source_id = (self.ses.query(func.max(SymbolSource.id)).scalar() or 0) + 1
+        symbol_rows = []
+        source_rows = []
+
+        def get_source(fun, path):
+            key = (fun, path)
+            if key not in sources:
+                symbol = None
+                if fun is not None:
+                    symbol = symbol_id + len(symbol_rows)
+                    symbol_rows.append({'id': symbol, 'name': fun,
+                                        'normalized_path': os.path.basename(path)})
+                sources[key] = source_id + len(source_rows)
+                source_rows.append({'id': sources[key], 'symbol_id': symbol,
+                                    'build_id': '{0:040x}'.format(rand.getrandbits(160)),
+                                    'path': path, 'offset': sources[key]})
+            return sources[key]
+
+        # crashes as lists of symbol source ids and their components
+        crashes = []
+        for i in xrange(max(10, count / 20)):
+            comp = rand.choice(comps)
+            binary = '/usr/bin/{0}'.format(comp.name)
+            frames = pick_top() + [pick_fun() for j in xrange(rand.randrange(3, 25))] + \
+                     [('main', binary), ('__libc_start_main', libc), ('_start', binary)]
+            crashes.append((comp.id, [get_source(fun, path) for fun, path in frames]))
+        pick_crash = zipf_picker(crashes, 1.0)
+
+        report_id = (self.ses.query(func.max(Report.id)).scalar() or 0) + 1
+        backtrace_id = (self.ses.query(func.max(ReportBacktrace.id)).scalar() or 0) + 1
+        now = datetime.now()
+
+        for start in xrange(0, count, batch_size):
+            report_rows = []
+            backtrace_rows = []
+            frame_rows = []
+            for i in xrange(start, min(start + batch_size, count)):
+                component_id, frames = pick_crash()
+
+                # vary the crash a little
+                frames = list(frames)
+                for j in xrange(len(frames)):
+                    toss = rand.random()
+                    if toss < 0.05:
+                        frames[j] = get_source(*pick_fun())
+                    elif toss < 0.08:
+                        frames[j] = get_source(None, libs[j % len(libs)])
+                if rand.random() < 0.1:
+                    del frames[rand.randrange(len(frames))]
+
+                occurence = now - timedelta(seconds=rand.randrange(0, 365 * 24 * 3600))
+                report_rows.append({'id': report_id, 'type': 'USERSPACE',
+                                    'count': rand.randrange(1, 20),
+                                    'first_occurence': occurence,
+                                    'last_occurence': occurence,
+                                    'component_id': component_id})
+                backtrace_rows.append({'id': backtrace_id, 'report_id': report_id})
+                for order, frame in enumerate(frames):
+                    frame_rows.append({'backtrace_id': backtrace_id, 'order': order,
+                                       'symbolsource_id': frame, 'inlined': False})
+
+                report_id += 1
+                backtrace_id += 1
+
+            if symbol_rows:
+                self.ses.execute(Symbol.__table__.insert(), symbol_rows)
+            if source_rows:
+                self.ses.execute(SymbolSource.__table__.insert(), source_rows)
+            symbol_id += len(symbol_rows)
+            source_id += len(source_rows)
+            del symbol_rows[:]
+            del source_rows[:]
+
+            self.ses.execute(Report.__table__.insert(), report_rows)
+            self.ses.execute(ReportBacktrace.__table__.insert(), backtrace_rows)
+            self.ses.execute(ReportBtFrame.__table__.insert(), frame_rows)
+            self.total_objs += len(report_rows) + len(backtrace_rows) + len(frame_rows)
+            print 'Generated {0}/{1} reports'.format(start + len(report_rows), count)
+
+        self.commit()
+
     def from_sql_file(self, fname):
         fname += '.sql'
         print 'Loading %s' % fname
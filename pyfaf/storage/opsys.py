@@ -234,3 +234,27 @@ class PackageDependency(GenericTable):
     version = Column(String(64), nullable=True)
     release = Column(String(64), nullable=True)
     package = relationship(Package, backref="dependencies")
+
+class PathComponent(GenericTable):
+    # Component of a package providing the file, maintained
+    # when packages are stored.
+    __tablename__ = "pathcomponents"
+
+    opsys_id = Column(Integer, ForeignKey("{0}.id".format(OpSys.__tablename__)), primary_key=True)
+    path = Column(String(1024), primary_key=True)
+    component_id = Column(Integer, ForeignKey("{0}.id".format(OpSysComponent.__tablename__)), nullable=False, index=True)
+    component = relationship(OpSysComponent)
+
+class PackageBuildId(GenericTable):
+    # Debug file of a build id in a debuginfo package and the binary
+    # package and path with the build id when known, maintained when
+    # packages are stored.
+    __tablename__ = "packagebuildids"
+
+    build_id = Column(String(64), primary_key=True)
+    debuginfo_id = Column(Integer, ForeignKey("{0}.id".format(Package.__tablename__)), primary_key=True)
+    debug_path = Column(String(1024), nullable=False)
+    package_id = Column(Integer, ForeignKey("{0}.id".format(Package.__tablename__)), nullable=True, index=True)
+    path = Column(String(1024), nullable=True)
+    debuginfo = relationship(Package, primaryjoin="Package.id==PackageBuildId.debuginfo_id")
+    package = relationship(Package, primaryjoin="Package.id==PackageBuildId.package_id")
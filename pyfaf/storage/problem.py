@@ -18,6 +18,7 @@ from . import ForeignKey
 from . import GenericTable
 from . import Integer
 from . import OpSysComponent
+from . import Text
 from . import relationship
 
 class ProblemComponent(GenericTable):
@@ -100,3 +101,13 @@ class Problem(GenericTable):
         """
 
         return sorted(self.reports, key=lambda report: report.count, reverse=True)
+
+class ProblemThread(GenericTable):
+    # Representative thread of a problem used by the incremental
+    # clustering, the normalized frames as "function library" lines.
+    __tablename__ = "problemthreads"
+
+    problem_id = Column(Integer, ForeignKey("{0}.id".format(Problem.__tablename__)), primary_key=True)
+    report_id = Column(Integer, ForeignKey("reports.id"), nullable=False, index=True)
+    thread = Column(Text, nullable=False)
+    problem = relationship(Problem)
@@ -33,6 +33,7 @@ from . import Problem
 from . import RhbzBug
 from . import String
 from . import SymbolSource
+from . import Text
 from . import UniqueConstraint
 from . import backref
 from . import relationship
@@ -345,3 +346,20 @@ class ReportRhbz(GenericTable):
     rhbzbug_id = Column(Integer, ForeignKey("{0}.id".format(RhbzBug.__tablename__)), primary_key=True)
     report = relationship(Report, backref="rhbz_bugs")
     rhbzbug = relationship(RhbzBug)
+
+class ReportChanged(GenericTable):
+    # Reports whose backtraces were changed by retracing
+    # since they were clustered.
+    __tablename__ = "reportchanged"
+
+    report_id = Column(Integer, ForeignKey("{0}.id".format(Report.__tablename__)), primary_key=True)
+
+class ReportBtThread(GenericTable):
+    # Normalized thread of a backtrace serialized for btparser.
+    # Rows are removed when retracing changes the backtrace.
+    __tablename__ = "reportbtthreads"
+
+    backtrace_id = Column(Integer, ForeignKey("{0}.id".format(ReportBacktrace.__tablename__)), primary_key=True)
+    report_id = Column(Integer, ForeignKey("{0}.id".format(Report.__tablename__)), nullable=False, index=True)
+    version = Column(Integer, nullable=False)
+    thread = Column(Text, nullable=False)
@@ -6,15 +6,16 @@ import datetime
 
 import os
 import pyfaf
+import btparser
 
+from sqlalchemy import text, select, bindparam, and_, or_
 from sqlalchemy.orm import joinedload_all
 
-from pyfaf.common import get_libname, cpp_demangle
+from pyfaf.common import get_libname, cpp_demangle, LRUCache
+from pyfaf.dimensions import dimension_cache
+from pyfaf.knownreports import known_reports
 
-from pyfaf.kb import (get_kb_btpath_parsers,
-                      get_kb_pkgname_parsers)
-
-from pyfaf.storage.kb import KbBacktracePath
+from pyfaf.kb import kb_matcher
 
 from pyfaf.storage.opsys import (OpSys,
                                  OpSysRelease,
@@ -22,7 +23,8 @@ from pyfaf.storage.opsys import (OpSys,
                                  Arch,
                                  Build,
                                  Package,
-                                 PackageDependency)
+                                 PackageDependency,
+                                 PathComponent)
 
 from pyfaf.storage.report import (Report,
                                   ReportArch,
@@ -36,6 +38,7 @@ from pyfaf.storage.report import (Report,
                                   ReportReason,
                                   ReportRhbz,
                                   ReportBacktrace,
+                                  ReportBtThread,
                                   ReportSelinuxMode,
                                   ReportSelinuxContext,
                                   ReportHistoryDaily,
@@ -330,65 +333,127 @@ def ureport2to1(ureport2):
 
     return ureport1
 
-def validate(obj, checker=UREPORT_CHECKER):
-    if (checker == UREPORT_CHECKER and
-        "ureport_version" in obj and
-        obj["ureport_version"] == 2):
-        obj = ureport2to1(obj)
+def _compile_checker(checker, compiled):
+    '''
+    Build a function validating an object against `checker`.
+    The function behaves exactly like walking the checker
+    recursively for every object, but all decisions depending
+    only on the checker are made here, once.
+    '''
+    if id(checker) in compiled:
+        return compiled[id(checker)]
 
     expected = dict
     if "type" in checker and isinstance(checker["type"], type):
         expected = checker["type"]
 
-    # check for expected type
-    if not isinstance(obj, expected):
-        raise Exception, "typecheck failed: expected {0}, had {1}; {2}".format(expected.__name__, type(obj).__name__, obj)
-
-    # str checks
-    if isinstance(obj, basestring):
-        if "re" in checker and checker["re"].match(obj) is None:
-            raise Exception, 'string "{0}" contains illegal characters'.format(obj)
-        if "trunc" in checker and len(obj) > checker["trunc"]:
-            obj = obj[:checker["trunc"]]
-        if "maxlen" in checker and len(obj) > checker["maxlen"]:
-            raise Exception, 'string "{0}" is too long (maximum {1})'.format(obj, checker["maxlen"])
-    # list - apply checker["checker"] to every element
-    elif isinstance(obj, list):
-        obj = [validate(elem, checker["checker"]) for elem in obj]
-
-    # dict
-    elif isinstance(obj, dict):
-        # load the actual checker if we are not toplevel
+    def typecheck_failed(obj):
+        return Exception("typecheck failed: expected {0}, had {1}; {2}".format(
+            expected.__name__, type(obj).__name__, obj))
+
+    if issubclass(expected, basestring):
+        regex = checker.get("re")
+        has_re = "re" in checker
+        trunc = checker.get("trunc")
+        has_trunc = "trunc" in checker
+        maxlen = checker.get("maxlen")
+        has_maxlen = "maxlen" in checker
+
+        def check(obj):
+            if not isinstance(obj, expected):
+                raise typecheck_failed(obj)
+            if has_re and regex.match(obj) is None:
+                raise Exception, 'string "{0}" contains illegal characters'.format(obj)
+            if has_trunc and len(obj) > trunc:
+                obj = obj[:trunc]
+            if has_maxlen and len(obj) > maxlen:
+                raise Exception, 'string "{0}" is too long (maximum {1})'.format(obj, maxlen)
+            return obj
+
+    elif issubclass(expected, list):
+        # resolved lazily, a broken checker only fails on a list
+        elem_check = []
+
+        def check(obj):
+            if not isinstance(obj, expected):
+                raise typecheck_failed(obj)
+            if not elem_check:
+                elem_check.append(_compile_checker(checker["checker"], compiled))
+            return [elem_check[0](elem) for elem in obj]
+
+    elif issubclass(expected, dict):
+        fields = checker
         if "checker" in checker:
-            checker = checker["checker"]
-
-        # need to clone, we are going to modify
-        clone = dict(obj)
-        obj = dict()
-        # validate each element separately
-        for key in checker:
-            subchkr = checker[key]
-            try:
-                value = clone.pop(key)
-            except KeyError:
-                # fail for mandatory elements
-                if subchkr["mand"]:
-                    raise Exception, "missing mandatory element '{0}'".format(key)
-                # just skip optional
-                continue
+            fields = checker["checker"]
+
+        # filled below, the checkers may be recursive
+        steps = []
+
+        def check(obj):
+            if not isinstance(obj, expected):
+                raise typecheck_failed(obj)
+
+            result = {}
+            for key, subchkr, subcheck in steps:
+                if key not in obj:
+                    # fail for mandatory elements
+                    if subchkr["mand"]:
+                        raise Exception, "missing mandatory element '{0}'".format(key)
+                    continue
+
+                try:
+                    result[key] = subcheck(obj[key])
+                except Exception, msg:
+                    raise Exception, "error validating '{0}': {1}".format(key, msg)
+
+            # excessive elements - error, with the keys
+            # listed in the order of the unvalidated clone
+            if len(result) != len(obj):
+                clone = dict(obj)
+                for key in fields:
+                    clone.pop(key, None)
+                raise Exception, "unknown elements present: {0}".format(clone.keys())
+
+            return result
 
-            try:
-                obj[key] = validate(value, subchkr)
-            except Exception, msg:
-                # queue error messages
-                raise Exception, "error validating '{0}': {1}".format(key, msg)
+    else:
+        def check(obj):
+            if not isinstance(obj, expected):
+                raise typecheck_failed(obj)
+            return obj
 
-        # excessive elements - error
-        keys = clone.keys()
-        if keys:
-            raise Exception, "unknown elements present: {0}".format(keys)
+    compiled[id(checker)] = check
+    if issubclass(expected, dict):
+        for key in fields:
+            steps.append((key, fields[key], _compile_checker(fields[key], compiled)))
 
-    return obj
+    return check
+
+# compiled validators, keyed by id of the checker
+_compiled_checkers = {}
+
+def compile_checker(checker):
+    '''
+    Return a validation function for `checker`. The checkers
+    are compiled once and must not be modified afterwards.
+    '''
+    if id(checker) not in _compiled_checkers:
+        compiled = {}
+        _compile_checker(checker, compiled)
+        _compiled_checkers[id(checker)] = (checker, compiled[id(checker)])
+
+    return _compiled_checkers[id(checker)][1]
+
+def validate(obj, checker=UREPORT_CHECKER):
+    if ((checker is UREPORT_CHECKER or checker == UREPORT_CHECKER) and
+        "ureport_version" in obj and
+        obj["ureport_version"] == 2):
+        obj = ureport2to1(obj)
+
+    return compile_checker(checker)(obj)
+
+compile_checker(UREPORT_CHECKER)
+compile_checker(ATTACHMENT_CHECKER)
 
 def get_crash_thread(ureport):
     result = []
@@ -422,35 +487,27 @@ def hash_thread(thread, hashbase=[], include_offset=False):
     return (hashtype, hashlib.sha1("\n".join(hashbase)).hexdigest())
 
 def get_package(ureport_package, ureport_os, db):
-    return db.session.query(Package).join(Package.arch).join(Package.build).\
-            join(Build.component).join(OpSysComponent.opsysreleases).\
-            join(OpSysRelease.opsys).\
-            filter((Package.name == ureport_package["name"]) & \
-                   (Build.epoch == ureport_package["epoch"]) & \
-                   (Build.version == ureport_package["version"]) & \
-                   (Build.release == ureport_package["release"]) & \
-                   (Arch.name == ureport_package["architecture"]) & \
-                   (OpSys.name == ureport_os["name"]) & \
-                   (OpSysRelease.version == ureport_os["version"])).first()
+    return dimension_cache.get_package(db, ureport_package, ureport_os)
 
 def get_component(component_name, ureport_os, db):
-    return db.session.query(OpSysComponent).join(OpSys).\
-            join(OpSysRelease).\
-            filter((OpSysComponent.name == component_name) & \
-                   (OpSys.name == ureport_os["name"]) & \
-                   (OpSysRelease.version == ureport_os["version"])).first()
+    return dimension_cache.get_component(db, component_name, ureport_os["name"],
+                                         ureport_os["version"])
 
 def guess_component(ureport_package, ureport_os, db):
-    # Find a package only by name.
-    pkg = db.session.query(Package).join(Package.build).\
-            join(Build.component).join(OpSysComponent.opsysreleases).\
-            join(OpSysRelease.opsys).\
-            filter((Package.name == ureport_package["name"]) & \
-                   (OpSys.name == ureport_os["name"]) & \
-                   (OpSysRelease.version == ureport_os["version"])).first()
-    if pkg:
-        return pkg.build.component
-    return None
+    return dimension_cache.guess_component(db, ureport_package, ureport_os)
+
+def get_opsysrelease(ureport_os, db):
+    opsysrelease = dimension_cache.get_opsysrelease(db, ureport_os["name"],
+                                                    ureport_os["version"])
+    if opsysrelease is None:
+        raise Exception, "Unknown operating system release."
+    return opsysrelease
+
+def get_arch(name, db):
+    arch = dimension_cache.get_arch(db, name)
+    if arch is None:
+        raise Exception, "Unknown architecture."
+    return arch
 
 def guess_component_paths(path):
     # Return list of paths which could belong to the same component as path
@@ -480,15 +537,14 @@ def get_report_hash(ureport, component):
     return hash_thread(cthread, hashbase=[component],
                        include_offset=include_offset)
 
-def get_unknownpackage_spec(type, ureport_packages, db):
+def get_unknownpackage_spec(type, ureport_packages, db, batch=None):
     ureport_installed_package = ureport_packages["installed_package"]
     result = [("type", type),
               ("name", ureport_installed_package["name"]),
               ("installed_epoch", ureport_installed_package["epoch"]),
               ("installed_version", ureport_installed_package["version"]),
               ("installed_release", ureport_installed_package["release"]),
-              ("installed_arch", db.session.query(Arch).\
-                      filter(Arch.name == ureport_installed_package["architecture"]).one())]
+              ("installed_arch", get_arch(ureport_installed_package["architecture"], db))]
 
     if "running_package" in ureport_packages:
         ureport_running_package = ureport_packages["running_package"]
@@ -497,8 +553,7 @@ def get_unknownpackage_spec(type, ureport_packages, db):
         result.extend([("running_epoch", ureport_running_package["epoch"]),
                        ("running_version", ureport_running_package["version"]),
                        ("running_release", ureport_running_package["release"]),
-                       ("running_arch", db.session.query(Arch).\
-                               filter(Arch.name == ureport_running_package["architecture"]).one())])
+                       ("running_arch", get_arch(ureport_running_package["architecture"], db))])
     else:
         result.extend([("running_epoch", None),
                        ("running_version", None),
@@ -507,10 +562,15 @@ def get_unknownpackage_spec(type, ureport_packages, db):
 
     return result
 
-def get_package_stat(package_type, ureport_packages, ureport_os, db):
-    installed_package = get_package(ureport_packages["installed_package"], ureport_os, db)
+def get_package_stat(package_type, ureport_packages, ureport_os, db, batch=None):
+    if batch:
+        get = lambda package: batch.get_package(package, ureport_os)
+    else:
+        get = lambda package: get_package(package, ureport_os, db)
+
+    installed_package = get(ureport_packages["installed_package"])
     if "running_package" in ureport_packages:
-        running_package = get_package(ureport_packages["running_package"], ureport_os, db)
+        running_package = get(ureport_packages["running_package"])
     else:
         running_package = None
 
@@ -525,7 +585,7 @@ def get_package_stat(package_type, ureport_packages, ureport_os, db):
                                 ("running_package", running_package)])
     else:
         return (ReportUnknownPackage,
-                get_unknownpackage_spec(package_type, ureport_packages, db))
+                get_unknownpackage_spec(package_type, ureport_packages, db, batch=batch))
 
 def flip_corebt_if_necessary(ureport):
     # only python needs flipping
@@ -558,35 +618,594 @@ def flip_corebt_if_necessary(ureport):
         frame["frame"] = threads[frame["thread"]] - frame["frame"]
 
 def find_ureport_kb_solution(ureport, db, opsys_id=None):
-    btpath_parsers = get_kb_btpath_parsers(db, opsys_id=opsys_id)
-    for parser in btpath_parsers:
-        for frame in ureport["core_backtrace"]:
-            if "path" in frame and parser.match(frame["path"]):
-                return btpath_parsers[parser]
+    paths = [frame["path"] for frame in ureport["core_backtrace"] if "path" in frame]
 
     pkg = ureport["installed_package"]
     nvra = "{0}-{1}-{2}.{3}".format(pkg["name"], pkg["version"],
                                     pkg["release"], pkg["architecture"])
-    pkgname_parsers = get_kb_pkgname_parsers(db, opsys_id=opsys_id)
-    for parser in pkgname_parsers:
-        if parser.match(nvra):
-            return pkgname_parsers[parser]
 
-    return None
+    return kb_matcher.find_solution(db, paths, [nvra], opsys_id=opsys_id)
+
+# Tables updated in the stat_map loop of add_report
+STAT_TABLES = [ReportArch,
+               ReportOpSysRelease,
+               ReportReason,
+               ReportHistoryMonthly,
+               ReportHistoryWeekly,
+               ReportHistoryDaily,
+               ReportExecutable,
+               ReportUptime,
+               ReportPackage,
+               ReportUnknownPackage,
+               ReportSelinuxMode,
+               ReportSelinuxContext,
+               ReportKernelTaintState]
+
+# Maximum number of values in a single IN clause
+IN_CHUNK_SIZE = 500
+
+# Maximum number of remembered path to component lookups
+PATH_COMPONENT_CACHE_SIZE = 100000
+
+path_component_cache = LRUCache(PATH_COMPONENT_CACHE_SIZE)
+
+# Operating system ids mapped to whether their path to component map is filled
+path_components_filled = dict()
+
+# Version of the normalized threads stored in ReportBtThread,
+# threads of other versions are created again
+BT_THREAD_VERSION = 1
+
+def chunks(values, size=IN_CHUNK_SIZE):
+    values = list(values)
+    for i in xrange(0, len(values), size):
+        yield values[i:i + size]
+
+def get_stat_dims(table):
+    # Return names of the columns identifying a stat row of the report.
+    return [column.name for column in table.__table__.columns
+            if column.name not in ("id", "report_id", "count")]
+
+def get_stat_values(table, cols):
+    # Convert stat_map (name, value) pairs to a column name -> value dict.
+    result = {}
+    for name, value in cols:
+        if "{0}_id".format(name) in table.__table__.c:
+            name = "{0}_id".format(name)
+            if value is not None:
+                value = value.id
+        result[name] = value
+    return result
 
-def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, return_report=False):
-    if not utctime:
-        utctime = datetime.datetime.utcnow()
+# Maximum number of rows in a single multi-row INSERT
+UPSERT_CHUNK_SIZE = 500
+
+class StatsAccumulator(object):
+    '''
+    Aggregates increments of report statistics in memory, keyed
+    by (table, report_id, dimension values), and writes them with
+    a few bulk statements in `flush`.
+
+    Tables keyed by their columns are written with multi-row
+    INSERT ... ON CONFLICT DO UPDATE (PostgreSQL, SQLite)
+    or ON DUPLICATE KEY UPDATE (MySQL). Tables with a surrogate
+    key (ReportPackage, ReportUnknownPackage) have nullable columns
+    in their unique constraints that upserts can not match, so the
+    existing rows are selected at once and updated or inserted
+    with executemany.
+    '''
+
+    def __init__(self):
+        self._counts = {}
+        self._added = []
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, table, report, cols, count=1):
+        values = get_stat_values(table, cols)
+        key = (table, report.id,
+               tuple(values.get(dim) for dim in get_stat_dims(table)))
+        self._added.append((key, count))
+        self._counts[key] = self._counts.get(key, 0) + count
+
+    def commit(self):
+        self._added = []
+
+    def rollback(self):
+        for key, count in reversed(self._added):
+            self._counts[key] -= count
+            if not self._counts[key]:
+                del self._counts[key]
+        self._added = []
+
+    def flush(self, db):
+        '''
+        Write the accumulated increments to the database.
+        '''
+        db.session.flush()
+
+        tables = {}
+        for (table, report_id, dims), count in self._counts.items():
+            tables.setdefault(table, []).append((report_id, dims, count))
+
+        dialect = db.session.bind.dialect
+        for table, rows in tables.items():
+            if "id" in table.__table__.c or not self._can_upsert(dialect):
+                self._update_or_insert(db, table, rows)
+            else:
+                self._upsert(db, dialect, table, rows)
 
-    flip_corebt_if_necessary(ureport)
+        self._counts = {}
+        self._added = []
+
+    @staticmethod
+    def _can_upsert(dialect):
+        if dialect.name == "sqlite":
+            return dialect.dbapi.sqlite_version_info >= (3, 24, 0)
+
+        return dialect.name in ["postgresql", "mysql"]
+
+    def _upsert(self, db, dialect, table, rows):
+        quote = dialect.identifier_preparer.quote_identifier
+        columns = ["report_id"] + get_stat_dims(table)
+        names = ", ".join(quote(column) for column in columns + ["count"])
+        tablename = quote(table.__tablename__)
+        count = quote("count")
+
+        if dialect.name == "mysql":
+            suffix = "ON DUPLICATE KEY UPDATE {0} = {0} + VALUES({0})".format(count)
+        else:
+            suffix = "ON CONFLICT ({0}) DO UPDATE SET {1} = {2}.{1} + EXCLUDED.{1}"\
+                     .format(", ".join(quote(column) for column in columns),
+                             count, tablename)
+
+        for chunk in chunks(rows, UPSERT_CHUNK_SIZE):
+            params = {}
+            values = []
+            for i, (report_id, dims, inc) in enumerate(chunk):
+                row = [report_id] + list(dims) + [inc]
+                placeholders = []
+                for j, value in enumerate(row):
+                    name = "p{0}_{1}".format(i, j)
+                    params[name] = value
+                    placeholders.append(":{0}".format(name))
+                values.append("({0})".format(", ".join(placeholders)))
+
+            sql = "INSERT INTO {0} ({1}) VALUES {2} {3}".format(
+                tablename, names, ", ".join(values), suffix)
+            db.session.execute(text(sql), params)
+
+    def _update_or_insert(self, db, table, rows):
+        t = table.__table__
+        dims = get_stat_dims(table)
+        keyed = "id" in t.c
+
+        existing = set()
+        if keyed:
+            existing = {}
+            report_ids = set(report_id for report_id, _, _ in rows)
+            for chunk in chunks(report_ids):
+                query = select([t.c.id, t.c.report_id] + [t.c[name] for name in dims])\
+                        .where(t.c.report_id.in_(chunk))
+                for row in db.session.execute(query):
+                    existing[(row[1], tuple(row[2:]))] = row[0]
+        else:
+            for report_id, dims_values, _ in rows:
+                query = select([t.c.report_id]).where(t.c.report_id == report_id)
+                for dim, value in zip(dims, dims_values):
+                    query = query.where(t.c[dim] == value)
+                if db.session.execute(query).first():
+                    existing.add((report_id, dims_values))
+
+        updates = []
+        inserts = []
+        for report_id, dims_values, inc in rows:
+            key = (report_id, dims_values)
+            if key in existing:
+                if keyed:
+                    updates.append({"b_id": existing[key], "b_count": inc})
+                else:
+                    params = {"b_report_id": report_id, "b_count": inc}
+                    params.update(("b_{0}".format(dim), value)
+                                  for dim, value in zip(dims, dims_values))
+                    updates.append(params)
+            else:
+                values = {"report_id": report_id, "count": inc}
+                values.update(zip(dims, dims_values))
+                inserts.append(values)
 
+        if updates:
+            if keyed:
+                cond = t.c.id == bindparam("b_id")
+            else:
+                cond = t.c.report_id == bindparam("b_report_id")
+                for dim in dims:
+                    cond = cond & (t.c[dim] == bindparam("b_{0}".format(dim)))
+            db.session.execute(t.update().where(cond)
+                               .values(count=t.c.count + bindparam("b_count")),
+                               updates)
+
+        if inserts:
+            db.session.execute(t.insert(), inserts)
+
+# Maximum number of keys remembered by the symbol cache
+SYMBOL_CACHE_SIZE = 100000
+
+# Maximum number of natural keys looked up by a single query,
+# each key adds a term to the OR-ed condition
+KEY_CHUNK_SIZE = 100
+
+class SymbolCache(object):
+    '''
+    Resolves natural keys of symbol sources (build_id, path, offset)
+    and symbols (name, normalized_path) to database objects.
+
+    Ids of resolved objects are remembered across reports and
+    transactions in bounded LRU caches. The ids are not trusted
+    blindly, cached objects are loaded by a single query on primary
+    keys and their natural keys are checked again, so rows deleted or
+    rolled back in the meantime are just looked up again. Objects
+    created and not flushed yet are kept aside until they get an id.
+    '''
+
+    def __init__(self, size=SYMBOL_CACHE_SIZE):
+        self._ids = {SymbolSource: LRUCache(size), Symbol: LRUCache(size)}
+        self._pending = {SymbolSource: {}, Symbol: {}}
+
+    @staticmethod
+    def key(obj):
+        if isinstance(obj, SymbolSource):
+            return (obj.build_id, obj.path, obj.offset)
+
+        return (obj.name, obj.normalized_path)
+
+    def clear(self):
+        for table in self._ids:
+            self._ids[table].clear()
+            self._pending[table].clear()
+
+    def add(self, obj):
+        '''
+        Remember a newly created symbol source or symbol.
+        '''
+        self._pending[type(obj)][self.key(obj)] = obj
+
+    def promote(self, db):
+        '''
+        Move flushed pending objects to the id cache and forget
+        the ones removed from the session by a rollback.
+        '''
+        for table, pending in self._pending.items():
+            for key, obj in pending.items():
+                if obj not in db.session:
+                    del pending[key]
+                elif obj.id is not None:
+                    self._ids[table].set(key, obj.id)
+                    del pending[key]
+
+    @staticmethod
+    def _query(db, table, keys):
+        # Match the whole natural key, comparing a None column
+        # with None renders IS NULL.
+        if table is SymbolSource:
+            return db.session.query(SymbolSource).\
+                    filter(or_(*[and_(SymbolSource.build_id == build_id,
+                                      SymbolSource.path == path,
+                                      SymbolSource.offset == offset)
+                                 for build_id, path, offset in keys]))
+
+        return db.session.query(Symbol).\
+                filter(or_(*[and_(Symbol.name == name,
+                                  Symbol.normalized_path == normalized_path)
+                             for name, normalized_path in keys]))
+
+    def resolve(self, db, table, keys):
+        '''
+        Return a dict mapping each of `keys` to an object
+        of `table` (SymbolSource or Symbol) or None.
+        '''
+        keys = set(keys)
+        ids = self._ids[table]
+        pending = self._pending[table]
+        result = {}
+        cached = {}
+        for key in keys:
+            obj = pending.get(key)
+            if obj is not None:
+                if obj in db.session:
+                    result[key] = obj
+                    continue
+                del pending[key]
+
+            obj_id = ids.get(key)
+            if obj_id is not None:
+                cached[obj_id] = key
+
+        for chunk in chunks(cached.keys()):
+            for obj in db.session.query(table).filter(table.id.in_(chunk)):
+                if self.key(obj) == cached[obj.id]:
+                    result[cached[obj.id]] = obj
+
+        for key in cached.itervalues():
+            if key not in result:
+                ids.pop(key)
+
+        for chunk in chunks((key for key in keys if key not in result), KEY_CHUNK_SIZE):
+            chunk = set(chunk)
+            for obj in self._query(db, table, chunk):
+                key = self.key(obj)
+                if key in chunk and key not in result:
+                    result[key] = obj
+                    ids.set(key, obj.id)
+
+        for key in keys:
+            result.setdefault(key, None)
+
+        return result
+
+symbol_cache = SymbolCache()
+
+_MISSING = object()
+
+class ReportBatch(object):
+    '''
+    Lookup tables shared by uReports saved within one transaction.
+
+    `prefetch` resolves the components, known reports, symbol sources,
+    symbols and packages needed by the given uReports with a few
+    set-based queries, add_report then only consults the tables.
+    Objects created while saving a report are recorded in the tables too,
+    `rollback` forgets the ones recorded since the last `commit` so that
+    a report rolled back to its savepoint does not leave stale entries.
+    Statistics are aggregated in `stats` and must be written by calling
+    `stats.flush` before the transaction is committed.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self._prepared = {}
+        self._components = {}
+        self._guessed_components = {}
+        self._packages = {}
+        self._reports = {}
+        self._new_reports = {}
+        self._symbolsources = {}
+        self._symbols = {}
+        self.stats = StatsAccumulator()
+        self._added = []
+
+    def _set(self, table, key, value):
+        self._added.append((table, key, table.get(key, _MISSING)))
+        table[key] = value
+
+    def commit(self):
+        self.stats.commit()
+        self._added = []
+
+    def rollback(self):
+        self.stats.rollback()
+        for table, key, previous in reversed(self._added):
+            if previous is _MISSING:
+                table.pop(key, None)
+            else:
+                table[key] = previous
+        self._added = []
+
+    def prefetch(self, ureports):
+        '''
+        Resolve lookups of all `ureports` at once. Reports failing
+        to normalize are skipped here and fail again in add_report.
+        '''
+        self._prefetch_components(ureports)
+
+        prepared = []
+        for ureport in ureports:
+            try:
+                prepared.append((ureport, self.prepare(ureport)))
+            except Exception:
+                continue
+
+        self._prefetch_reports(prepared)
+        self._prefetch_symbols([ureport for ureport, _ in prepared])
+        self._prefetch_packages(ureports)
+        self.commit()
+
+    def _prefetch_components(self, ureports):
+        # Named components are answered by the dimension cache,
+        # only the components guessed from packages are queried.
+        pkgnames = set()
+        osnames = set()
+        for ureport in ureports:
+            if "component" not in ureport:
+                osnames.add(ureport["os"]["name"])
+                pkgnames.add(ureport["installed_package"]["name"])
+
+        for chunk in chunks(pkgnames):
+            for pkgname, osname, osversion, component in \
+                    self.db.session.query(Package.name, OpSys.name, OpSysRelease.version,
+                                          OpSysComponent).\
+                    join(Package.build).join(Build.component).\
+                    join(OpSysComponent.opsysreleases).join(OpSysRelease.opsys).\
+                    filter(Package.name.in_(chunk) & OpSys.name.in_(osnames)):
+                self._guessed_components.setdefault((pkgname, osname, osversion), component)
+
+        for ureport in ureports:
+            if "component" not in ureport:
+                key = (ureport["installed_package"]["name"],
+                       ureport["os"]["name"], ureport["os"]["version"])
+                self._guessed_components.setdefault(key, None)
+
+    def _prefetch_reports(self, prepared):
+        hashes = set(hash_hash for _, (_, _, hash_hash) in prepared)
+        for chunk in chunks(hashes):
+            for report, hash_type, hash_hash in \
+                    self.db.session.query(Report, ReportBtHash.type, ReportBtHash.hash).\
+                    join(ReportBacktrace).join(ReportBtHash).\
+                    filter(ReportBtHash.hash.in_(chunk)):
+                self._reports.setdefault((hash_type, hash_hash, report.component_id), report)
+
+        for _, (component, hash_type, hash_hash) in prepared:
+            self._reports.setdefault((hash_type, hash_hash, component.id), None)
+
+    def _prefetch_symbols(self, ureports):
+        keys = set()
+        for ureport in ureports:
+            for frame in get_crash_thread(ureport):
+                if "path" in frame:
+                    keys.add((frame.get("buildid"), frame["path"], frame["offset"]))
+
+        for key, symbolsource in symbol_cache.resolve(self.db, SymbolSource, keys).items():
+            self._symbolsources.setdefault(key, symbolsource)
+
+        symbol_keys = set()
+        for ureport in ureports:
+            for frame in get_crash_thread(ureport):
+                if "path" not in frame:
+                    continue
+                key = (frame.get("buildid"), frame["path"], frame["offset"])
+                if self._symbolsources[key] is None and "funcname" in frame:
+                    symbol_keys.add((frame["funcname"], get_libname(frame["path"])))
+
+        for key, symbol in symbol_cache.resolve(self.db, Symbol, symbol_keys).items():
+            self._symbols.setdefault(key, symbol)
+
+    def _prefetch_packages(self, ureports):
+        keys = set()
+        for ureport in ureports:
+            ureport_os = ureport["os"]
+            packages = [ureport["installed_package"]]
+            if "running_package" in ureport:
+                packages.append(ureport["running_package"])
+            for related_package in ureport.get("related_packages", []):
+                packages.append(related_package["installed_package"])
+                if "running_package" in related_package:
+                    packages.append(related_package["running_package"])
+            if "selinux" in ureport and "policy_package" in ureport["selinux"]:
+                packages.append(ureport["selinux"]["policy_package"])
+
+            for package in packages:
+                keys.add(self._package_key(package, ureport_os))
+
+        names = set(key[0] for key in keys)
+        versions = set(key[2] for key in keys)
+        for chunk in chunks(names):
+            for row in self.db.session.query(Package, Build.epoch, Build.version,
+                                             Build.release, Arch.name, OpSys.name,
+                                             OpSysRelease.version).\
+                    join(Package.arch).join(Package.build).\
+                    join(Build.component).join(OpSysComponent.opsysreleases).\
+                    join(OpSysRelease.opsys).\
+                    filter(Package.name.in_(chunk) & Build.version.in_(versions)):
+                key = (row[0].name,) + tuple(row[1:])
+                if key in keys:
+                    self._packages.setdefault(key, row[0])
+
+        for key in keys:
+            self._packages.setdefault(key, None)
+
+    def prepare(self, ureport):
+        key = id(ureport)
+        if key not in self._prepared:
+            try:
+                self._prepared[key] = (ureport, _prepare_report(ureport, self.db, batch=self))
+            except Exception as ex:
+                self._prepared[key] = (ureport, ex)
+
+        result = self._prepared[key][1]
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def get_component(self, component_name, ureport_os):
+        key = (component_name, ureport_os["name"], ureport_os["version"])
+        if key not in self._components:
+            self._components[key] = get_component(component_name, ureport_os, self.db)
+        return self._components[key]
+
+    def guess_component(self, ureport_package, ureport_os):
+        key = (ureport_package["name"], ureport_os["name"], ureport_os["version"])
+        if key not in self._guessed_components:
+            self._guessed_components[key] = guess_component(ureport_package,
+                                                            ureport_os, self.db)
+        return self._guessed_components[key]
+
+    def get_report(self, hash_type, hash_hash, component):
+        key = (hash_type, hash_hash, component.id)
+        if key not in self._reports:
+            self._reports[key] = self.db.session.query(Report).\
+                    join(ReportBacktrace).join(ReportBtHash).\
+                    filter((ReportBtHash.hash == hash_hash) & \
+                           (ReportBtHash.type == hash_type) & \
+                           (Report.component == component)).first()
+        return self._reports[key]
+
+    def add_report(self, hash_type, hash_hash, component, report):
+        self._set(self._reports, (hash_type, hash_hash, component.id), report)
+        self._set(self._new_reports, id(report), report)
+
+    def get_symbolsource(self, build_id, path, offset):
+        key = (build_id, path, offset)
+        if key not in self._symbolsources:
+            self._symbolsources[key] = symbol_cache.resolve(self.db, SymbolSource,
+                                                            [key])[key]
+        return self._symbolsources[key]
+
+    def add_symbolsource(self, symbolsource):
+        self._set(self._symbolsources, symbol_cache.key(symbolsource), symbolsource)
+
+    def get_symbol(self, name, normalized_path):
+        key = (name, normalized_path)
+        if key not in self._symbols:
+            self._symbols[key] = symbol_cache.resolve(self.db, Symbol, [key])[key]
+        return self._symbols[key]
+
+    def add_symbol(self, symbol):
+        self._set(self._symbols, symbol_cache.key(symbol), symbol)
+
+    @staticmethod
+    def _package_key(ureport_package, ureport_os):
+        return (ureport_package["name"], ureport_package["epoch"],
+                ureport_package["version"], ureport_package["release"],
+                ureport_package["architecture"], ureport_os["name"],
+                ureport_os["version"])
+
+    def get_package(self, ureport_package, ureport_os):
+        key = self._package_key(ureport_package, ureport_os)
+        if key not in self._packages:
+            self._packages[key] = get_package(ureport_package, ureport_os, self.db)
+        return self._packages[key]
+
+def prepare_report(ureport, db, batch=None):
+    '''
+    Normalize `ureport` in place and return tuple of its component,
+    backtrace hash type and backtrace hash.
+
+    With `batch` the result is remembered, because the normalization
+    (flipping of the core backtrace) must only be done once.
+    '''
+    if batch:
+        return batch.prepare(ureport)
+
+    return _prepare_report(ureport, db)
+
+def _prepare_report(ureport, db, batch=None):
     if "component" in ureport:
-        component = get_component(ureport["component"], ureport["os"], db)
+        if batch:
+            component = batch.get_component(ureport["component"], ureport["os"])
+        else:
+            component = get_component(ureport["component"], ureport["os"], db)
     else:
-        component = guess_component(ureport["installed_package"], ureport["os"], db)
+        if batch:
+            component = batch.guess_component(ureport["installed_package"], ureport["os"])
+        else:
+            component = guess_component(ureport["installed_package"], ureport["os"], db)
     if component is None:
         raise Exception, "Unknown component."
 
+    flip_corebt_if_necessary(ureport)
+
     for frame in ureport["core_backtrace"]:
         if not "path" in frame and "executable" in ureport:
             frame["path"] = ureport["executable"]
@@ -596,11 +1215,23 @@ def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, re
 
     hash_type, hash_hash = get_report_hash(ureport, component.name)
 
+    return component, hash_type, hash_hash
+
+def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False,
+               return_report=False, batch=None):
+    if not utctime:
+        utctime = datetime.datetime.utcnow()
+
+    component, hash_type, hash_hash = prepare_report(ureport, db, batch=batch)
+
     # Find a report with matching hash and component.
-    report = db.session.query(Report).join(ReportBacktrace).join(ReportBtHash).\
-            filter((ReportBtHash.hash == hash_hash) & \
-                   (ReportBtHash.type == hash_type) & \
-                   (Report.component == component)).first()
+    if batch:
+        report = batch.get_report(hash_type, hash_hash, component)
+    else:
+        report = db.session.query(Report).join(ReportBacktrace).join(ReportBtHash).\
+                filter((ReportBtHash.hash == hash_hash) & \
+                       (ReportBtHash.type == hash_type) & \
+                       (Report.component == component)).first()
 
     if only_check_if_known:
         # check whether the report has a BZ associated
@@ -646,26 +1277,35 @@ def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, re
         report_bthash.backtrace = report_backtrace
         db.session.add(report_bthash)
 
+        if batch:
+            batch.add_report(hash_type, hash_hash, component, report)
+
+        frames = get_crash_thread(ureport)
+        for frame in frames:
+            if not "buildid" in frame:
+                frame["buildid"] = None
+
+        # Look up symbol sources and symbols of all frames at once.
+        if not batch:
+            symbolsources = symbol_cache.resolve(db, SymbolSource,
+                    [(f["buildid"], f["path"], f["offset"]) for f in frames])
+            symbols = symbol_cache.resolve(db, Symbol,
+                    [(f["funcname"], get_libname(f["path"])) for f in frames
+                     if "funcname" in f and not symbolsources[(f["buildid"],
+                                                               f["path"],
+                                                               f["offset"])]])
+
         # Add frames, symbols, hashes and sources.
-        for frame in get_crash_thread(ureport):
+        for frame in frames:
             report_btframe = ReportBtFrame()
             report_btframe.backtrace = report_backtrace
             report_btframe.order = frame["frame"]
-            if not "buildid" in frame:
-                frame["buildid"] = None
 
-            # Check if there was already such symbol added, but first check
-            # the current session before doing a query.
-            for symbolsource in (x for x in db.session.new if type(x) is SymbolSource):
-                if symbolsource.build_id == frame["buildid"] and \
-                        symbolsource.path == frame["path"] and \
-                        symbolsource.offset == frame["offset"]:
-                    break
+            key = (frame["buildid"], frame["path"], frame["offset"])
+            if batch:
+                symbolsource = batch.get_symbolsource(*key)
             else:
-                symbolsource = db.session.query(SymbolSource).\
-                        filter((SymbolSource.build_id == frame["buildid"]) & \
-                               (SymbolSource.path == frame["path"]) & \
-                               (SymbolSource.offset == frame["offset"])).first()
+                symbolsource = symbolsources[key]
 
             # Create a new symbolsource if not found.
             if not symbolsource:
@@ -681,15 +1321,11 @@ def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, re
                     symbolsource.hash = frame["funchash"]
 
                 if "funcname" in frame:
-                    normalized_path = get_libname(frame["path"])
-                    for symbol in (x for x in db.session.new if type(x) is Symbol):
-                        if symbol.name == frame["funcname"] and \
-                            symbol.normalized_path == normalized_path:
-                            break
+                    symbol_key = (frame["funcname"], get_libname(frame["path"]))
+                    if batch:
+                        symbol = batch.get_symbol(*symbol_key)
                     else:
-                        symbol = db.session.query(Symbol).\
-                                filter((Symbol.name == frame["funcname"]) & \
-                                       (Symbol.normalized_path == normalized_path)).first()
+                        symbol = symbols.get(symbol_key)
 
                     # Create a new symbol if not found.
                     if not symbol:
@@ -700,12 +1336,24 @@ def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, re
                         if demangled != symbol.name:
                             symbol.nice_name = demangled
 
-                        symbol.normalized_path = normalized_path
+                        symbol.normalized_path = symbol_key[1]
                         db.session.add(symbol)
+                        symbol_cache.add(symbol)
+
+                        if batch:
+                            batch.add_symbol(symbol)
+                        else:
+                            symbols[symbol_key] = symbol
 
                     symbolsource.symbol = symbol
 
                 db.session.add(symbolsource)
+                symbol_cache.add(symbolsource)
+
+                if batch:
+                    batch.add_symbolsource(symbolsource)
+                else:
+                    symbolsources[key] = symbolsource
 
             report_btframe.symbolsource = symbolsource
             db.session.add(report_btframe)
@@ -723,17 +1371,16 @@ def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, re
                 report.problem.first_occurence = report.first_occurence
 
     db.session.flush()
+    symbol_cache.promote(db)
+
     if report.type == "KERNELOOPS":
         if not report.get_lob_fd("oops") and "oops" in ureport:
             report.save_lob("oops", ureport["oops"])
 
     # Update various stats.
 
-    opsysrelease = db.session.query(OpSysRelease).join(OpSys).filter(\
-            (OpSysRelease.version == ureport["os"]["version"]) & \
-            (OpSys.name == ureport["os"]["name"])).one()
-
-    arch = db.session.query(Arch).filter_by(name=ureport['architecture']).one()
+    opsysrelease = get_opsysrelease(ureport["os"], db)
+    arch = get_arch(ureport["architecture"], db)
 
     day = utctime.date()
     week = day - datetime.timedelta(days=day.weekday())
@@ -757,12 +1404,13 @@ def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, re
         stat_map.append((ReportUptime, [("uptime_exp", uptime_exp)]))
 
     # Add the reported package (installed and running).
-    stat_map.append(get_package_stat("CRASHED", ureport, ureport["os"], db))
+    stat_map.append(get_package_stat("CRASHED", ureport, ureport["os"], db, batch=batch))
 
     # Similarly add related packages.
     if "related_packages" in ureport:
         for related_package in ureport["related_packages"]:
-            stat_map.append(get_package_stat("RELATED", related_package, ureport["os"], db))
+            stat_map.append(get_package_stat("RELATED", related_package, ureport["os"], db,
+                                             batch=batch))
 
     # Add selinux fields to stat_map
     if "selinux" in ureport:
@@ -773,7 +1421,8 @@ def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, re
 
         if "policy_package" in ureport["selinux"]:
             stat_map.append(get_package_stat("SELINUX_POLICY",
-                {"installed_package": ureport["selinux"]["policy_package"]}, ureport["os"], db))
+                {"installed_package": ureport["selinux"]["policy_package"]}, ureport["os"], db,
+                batch=batch))
 
     # Add kernel taint state fields to stat_map.
     if "kernel_taint_state" in ureport:
@@ -781,6 +1430,10 @@ def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, re
 
     # Create missing stats and increase counters.
     for table, cols in stat_map:
+        if batch:
+            batch.stats.add(table, report, cols, count)
+            continue
+
         report_stat_query = db.session.query(table).join(Report).filter(Report.id == report.id)
         for name, value in cols:
             report_stat_query = report_stat_query.filter(getattr(table, name) == value)
@@ -793,10 +1446,58 @@ def add_report(ureport, db, utctime=None, count=1, only_check_if_known=False, re
                 setattr(report_stat, name, value)
             report_stat.count = 0
             db.session.add(report_stat)
+
         report_stat.count += count
 
+def get_known_report(ureport, db):
+    '''
+    Return tuple of id of the stored report matching `ureport` and list
+    of ids of its bugs, or None if the report is not known. A report is
+    known if it is stored and has a bug or a knowledge base solution.
+
+    Stored reports are looked up in the in-memory index of known reports,
+    which follows the database with a delay of a few seconds.
+    '''
+    component, hash_type, hash_hash = prepare_report(ureport, db)
+
+    known = known_reports.get(db, hash_type, hash_hash, component.id)
+    if known is None:
+        return None
+
+    report_id, bug_ids = known
+    if not bug_ids and not find_ureport_kb_solution(ureport, db,
+                                                    opsys_id=component.opsys_id):
+        return None
+
+    return known
+
+def get_submission_info(ureport, db):
+    '''
+    Return tuple of backtrace hash of `ureport`, the result of
+    get_known_report and the knowledge base solution of `ureport`
+    or None.
+
+    Only the in-memory caches are used, the database is queried
+    just when they need to be refreshed.
+    '''
+    component, hash_type, hash_hash = prepare_report(ureport, db)
+    solution = find_ureport_kb_solution(ureport, db, opsys_id=component.opsys_id)
+
+    known = known_reports.get(db, hash_type, hash_hash, component.id)
+    if known is not None and not known[1] and solution is None:
+        known = None
+
+    return hash_hash, known, solution
+
 def is_known(ureport, db, return_report=False):
-    return add_report(ureport, db, only_check_if_known=True, return_report=return_report)
+    known = get_known_report(ureport, db)
+    if return_report:
+        if known is None:
+            return None
+
+        return db.session.query(Report).get(known[0])
+
+    return bool(known)
 
 def convert_to_str(obj):
     if type(obj) in (int, float, str, bool, long):
@@ -821,12 +1522,40 @@ def get_btp_thread(backtrace, max_frames=None, normalize=True):
         thread.frames = thread.frames[:max_frames]
     return thread
 
+def btp_thread_to_text(thread):
+    # Serialize a btparser thread as it is parsed by btparser.Thread(text, True).
+    return "".join("{0} {1}\n".format(frame.get_function_name(),
+                                      frame.get_library_name())
+                   for frame in thread.frames)
+
+def get_cached_btp_threads(report_ids, db):
+    # Return dict mapping report ids to the texts of the first cached
+    # normalized thread of the report.
+    result = dict()
+    for report_ids_chunk in chunks(report_ids):
+        for report_id, thread in db.session.query(ReportBtThread.report_id,
+                                                  ReportBtThread.thread).\
+                filter(ReportBtThread.report_id.in_(report_ids_chunk) &
+                       (ReportBtThread.version == BT_THREAD_VERSION)).\
+                order_by(ReportBtThread.backtrace_id):
+            result.setdefault(report_id, thread)
+
+    return result
+
 def get_report_btp_threads(report_ids, db, max_frames=None, normalize=True, log_debug=None):
     # Create btparser threads for specified report ids. Return a list
     # of (report_id, thread) pairs.
+    # Normalized threads are parsed from the ReportBtThread cache, the
+    # missing ones are created from the backtraces and stored there.
 
     result = []
 
+    cached = dict()
+    if normalize:
+        cached = get_cached_btp_threads(report_ids, db)
+        if log_debug:
+            log_debug("Found {0}/{1} cached threads.".format(len(cached), len(report_ids)))
+
     # Split the ids into small groups to keep memory consumption low.
     group_size = 100
     report_id_groups = []
@@ -835,36 +1564,101 @@ def get_report_btp_threads(report_ids, db, max_frames=None, normalize=True, log_
 
     # Load all reports from each group and create threads.
     for i, report_id_group in enumerate(report_id_groups):
-        if log_debug:
+        missing = [group_report_id for group_report_id in report_id_group
+                   if group_report_id not in cached]
+        if log_debug and missing:
             log_debug("Loading reports {0}-{1}/{2}.".format(i * group_size + 1,
                 i * group_size + len(report_id_group), len(report_ids)))
 
-        # Set joined load to fetch all needed data at once.
-        reports = db.session.query(Report).filter(Report.id.in_(report_id_group)).\
-                options(joinedload_all('backtraces.frames.symbolsource.symbol')).\
-                order_by(Report.id).all()
+        threads = dict()
+        for report_id in report_id_group:
+            if report_id in cached:
+                thread = btparser.Thread(cached.pop(report_id), True)
+                if max_frames:
+                    thread.frames = thread.frames[:max_frames]
+                threads[report_id] = thread
+
+        if missing:
+            if normalize:
+                # threads of other versions are replaced
+                db.session.query(ReportBtThread).\
+                        filter(ReportBtThread.report_id.in_(missing)).\
+                        delete(synchronize_session=False)
+
+            # Set joined load to fetch all needed data at once.
+            reports = db.session.query(Report).filter(Report.id.in_(missing)).\
+                    options(joinedload_all('backtraces.frames.symbolsource.symbol')).\
+                    order_by(Report.id).all()
+
+            for report in reports:
+                for backtrace in report.backtraces:
+                    thread = get_btp_thread(backtrace, normalize=normalize)
+                    if normalize:
+                        db.session.add(ReportBtThread(backtrace_id=backtrace.id,
+                                                      report_id=report.id,
+                                                      version=BT_THREAD_VERSION,
+                                                      thread=btp_thread_to_text(thread)))
+                    if max_frames:
+                        thread.frames = thread.frames[:max_frames]
+                    threads[report.id] = thread
+
+                    # For now, return only the first thread per report.
+                    break
 
-        for report in reports:
-            for backtrace in report.backtraces:
-                thread = get_btp_thread(backtrace, max_frames=max_frames, normalize=normalize)
-                result.append((report.id, thread))
+            db.session.flush()
 
-                # For now, return only the first thread per report.
-                break
+        for report_id in sorted(threads):
+            result.append((report_id, threads[report_id]))
 
     return result
 
+def has_path_components(opsys_id, db):
+    # Return whether the path to component map of the operating system
+    # is filled, it is empty in databases created before the map existed.
+    if opsys_id not in path_components_filled:
+        path_components_filled[opsys_id] = \
+                db.session.query(PathComponent.path).\
+                        filter(PathComponent.opsys_id == opsys_id).first() is not None
+
+    return path_components_filled[opsys_id]
+
 def get_components_by_files(paths, opsys_id, db):
-    # Return list of paths and corresponding components according to package provides.
-    #pylint:disable=E1101
-    # Class 'OpSysComponent' has no 'builds' member
-    return db.session.query(PackageDependency.name, OpSysComponent.name).\
-            join(OpSysComponent.builds).\
-            join(Build.packages).\
-            join(Package.dependencies).\
-            filter((OpSysComponent.opsys_id == opsys_id) & \
-                   (PackageDependency.type == 'PROVIDES') & \
-                   (PackageDependency.name.in_(paths))).distinct().all()
+    # Return list of paths and corresponding components according to
+    # the path to component map, which is built from package provides.
+    result = []
+    missing = []
+    for path in paths:
+        component = path_component_cache.get((opsys_id, path), False)
+        if component is False:
+            missing.append(path)
+        elif component is not None:
+            result.append((path, component))
+
+    found = dict()
+    for paths_chunk in chunks(missing):
+        if has_path_components(opsys_id, db):
+            found.update(db.session.query(PathComponent.path, OpSysComponent.name).\
+                    join(PathComponent.component).\
+                    filter((PathComponent.opsys_id == opsys_id) &
+                           (PathComponent.path.in_(paths_chunk))).all())
+        else:
+            #pylint:disable=E1101
+            # Class 'OpSysComponent' has no 'builds' member
+            found.update(db.session.query(PackageDependency.name, OpSysComponent.name).\
+                    join(OpSysComponent.builds).\
+                    join(Build.packages).\
+                    join(Package.dependencies).\
+                    filter((OpSysComponent.opsys_id == opsys_id) & \
+                           (PackageDependency.type == 'PROVIDES') & \
+                           (PackageDependency.name.in_(paths_chunk))).\
+                    order_by(OpSysComponent.id.desc()).all())
+
+    for path in missing:
+        path_component_cache.set((opsys_id, path), found.get(path))
+        if path in found:
+            result.append((path, found[path]))
+
+    return result
 
 def get_symbolsource_paths(report_ids, db):
     # Return symbolsource paths for all frames in all backtraces for each report.